@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import time
+from cache_entidades import cache_entidades
+from db_config import database
+from exportaciones import binarios
+from permisos import cargar_mapa_acceso
+from procesos import get_pool
+
+
+#Precalentamiento opcional al arrancar (ESCRIBDREAM_PRECALENTAR=1). Se ejecuta en el evento startup, después de
+#conectar la base de datos y de buscar los binarios, y antes de que uvicorn acepte peticiones, así que las
+#primeras peticiones no pagan:
+#  - abrir las conexiones del pool (PRECALENTAR_CONEXIONES consultas SELECT 1 en paralelo)
+#  - importar passlib y cargar el backend de bcrypt, que usa cada login
+#  - arrancar los procesos del pool de procesos (imágenes y exportaciones)
+#  - comprobar que Node y wkhtmltopdf se pueden ejecutar; si no, sus formatos quedan desactivados
+#  - cargar los mapas de acceso y los proyectos (caché de entidades) de los PRECALENTAR_USUARIOS usuarios que
+#    han modificado proyectos más recientemente, que son los que más probablemente vuelvan enseguida
+#La caché de tokens no se precalienta: los tokens solo se conocen cuando llegan en una petición.
+#Sin precalentar todo esto se hace bajo demanda la primera vez que se necesita
+PRECALENTAR = os.getenv("ESCRIBDREAM_PRECALENTAR", "0") == "1"
+PRECALENTAR_CONEXIONES = int(os.getenv("PRECALENTAR_CONEXIONES", "5"))
+PRECALENTAR_USUARIOS = int(os.getenv("PRECALENTAR_USUARIOS", "100"))
+TIMEOUT_BINARIOS = 10
+
+logger = logging.getLogger("escribdream.arranque")
+
+#Resultado del precalentamiento (lo consultan las comprobaciones de salud)
+estado_arranque = {"precalentado": False, "segundos": None, "errores": []}
+
+
+async def _abrir_conexiones():
+    await asyncio.gather(*(database.fetch_one(query="SELECT 1") for _ in range(PRECALENTAR_CONEXIONES)))
+
+
+def _cargar_passlib():
+    from endpoint_login_register import get_pwd_context
+    #La primera verificación es la que carga el backend de bcrypt
+    contexto = get_pwd_context()
+    contexto.verify("precalentamiento", contexto.hash("precalentamiento"))
+
+
+async def _cargar_caches():
+    if PRECALENTAR_USUARIOS <= 0:
+        return
+    usuarios = await database.fetch_all(
+        query="""SELECT id_usuario FROM proyectos WHERE eliminado_en IS NULL
+            GROUP BY id_usuario ORDER BY MAX(fecha_modificacion) DESC LIMIT :limite""",
+        values={"limite": PRECALENTAR_USUARIOS}
+    )
+    ids = [fila["id_usuario"] for fila in usuarios]
+    if not ids:
+        return
+    #Los mapas de acceso de pocos en pocos para no ocupar todas las conexiones del pool
+    for inicio in range(0, len(ids), PRECALENTAR_CONEXIONES):
+        await asyncio.gather(*(cargar_mapa_acceso(id_usuario) for id_usuario in ids[inicio:inicio + PRECALENTAR_CONEXIONES]))
+    #Las mismas entradas que guarda GET /proyectos/{id_proyecto}
+    generacion = cache_entidades.generacion
+    proyectos = await database.fetch_all(
+        query=f"SELECT * FROM proyectos WHERE id_usuario IN ({', '.join(str(int(id_usuario)) for id_usuario in ids)}) AND eliminado_en IS NULL"
+    )
+    for proyecto in proyectos:
+        await cache_entidades.set("proyecto", proyecto["id_proyecto"], dict(proyecto), etiquetas=[("usuario", proyecto["id_usuario"])], generacion=generacion)
+
+
+def _arrancar_procesos():
+    pool = get_pool()
+    for futuro in [pool.submit(abs, 0) for _ in range(pool._max_workers)]:
+        futuro.result()
+
+
+async def _comprobar_binario(nombre):
+    ruta = binarios.get(nombre)
+    if ruta is None:
+        return
+    try:
+        proceso = await asyncio.create_subprocess_exec(ruta, "--version", stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        codigo = await asyncio.wait_for(proceso.wait(), timeout=TIMEOUT_BINARIOS)
+    except (OSError, asyncio.TimeoutError) as error:
+        codigo = error
+    if codigo != 0:
+        logger.warning("%s (%s) no se puede ejecutar (%s): los formatos que lo necesitan no estarán disponibles", nombre, ruta, codigo)
+        binarios[nombre] = None
+
+
+async def precalentar():
+    inicio = time.perf_counter()
+    pasos = [
+        ("conexiones", _abrir_conexiones()),
+        ("caches", _cargar_caches()),
+        ("passlib", asyncio.to_thread(_cargar_passlib)),
+        ("procesos", asyncio.to_thread(_arrancar_procesos)),
+        ("binarios", asyncio.gather(*(_comprobar_binario(nombre) for nombre in list(binarios)))),
+    ]
+    resultados = await asyncio.gather(*(paso for _, paso in pasos), return_exceptions=True)
+    estado_arranque["errores"] = [f"{nombre}: {resultado}" for (nombre, _), resultado in zip(pasos, resultados) if isinstance(resultado, Exception)]
+    for error in estado_arranque["errores"]:
+        logger.error("Error al precalentar %s", error)
+    estado_arranque["segundos"] = round(time.perf_counter() - inicio, 3)
+    estado_arranque["precalentado"] = True
+    logger.info("Precalentamiento terminado en %s s", estado_arranque["segundos"])
+
+
+async def iniciar_arranque():
+    if PRECALENTAR:
+        await precalentar()
@@ -0,0 +1,83 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from indice_espacial import IndiceMapa, caja_localizacion
+
+
+#Compara las vistas de GET /localizaciones/mapa/{id_mapa}/vista con la rejilla de indice_espacial.py y recorriendo
+#todas las localizaciones del mapa, sin red ni base de datos. Las vistas son cuadrados de LADO_VISTA píxeles en
+#sitios al azar de un mapa de LADO_MAPA píxeles, como las de un lector que navega ampliado; un 10 % de las
+#localizaciones tienen polígono. Cada medida es el mejor tiempo de varias rondas.
+#Uso: python benchmarks/bench_indice_espacial.py [localizaciones] [vistas por ronda] [rondas]
+LOCALIZACIONES = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+VISTAS = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+RONDAS = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+LADO_MAPA = 16384
+LADO_VISTA = 1024
+
+
+def localizaciones_sinteticas(rng):
+    localizaciones = []
+    for id_localizacion in range(1, LOCALIZACIONES + 1):
+        x, y = rng.uniform(0, LADO_MAPA), rng.uniform(0, LADO_MAPA)
+        poligono = None
+        if rng.random() < 0.1:
+            radio = rng.uniform(20, 300)
+            poligono = [[x - radio, y - radio], [x + radio, y - radio], [x, y + radio]]
+        localizaciones.append({"id_localizacion": id_localizacion, "nombre_localizacion": f"Lugar {id_localizacion}",
+                               "tipo_terreno": None, "coordenada_x": x, "coordenada_y": y, "poligono": poligono})
+    return localizaciones
+
+
+def recorrido_lineal(localizaciones, x_min, y_min, x_max, y_max):
+    resultado = []
+    for localizacion in localizaciones:
+        caja = caja_localizacion(localizacion["coordenada_x"], localizacion["coordenada_y"], localizacion["poligono"])
+        if caja[0] <= x_max and caja[2] >= x_min and caja[1] <= y_max and caja[3] >= y_min:
+            resultado.append(localizacion)
+    return resultado
+
+
+def ronda(buscar, vistas):
+    inicio = time.perf_counter()
+    for vista in vistas:
+        buscar(*vista)
+    return (time.perf_counter() - inicio) / len(vistas)
+
+
+def main():
+    rng = random.Random(1)
+    localizaciones = localizaciones_sinteticas(rng)
+    inicio = time.perf_counter()
+    indice = IndiceMapa(localizaciones)
+    construccion = time.perf_counter() - inicio
+    vistas = []
+    for _ in range(VISTAS):
+        x, y = rng.uniform(0, LADO_MAPA - LADO_VISTA), rng.uniform(0, LADO_MAPA - LADO_VISTA)
+        vistas.append((x, y, x + LADO_VISTA, y + LADO_VISTA))
+
+    #Las dos formas tienen que devolver lo mismo
+    for vista in vistas[:20]:
+        esperado = {localizacion["id_localizacion"] for localizacion in recorrido_lineal(localizaciones, *vista)}
+        if {localizacion["id_localizacion"] for localizacion in indice.buscar(*vista)} != esperado:
+            print("La rejilla no devuelve las mismas localizaciones que el recorrido lineal")
+            return 1
+
+    tiempos_rejilla, tiempos_lineal = [], []
+    for _ in range(RONDAS):
+        tiempos_rejilla.append(ronda(indice.buscar, vistas))
+        tiempos_lineal.append(ronda(lambda *vista: recorrido_lineal(localizaciones, *vista), vistas))
+    rejilla, lineal = min(tiempos_rejilla), min(tiempos_lineal)
+    print(f"localizaciones:        {LOCALIZACIONES} (rejilla de {len(indice.celdas)} celdas, construida en {construccion * 1e3:.1f} ms)")
+    print(f"rejilla:               {rejilla * 1e6:.1f} us/vista")
+    print(f"recorrido lineal:      {lineal * 1e6:.1f} us/vista")
+    print(f"mejora:                x{lineal / rejilla:.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
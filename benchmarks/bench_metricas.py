@@ -0,0 +1,158 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import FastAPI
+from uvicorn.config import Config
+from uvicorn.protocols.http.httptools_impl import HttpToolsProtocol
+from uvicorn.server import ServerState
+from metricas import Metricas, MetricasMiddleware
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+#Mide el sobrecoste del middleware de métricas respecto a una ruta trivial (/ping/{id}).
+#Comparar dos servidores completos no sirve para ver un 2 %: el ruido de la máquina es mayor que eso.
+#Por eso se mide por separado y sin red:
+#  - lo que cuesta atender la ruta trivial: protocolo HTTP de uvicorn (httptools) + toda la pila de FastAPI,
+#    alimentando el protocolo directamente con un transporte en memoria
+#  - lo que añade el middleware, envolviendo una aplicación ASGI mínima que responde lo mismo
+#Cada medida es el mejor tiempo de varias rondas alternadas, que es el menos contaminado por otros procesos.
+#Uso: python benchmarks/bench_metricas.py [peticiones por ronda] [rondas]
+PETICIONES = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+RONDAS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+LIMITE_SOBRECOSTE = 2.0
+
+CUERPO = b'{"ok":true,"content":1}'
+
+
+def crear_app():
+    app = FastAPI()
+
+    @app.get("/api/escribdream/ping/{id_recurso}")
+    async def ping(id_recurso: int):
+        return {"ok": True, "content": id_recurso}
+
+    return app
+
+
+#Aplicación ASGI mínima: solo sirve para aislar el coste del middleware
+async def app_minima(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-length", b"23"), (b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": CUERPO})
+
+
+class RutaPing:
+    path = "/api/escribdream/ping/{id_recurso}"
+
+
+class TransporteMemoria(asyncio.Transport):
+    def __init__(self):
+        super().__init__()
+        self.extra = {"sockname": ("127.0.0.1", 4000), "peername": ("127.0.0.1", 1234)}
+
+    def get_extra_info(self, name, default=None):
+        return self.extra.get(name, default)
+
+    def write(self, data):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ProtocoloMedido(HttpToolsProtocol):
+    def on_response_complete(self):
+        super().on_response_complete()
+        self.respuesta_completa.set_result(None)
+
+
+async def ronda_servidor(protocolo, peticiones):
+    loop = asyncio.get_running_loop()
+    inicio = time.perf_counter()
+    for i in range(peticiones):
+        protocolo.respuesta_completa = loop.create_future()
+        protocolo.data_received(f"GET /api/escribdream/ping/{i} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        await protocolo.respuesta_completa
+    return (time.perf_counter() - inicio) / peticiones
+
+
+async def receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def send(mensaje):
+    pass
+
+
+async def ronda_asgi(app, peticiones):
+    inicio = time.perf_counter()
+    for i in range(peticiones):
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": f"/api/escribdream/ping/{i}",
+            "raw_path": f"/api/escribdream/ping/{i}".encode(),
+            "query_string": b"",
+            "root_path": "",
+            "headers": [(b"host", b"localhost")],
+            "client": ("127.0.0.1", 1234),
+            "server": ("127.0.0.1", 4000),
+            #FastAPI pone la ruta en el scope al enrutar; la aplicación mínima no lo hace
+            "route": RutaPing,
+        }
+        await app(scope, receive, send)
+    return (time.perf_counter() - inicio) / peticiones
+
+
+async def main():
+    config = Config(crear_app(), http="httptools", lifespan="off", log_level="warning", access_log=False)
+    config.load()
+    protocolo = ProtocoloMedido(config=config, server_state=ServerState(), app_state={})
+    protocolo.connection_made(TransporteMemoria())
+    minima_con_metricas = MetricasMiddleware(app_minima, registro=Metricas())
+
+    #Calentamiento (construcción de la pila de middlewares, cachés de pydantic...)
+    await ronda_servidor(protocolo, 1000)
+    await ronda_asgi(app_minima, 1000)
+    await ronda_asgi(minima_con_metricas, 1000)
+
+    tiempos_ruta, tiempos_minima, tiempos_middleware = [], [], []
+    for _ in range(RONDAS):
+        tiempos_ruta.append(await ronda_servidor(protocolo, PETICIONES))
+        tiempos_minima.append(await ronda_asgi(app_minima, PETICIONES))
+        tiempos_middleware.append(await ronda_asgi(minima_con_metricas, PETICIONES))
+    if protocolo.timeout_keep_alive_task is not None:
+        protocolo.timeout_keep_alive_task.cancel()
+
+    ruta = min(tiempos_ruta)
+    coste_middleware = min(tiempos_middleware) - min(tiempos_minima)
+    sobrecoste = coste_middleware / ruta * 100
+    print(f"ruta trivial:           {ruta * 1e6:.1f} us/petición")
+    print(f"middleware de métricas: {coste_middleware * 1e6:.2f} us/petición")
+    print(f"sobrecoste:             {sobrecoste:.2f} % (límite {LIMITE_SOBRECOSTE} %)")
+    return 0 if sobrecoste < LIMITE_SOBRECOSTE else 1
+
+
+if __name__ == "__main__":
+    if uvloop is not None:
+        uvloop.install()
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+import jwt
+from databases import Database
+from datos_sinteticos import CLAVE_USUARIOS, PERFIL, correo_usuario, crear_esquema, sembrar
+
+
+#Prueba de carga de la API completa contra una base de datos desechable.
+#  1. Crea el esquema y siembra un conjunto de datos sintético (tamaño configurable, misma semilla = mismos datos)
+#  2. Arranca la aplicación con uvicorn en un subproceso apuntando a esa base de datos
+#  3. Lanza cada escenario con N clientes concurrentes y mide latencias
+#  4. Escribe un JSON con rps y p50/p95/p99 por escenario, para comparar commits con benchmarks/comparar.py
+#
+#Con --db sqlite no hace falta nada más que aiosqlite. Con --db mysql hay que pasar --url de una base de datos
+#desechable (se BORRAN y recrean sus tablas), por ejemplo un contenedor:
+#  docker run --rm -d -p 3307:3306 -e MYSQL_ALLOW_EMPTY_PASSWORD=1 -e MYSQL_DATABASE=escribdream_bench mysql:8
+#  python benchmarks/carga.py --db mysql --url mysql://root:@127.0.0.1:3307/escribdream_bench
+#
+#Los escenarios de login y estadísticas usan mysql.connector (síncrono), así que solo se ejecutan con MySQL.
+#La exportación a PDF necesita wkhtmltopdf y Node; si no están, el escenario se registra con sus errores
+API = "/api/escribdream"
+
+#nombre -> (método, ruta con {tipo de recurso}, peso relativo de peticiones, solo con mysql)
+ESCENARIOS = {
+    "login": ("POST", "/token", 0.2, True),
+    "login_google": ("POST", "/verification/account/google", 0.5, False),
+    "proyectos_usuario": ("GET", API + "/proyectos/usuario/{usuario}", 1, False),
+    "proyecto": ("GET", API + "/proyectos/{proyecto}", 1, False),
+    "libros_proyecto": ("GET", API + "/libros/proyecto/{proyecto}", 1, False),
+    "libro": ("GET", API + "/libros/{libro}", 1, False),
+    "capitulos_libro": ("GET", API + "/capitulos/libro/{libro}", 0.5, False),
+    "capitulo": ("GET", API + "/capitulos/{capitulo}", 1, False),
+    "autoguardado_capitulo": ("PUT", API + "/capitulos/{capitulo}", 1, False),
+    "personajes_proyecto": ("GET", API + "/personajes/proyecto/{proyecto}", 1, False),
+    "personaje": ("GET", API + "/personajes/{personaje}", 1, False),
+    "crear_personaje": ("POST", API + "/personajes/", 1, False),
+    "crear_personajes_lote": ("POST", API + "/personajes/lote/", 0.02, False),
+    "lineas_tiempo_proyecto": ("GET", API + "/lineas_tiempo/proyecto/{proyecto}", 1, False),
+    "lineas_tiempo_resumen": ("GET", API + "/lineas_tiempo/proyecto/{proyecto}?incluir_eventos=true", 1, False),
+    "eventos_linea_tiempo": ("GET", API + "/eventos/linea_tiempo/{linea_tiempo}", 1, False),
+    "eventos_ventana": ("GET", API + "/eventos/linea_tiempo/{linea_tiempo}/ventana?desde=250&hasta=500", 1, False),
+    "mapa_libro": ("GET", API + "/mapa/libro/{libro}", 1, False),
+    "localizaciones_mapa": ("GET", API + "/localizaciones/mapa/{mapa}", 1, False),
+    "localizaciones_vista": ("GET", API + "/localizaciones/mapa/{mapa}/vista?x_min=0&y_min=0&x_max=4096&y_max=4096", 1, False),
+    "notas_libro": ("GET", API + "/notas/libro/{libro}", 1, False),
+    "escaletas_libro": ("GET", API + "/escaletas/libro/{libro}", 1, False),
+    "secciones_escaleta": ("GET", API + "/secciones/escaleta/{escaleta}", 1, False),
+    "usuario": ("GET", API + "/usuarios/{usuario}", 1, False),
+    "estadisticas_usuario": ("GET", API + "/usuarios/estadisticas/{usuario}", 0.5, True),
+    "pdf_libro": ("GET", API + "/capitulos/libro/{libro}/pdf", 0.02, False),
+}
+
+SECRET_KEY_BENCHMARK = "benchmark-clave-secreta-no-usar-en-produccion"
+
+#Tamaño del lote de crear_personajes_lote (para compararlo con crear_personaje multiplicado por este número)
+PERSONAJES_POR_LOTE = 500
+
+
+def parsear_argumentos():
+    parser = argparse.ArgumentParser(description="Prueba de carga de escribdream con datos sintéticos")
+    parser.add_argument("--db", choices=["sqlite", "mysql"], default="sqlite")
+    parser.add_argument("--url", help="URL de la base de datos desechable (obligatoria con --db mysql)")
+    parser.add_argument("--usuarios", type=int, default=50)
+    parser.add_argument("--capitulos-por-libro", type=int, default=PERFIL["capitulos_por_libro"])
+    parser.add_argument("--concurrencia", type=int, default=16)
+    parser.add_argument("--peticiones", type=int, default=500, help="peticiones por escenario (se escalan con su peso)")
+    parser.add_argument("--escenarios", help="lista separada por comas; por defecto todos")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--puerto", type=int, default=0, help="0 = uno libre")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--sin-sembrar", action="store_true", help="reutilizar los datos ya sembrados con la misma semilla y tamaño")
+    parser.add_argument("--salida", help="fichero JSON de resultados; por defecto se imprime")
+    return parser.parse_args()
+
+
+def puerto_libre():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def commit_actual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+#Variables de entorno para el servidor: DATABASE_URL para el pool asíncrono y DB_* para mysql.connector.
+#Los límites de peticiones se desactivan salvo que se pida lo contrario (la prueba lanza todo con pocos usuarios)
+#y los correos se envían con el transporte falso
+def entorno_servidor(url):
+    entorno = {**os.environ, "DATABASE_URL": url, "SECRET_KEY": SECRET_KEY_BENCHMARK, "CONSULTAS_LENTAS_MS": "100000"}
+    entorno.setdefault("LIMITES_ACTIVOS", "0")
+    entorno.setdefault("CORREO_TRANSPORTE", "falso")
+    if url.startswith("mysql"):
+        partes = httpx.URL(url.replace("mysql://", "http://", 1))
+        entorno.update({
+            "DB_HOST": partes.host, "DB_PORT": str(partes.port or 3306), "DB_USER": partes.username,
+            "DB_PASSWORD": partes.password or "", "DB_NAME": partes.path.lstrip("/"),
+        })
+    return entorno
+
+
+async def esperar_servidor(base, proceso, limite=60):
+    fin = time.monotonic() + limite
+    async with httpx.AsyncClient(base_url=base) as cliente:
+        while time.monotonic() < fin:
+            if proceso.poll() is not None:
+                raise RuntimeError("El servidor ha terminado al arrancar")
+            try:
+                await cliente.get("/openapi.json")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError("El servidor no ha arrancado a tiempo")
+
+
+#Mismo formato que create_access_token de endpoint_login_register
+def token_usuario(id_usuario):
+    payload = {"exp": datetime.now(timezone.utc) + timedelta(hours=2), "sub": str(id_usuario)}
+    return jwt.encode(payload, SECRET_KEY_BENCHMARK, algorithm="HS256")
+
+
+def percentil(ordenados, fraccion):
+    if not ordenados:
+        return None
+    indice = min(len(ordenados) - 1, max(0, round(fraccion * len(ordenados)) - 1))
+    return ordenados[indice]
+
+
+def resumir(latencias, errores, estados, consultas, duracion):
+    ordenadas = sorted(latencias)
+    total = len(latencias) + errores
+    return {
+        "peticiones": total,
+        "errores": errores,
+        "estados": {str(estado): veces for estado, veces in sorted(estados.items(), key=lambda elemento: str(elemento[0]))},
+        "rps": round(len(latencias) / duracion, 2) if duracion > 0 else None,
+        "p50_ms": round(percentil(ordenadas, 0.50) * 1000, 3) if ordenadas else None,
+        "p95_ms": round(percentil(ordenadas, 0.95) * 1000, 3) if ordenadas else None,
+        "p99_ms": round(percentil(ordenadas, 0.99) * 1000, 3) if ordenadas else None,
+        "max_ms": round(ordenadas[-1] * 1000, 3) if ordenadas else None,
+        "consultas_por_peticion": round(sum(consultas) / len(consultas), 2) if consultas else None,
+    }
+
+
+def preparar_peticion(nombre, datos, rng):
+    metodo, ruta, _, _ = ESCENARIOS[nombre]
+    id_usuario = rng.choice(list(datos.por_usuario))
+    recursos = datos.por_usuario[id_usuario]
+    if nombre == "login":
+        return id_usuario, metodo, ruta, {"data": {"username": correo_usuario(id_usuario), "password": CLAVE_USUARIOS}}
+    if nombre == "login_google":
+        #Mitad cuentas existentes, mitad primeros inicios de sesión
+        correo = correo_usuario(id_usuario) if rng.random() < 0.5 else f"nuevo{rng.randrange(10 ** 9)}@google.benchmark"
+        return id_usuario, metodo, ruta, {"json": {"name": "Usuario Google", "email": correo, "picture": None}}
+    valores = {"usuario": id_usuario}
+    for tipo in ("proyecto", "libro", "capitulo", "personaje", "linea_tiempo", "mapa", "escaleta"):
+        if "{" + tipo + "}" in ruta:
+            valores[tipo] = rng.choice(recursos[tipo])
+    opciones = {}
+    if nombre == "autoguardado_capitulo":
+        texto = " ".join(rng.choice(("palabra", "frase", "escena", "diálogo")) for _ in range(2000))
+        opciones["json"] = {"contenido_capitulo": json.dumps({"ops": [{"insert": texto + "\n"}]})}
+    if nombre in ("crear_personaje", "crear_personajes_lote"):
+        id_proyecto = rng.choice(recursos["proyecto"])
+        personajes = [
+            {"id_proyecto": id_proyecto, "nombre_personaje": f"Personaje {indice}", "descripcion_personaje": "Creado en la prueba de carga",
+             "genero": "otro", "rol_personaje": "secundario", "estado_vital": "vivo", "imagen_personaje": None}
+            for indice in range(PERSONAJES_POR_LOTE if nombre == "crear_personajes_lote" else 1)
+        ]
+        opciones["json"] = personajes if nombre == "crear_personajes_lote" else personajes[0]
+    return id_usuario, metodo, ruta.format(**valores), opciones
+
+
+async def lanzar_escenario(cliente, nombre, datos, tokens, peticiones, concurrencia, semilla):
+    rng = random.Random(f"{semilla}-{nombre}")
+    cola = [preparar_peticion(nombre, datos, rng) for _ in range(peticiones)]
+    latencias, consultas, estados = [], [], {}
+    errores = 0
+
+    async def cliente_virtual():
+        nonlocal errores
+        while cola:
+            id_usuario, metodo, ruta, opciones = cola.pop()
+            cabeceras = {} if nombre in ("login", "login_google") else {"Authorization": f"Bearer {tokens[id_usuario]}"}
+            inicio = time.perf_counter()
+            try:
+                respuesta = await cliente.request(metodo, ruta, headers=cabeceras, **opciones)
+            except httpx.HTTPError:
+                errores += 1
+                estados["transporte"] = estados.get("transporte", 0) + 1
+                continue
+            duracion = time.perf_counter() - inicio
+            estados[respuesta.status_code] = estados.get(respuesta.status_code, 0) + 1
+            if respuesta.status_code >= 400:
+                errores += 1
+                continue
+            latencias.append(duracion)
+            if "x-db-queries" in respuesta.headers:
+                consultas.append(int(respuesta.headers["x-db-queries"]))
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(cliente_virtual() for _ in range(concurrencia)))
+    return resumir(latencias, errores, estados, consultas, time.perf_counter() - inicio)
+
+
+async def main():
+    args = parsear_argumentos()
+    if args.db == "mysql" and not args.url:
+        sys.exit("Con --db mysql hay que indicar --url de una base de datos desechable")
+    fichero_sqlite = None
+    if args.db == "sqlite":
+        fichero_sqlite = os.path.join(tempfile.gettempdir(), f"escribdream_bench_{args.usuarios}_{args.semilla}.db")
+        url = f"sqlite:///{fichero_sqlite}"
+    else:
+        url = args.url
+
+    seleccion = args.escenarios.split(",") if args.escenarios else list(ESCENARIOS)
+    desconocidos = [nombre for nombre in seleccion if nombre not in ESCENARIOS]
+    if desconocidos:
+        sys.exit(f"Escenarios desconocidos: {', '.join(desconocidos)}")
+
+    perfil = {"capitulos_por_libro": args.capitulos_por_libro}
+    database = Database(url)
+    await database.connect()
+    inicio = time.perf_counter()
+    if not args.sin_sembrar:
+        await crear_esquema(database, args.db)
+    #Con --sin-sembrar se regenera la estructura de ids sin insertar (la semilla la hace determinista)
+    datos = await sembrar(database if not args.sin_sembrar else _SinEscritura(), args.usuarios, args.semilla, perfil)
+    tiempo_siembra = time.perf_counter() - inicio
+    await database.disconnect()
+    print(f"Datos listos en {tiempo_siembra:.1f} s: {datos.resumen()}", file=sys.stderr)
+
+    puerto = args.puerto or puerto_libre()
+    base = f"http://127.0.0.1:{puerto}"
+    proceso = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(puerto),
+         "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"],
+        cwd=RAIZ, env=entorno_servidor(url),
+    )
+    resultados = {}
+    try:
+        await esperar_servidor(base, proceso)
+        tokens = {id_usuario: token_usuario(id_usuario) for id_usuario in datos.por_usuario}
+        limites = httpx.Limits(max_connections=args.concurrencia, max_keepalive_connections=args.concurrencia)
+        async with httpx.AsyncClient(base_url=base, limits=limites, timeout=120) as cliente:
+            for nombre in seleccion:
+                _, _, peso, solo_mysql = ESCENARIOS[nombre]
+                if solo_mysql and args.db != "mysql":
+                    resultados[nombre] = {"omitido": "usa mysql.connector, solo se ejecuta con --db mysql"}
+                    continue
+                peticiones = max(1, int(args.peticiones * peso))
+                #Calentamiento: cachés de pydantic, mapas de acceso, pool de conexiones...
+                await lanzar_escenario(cliente, nombre, datos, tokens, min(peticiones, 20), args.concurrencia, args.semilla + 1)
+                resultados[nombre] = await lanzar_escenario(cliente, nombre, datos, tokens, peticiones, args.concurrencia, args.semilla)
+                print(f"{nombre:24} {json.dumps(resultados[nombre], ensure_ascii=False)}", file=sys.stderr)
+    finally:
+        proceso.terminate()
+        try:
+            proceso.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proceso.kill()
+
+    informe = {
+        "commit": commit_actual(),
+        "fecha": datetime.now(timezone.utc).isoformat(),
+        "backend": args.db,
+        "python": sys.version.split()[0],
+        "usuarios": args.usuarios,
+        "datos": datos.resumen(),
+        "concurrencia": args.concurrencia,
+        "workers": args.workers,
+        "semilla": args.semilla,
+        "escenarios": resultados,
+    }
+    salida = json.dumps(informe, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as fichero:
+            fichero.write(salida + "\n")
+    else:
+        print(salida)
+
+
+#Sustituto de la base de datos para --sin-sembrar: sembrar() genera los mismos ids sin escribir nada
+class _SinEscritura:
+    async def execute_many(self, query, values):
+        pass
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+import argparse
+import json
+import sys
+
+
+#Compara dos resultados de benchmarks/carga.py (antes y después) escenario a escenario.
+#Sale con código 1 si algún escenario empeora más del umbral en p95 o en rps, para usarlo en CI:
+#  python benchmarks/comparar.py base.json nuevo.json --umbral 10
+METRICAS_MENOS_ES_MEJOR = ("p50_ms", "p95_ms", "p99_ms", "consultas_por_peticion")
+METRICAS_MAS_ES_MEJOR = ("rps",)
+METRICAS_VIGILADAS = ("p95_ms", "rps", "consultas_por_peticion")
+
+
+def variacion(antes, despues):
+    if antes in (None, 0) or despues is None:
+        return None
+    return (despues - antes) / antes * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Comparar dos resultados de la prueba de carga")
+    parser.add_argument("base")
+    parser.add_argument("nuevo")
+    parser.add_argument("--umbral", type=float, default=10.0, help="porcentaje de empeoramiento tolerado")
+    args = parser.parse_args()
+
+    with open(args.base, encoding="utf-8") as fichero:
+        base = json.load(fichero)
+    with open(args.nuevo, encoding="utf-8") as fichero:
+        nuevo = json.load(fichero)
+
+    for clave in ("backend", "usuarios", "concurrencia", "workers"):
+        if base.get(clave) != nuevo.get(clave):
+            print(f"Aviso: {clave} distinto ({base.get(clave)} / {nuevo.get(clave)}), la comparación puede no ser justa")
+
+    print(f"{base.get('commit')} -> {nuevo.get('commit')}")
+    print(f"{'escenario':24} {'métrica':24} {'antes':>10} {'después':>10} {'cambio':>9}")
+    regresiones = []
+    for nombre, antes in base["escenarios"].items():
+        despues = nuevo["escenarios"].get(nombre)
+        if despues is None or "omitido" in antes or "omitido" in despues:
+            continue
+        if despues.get("errores", 0) > antes.get("errores", 0):
+            regresiones.append(f"{nombre}: errores {antes.get('errores', 0)} -> {despues['errores']}")
+        for metrica in METRICAS_MENOS_ES_MEJOR + METRICAS_MAS_ES_MEJOR:
+            cambio = variacion(antes.get(metrica), despues.get(metrica))
+            if cambio is None:
+                continue
+            empeora = cambio if metrica in METRICAS_MENOS_ES_MEJOR else -cambio
+            marca = ""
+            if metrica in METRICAS_VIGILADAS and empeora > args.umbral:
+                marca = "  <-- regresión"
+                regresiones.append(f"{nombre}: {metrica} {antes[metrica]} -> {despues[metrica]} ({cambio:+.1f} %)")
+            print(f"{nombre:24} {metrica:24} {antes[metrica]:>10} {despues[metrica]:>10} {cambio:>+8.1f}%{marca}")
+
+    if regresiones:
+        print(f"\n{len(regresiones)} regresiones por encima del {args.umbral} %:")
+        for regresion in regresiones:
+            print(f"  {regresion}")
+        return 1
+    print("\nSin regresiones")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,400 @@
+import json
+import random
+from datetime import datetime, timedelta
+from passlib.context import CryptContext
+
+
+#Esquema mínimo de escribdream y datos sintéticos para los benchmarks.
+#El DDL se escribe una vez con {PK} y se adapta al dialecto (MySQL o SQLite)
+PK = {
+    "mysql": "INT AUTO_INCREMENT PRIMARY KEY",
+    "sqlite": "INTEGER PRIMARY KEY AUTOINCREMENT",
+}
+
+ESQUEMA = [
+    """CREATE TABLE usuarios (
+        id_usuario {PK},
+        nombre_usuario VARCHAR(255) NOT NULL,
+        primer_apellido VARCHAR(255),
+        segundo_apellido VARCHAR(255),
+        seudonimo VARCHAR(255),
+        correo_electronico VARCHAR(255) NOT NULL,
+        clave_acceso VARCHAR(255),
+        fecha_registro DATETIME DEFAULT CURRENT_TIMESTAMP,
+        nombre_completo VARCHAR(255),
+        fecha_nacimiento DATE,
+        biografia TEXT,
+        imagen_perfil VARCHAR(255),
+        proyectos_iniciados INT DEFAULT 0,
+        proyectos_finalizados INT DEFAULT 0,
+        ultima_conexion DATETIME,
+        eliminado_en DATETIME
+    )""",
+    """CREATE TABLE proyectos (
+        id_proyecto {PK},
+        id_usuario INT NOT NULL,
+        nombre_proyecto VARCHAR(255) NOT NULL,
+        tipo_proyecto VARCHAR(255),
+        descripcion_proyecto TEXT,
+        estado_proyecto VARCHAR(50) DEFAULT 'en_progreso',
+        libros_asociados INT DEFAULT 0,
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_modificacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_finalizacion DATETIME,
+        etiquetas_proyecto VARCHAR(255),
+        imagen_portada VARCHAR(255),
+        eliminado_en DATETIME
+    )""",
+    """CREATE TABLE libros (
+        id_libro {PK},
+        id_proyecto INT NOT NULL,
+        titulo_libro VARCHAR(255) NOT NULL,
+        genero_libro VARCHAR(50),
+        descripcion_libro TEXT,
+        imagen_portada VARCHAR(255),
+        estado_libro VARCHAR(50) DEFAULT 'borrador',
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_modificacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_finalizacion DATETIME,
+        eliminado_en DATETIME
+    )""",
+    """CREATE TABLE capitulos (
+        id_capitulo {PK},
+        id_libro INT NOT NULL,
+        numero_capitulo INT NOT NULL,
+        titulo_capitulo VARCHAR(255) NOT NULL,
+        contenido_capitulo LONGTEXT,
+        estado_capitulo VARCHAR(50) DEFAULT 'Primer borrador',
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_modificacion DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE personajes (
+        id_personaje {PK},
+        id_proyecto INT NOT NULL,
+        nombre_personaje VARCHAR(255) NOT NULL,
+        descripcion_personaje TEXT,
+        genero VARCHAR(50),
+        rol_personaje VARCHAR(50),
+        estado_vital VARCHAR(50),
+        imagen_personaje VARCHAR(255),
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_modificacion DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE personajes_libros (
+        id_personaje INT NOT NULL,
+        id_libro INT NOT NULL
+    )""",
+    """CREATE TABLE lineas_de_tiempo (
+        id_linea_tiempo {PK},
+        id_proyecto INT NOT NULL,
+        nombre_linea_tiempo VARCHAR(255) NOT NULL,
+        descripcion_lineatiempo TEXT,
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_modificacion DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE eventos (
+        id_evento {PK},
+        id_linea_tiempo INT NOT NULL,
+        nombre_evento VARCHAR(255) NOT NULL,
+        descripcion_evento TEXT,
+        posicion_inicio DOUBLE NOT NULL DEFAULT 0,
+        posicion_fin DOUBLE,
+        orden DOUBLE NOT NULL DEFAULT 0,
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_modificacion DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE mapas (
+        id_mapa {PK},
+        id_libro INT NOT NULL,
+        nombre_mapa VARCHAR(255) NOT NULL,
+        descripcion_mapa TEXT,
+        detalles_mapa TEXT,
+        imagen_mapa VARCHAR(255),
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_modificacion DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE localizaciones (
+        id_localizacion {PK},
+        id_mapa INT NOT NULL,
+        nombre_localizacion VARCHAR(255) NOT NULL,
+        ciudad VARCHAR(255),
+        provincia VARCHAR(255),
+        pais VARCHAR(255),
+        descripcion_localizacion TEXT,
+        tipo_terreno VARCHAR(50),
+        clima VARCHAR(50),
+        poblacion VARCHAR(50),
+        flora_fauna TEXT,
+        caracteristicas_destacadas TEXT,
+        leyendas_historias TEXT,
+        coordenada_x DOUBLE,
+        coordenada_y DOUBLE,
+        poligono TEXT,
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_modificacion DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE notas (
+        id_nota {PK},
+        id_libro INT NOT NULL,
+        titulo_nota VARCHAR(255) NOT NULL,
+        contenido TEXT,
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_modificacion DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE escaletas (
+        id_escaleta {PK},
+        id_libro INT NOT NULL,
+        nombre_escaleta VARCHAR(255) NOT NULL,
+        descripcion_escaleta TEXT,
+        contenido_escaleta TEXT,
+        notas_escaleta TEXT,
+        estado_escaleta VARCHAR(50) DEFAULT 'borrador',
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_modificacion DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE secciones_escaleta (
+        id_seccion {PK},
+        id_escaleta INT NOT NULL,
+        nombre_seccion VARCHAR(255) NOT NULL,
+        descripcion_seccion TEXT,
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_modificacion DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""",
+    #migraciones/003_correos_pendientes.sql
+    """CREATE TABLE correos_pendientes (
+        id_correo {PK},
+        destinatario VARCHAR(255) NOT NULL,
+        asunto VARCHAR(255) NOT NULL,
+        cuerpo TEXT,
+        estado VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+        intentos INT NOT NULL DEFAULT 0,
+        siguiente_intento DATETIME NOT NULL,
+        bloqueo VARCHAR(36),
+        ultimo_error TEXT,
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_envio DATETIME
+    )""",
+]
+
+#Índices por clave ajena, como los tendría la base de datos real (InnoDB los crea con las FOREIGN KEY)
+INDICES = [
+    ("proyectos", "id_usuario"),
+    ("libros", "id_proyecto"),
+    ("capitulos", "id_libro"),
+    ("personajes", "id_proyecto"),
+    ("lineas_de_tiempo", "id_proyecto"),
+    #migraciones/006_eventos_cronologia.sql
+    ("eventos", "id_linea_tiempo, posicion_inicio, orden"),
+    ("mapas", "id_libro"),
+    ("localizaciones", "id_mapa"),
+    ("notas", "id_libro"),
+    ("escaletas", "id_libro"),
+    ("secciones_escaleta", "id_escaleta"),
+    ("correos_pendientes", "estado, siguiente_intento"),
+    ("usuarios", "seudonimo"),
+]
+
+TABLAS = [
+    "secciones_escaleta", "escaletas", "notas", "localizaciones", "mapas", "eventos", "lineas_de_tiempo",
+    "personajes_libros", "personajes", "capitulos", "libros", "proyectos", "usuarios", "correos_pendientes",
+]
+
+#Cuántas filas hijas tiene cada fila padre. --usuarios y --capitulos-por-libro escalan el conjunto
+PERFIL = {
+    "proyectos_por_usuario": 2,
+    "libros_por_proyecto": 2,
+    "capitulos_por_libro": 20,
+    "palabras_por_capitulo": 1500,
+    "personajes_por_proyecto": 15,
+    "lineas_por_proyecto": 2,
+    "eventos_por_linea": 20,
+    "mapas_por_libro": 1,
+    "localizaciones_por_mapa": 20,
+    "notas_por_libro": 10,
+    "escaletas_por_libro": 1,
+    "secciones_por_escaleta": 10,
+}
+
+CLAVE_USUARIOS = "benchmark"
+
+PALABRAS = (
+    "el la los las un una de del en y que a por con para sobre bajo entre camino bosque castillo noche "
+    "luz sombra espada río montaña ciudad reina rey viaje memoria silencio tormenta fuego mar puerta"
+).split()
+
+LOTE_INSERCION = 500
+
+
+def correo_usuario(indice):
+    return f"usuario{indice}@benchmark.escribdream"
+
+
+def _delta(rng, palabras):
+    texto = " ".join(rng.choice(PALABRAS) for _ in range(palabras))
+    return json.dumps({"ops": [{"insert": texto + "\n"}]})
+
+
+class ConjuntoDatos:
+    def __init__(self):
+        #id_usuario -> {"proyectos": [...], "libros": [...], ...} para elegir recursos del propio usuario
+        self.por_usuario = {}
+
+    def apuntar(self, id_usuario, tipo, id_recurso):
+        self.por_usuario.setdefault(id_usuario, {}).setdefault(tipo, []).append(id_recurso)
+
+    def resumen(self):
+        totales = {}
+        for recursos in self.por_usuario.values():
+            for tipo, ids in recursos.items():
+                totales[tipo] = totales.get(tipo, 0) + len(ids)
+        totales["usuarios"] = len(self.por_usuario)
+        return totales
+
+
+async def crear_esquema(database, dialecto):
+    for tabla in TABLAS:
+        await database.execute(f"DROP TABLE IF EXISTS {tabla}")
+    for ddl in ESQUEMA:
+        await database.execute(ddl.format(PK=PK[dialecto]))
+    for tabla, columna in INDICES:
+        await database.execute(f"CREATE INDEX idx_{tabla}_{columna.replace(', ', '_')} ON {tabla} ({columna})")
+    #migraciones/001_personajes_libros_indice.sql
+    await database.execute("CREATE UNIQUE INDEX idx_personajes_libros_libro_personaje ON personajes_libros (id_libro, id_personaje)")
+    #migraciones/004_usuarios_correo_unico.sql
+    await database.execute("CREATE UNIQUE INDEX idx_usuarios_correo_electronico ON usuarios (correo_electronico)")
+
+
+async def _insertar(database, tabla, filas):
+    if not filas:
+        return
+    columnas = list(filas[0])
+    query = f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES ({', '.join(':' + columna for columna in columnas)})"
+    for inicio in range(0, len(filas), LOTE_INSERCION):
+        await database.execute_many(query, filas[inicio:inicio + LOTE_INSERCION])
+
+
+#Generar e insertar el conjunto de datos. Los ids se asignan aquí para saber a qué usuario pertenece cada recurso
+#sin volver a consultar; la misma semilla produce siempre los mismos datos
+async def sembrar(database, usuarios, semilla=1, perfil=None):
+    perfil = {**PERFIL, **(perfil or {})}
+    rng = random.Random(semilla)
+    datos = ConjuntoDatos()
+    #bcrypt es lento a propósito: se calcula un único hash y se comparte
+    clave_hash = CryptContext(schemes=["bcrypt"], deprecated="auto").hash(CLAVE_USUARIOS)
+    fecha_base = datetime(2024, 1, 1)
+    contadores = {}
+
+    def siguiente(tipo):
+        contadores[tipo] = contadores.get(tipo, 0) + 1
+        return contadores[tipo]
+
+    def fecha():
+        return fecha_base + timedelta(minutes=rng.randrange(0, 60 * 24 * 365))
+
+    filas = {tabla: [] for tabla in TABLAS}
+    for _ in range(usuarios):
+        id_usuario = siguiente("usuario")
+        filas["usuarios"].append({
+            "id_usuario": id_usuario,
+            "nombre_usuario": f"Usuario {id_usuario}",
+            "seudonimo": f"autor{id_usuario}",
+            "correo_electronico": correo_usuario(id_usuario),
+            "clave_acceso": clave_hash,
+        })
+        datos.por_usuario[id_usuario] = {}
+
+        for _ in range(perfil["proyectos_por_usuario"]):
+            id_proyecto = siguiente("proyecto")
+            datos.apuntar(id_usuario, "proyecto", id_proyecto)
+            filas["proyectos"].append({
+                "id_proyecto": id_proyecto, "id_usuario": id_usuario, "nombre_proyecto": f"Proyecto {id_proyecto}",
+                "tipo_proyecto": "novela", "descripcion_proyecto": "Proyecto sintético", "fecha_creacion": fecha(),
+            })
+
+            personajes = []
+            for _ in range(perfil["personajes_por_proyecto"]):
+                id_personaje = siguiente("personaje")
+                personajes.append(id_personaje)
+                datos.apuntar(id_usuario, "personaje", id_personaje)
+                filas["personajes"].append({
+                    "id_personaje": id_personaje, "id_proyecto": id_proyecto, "nombre_personaje": f"Personaje {id_personaje}",
+                    "descripcion_personaje": " ".join(rng.choice(PALABRAS) for _ in range(40)),
+                    "genero": rng.choice(["masculino", "femenino", "no_binario", "otro"]),
+                    "rol_personaje": rng.choice(["protagonista", "antagonista", "secundario"]),
+                    "estado_vital": rng.choice(["vivo", "muerto", "desconocido"]), "fecha_creacion": fecha(),
+                })
+
+            for _ in range(perfil["lineas_por_proyecto"]):
+                id_linea = siguiente("linea_tiempo")
+                datos.apuntar(id_usuario, "linea_tiempo", id_linea)
+                filas["lineas_de_tiempo"].append({
+                    "id_linea_tiempo": id_linea, "id_proyecto": id_proyecto,
+                    "nombre_linea_tiempo": f"Línea {id_linea}", "descripcion_lineatiempo": "Cronología sintética",
+                })
+                for _ in range(perfil["eventos_por_linea"]):
+                    id_evento = siguiente("evento")
+                    datos.apuntar(id_usuario, "evento", id_evento)
+                    filas["eventos"].append({
+                        "id_evento": id_evento, "id_linea_tiempo": id_linea, "nombre_evento": f"Evento {id_evento}",
+                        "descripcion_evento": " ".join(rng.choice(PALABRAS) for _ in range(30)), "fecha_creacion": fecha(),
+                        "posicion_inicio": float(rng.randrange(0, 1000)), "orden": 1024.0 * id_evento,
+                    })
+
+            for _ in range(perfil["libros_por_proyecto"]):
+                id_libro = siguiente("libro")
+                datos.apuntar(id_usuario, "libro", id_libro)
+                filas["libros"].append({
+                    "id_libro": id_libro, "id_proyecto": id_proyecto, "titulo_libro": f"Libro {id_libro}",
+                    "genero_libro": rng.choice(["fantasia", "ciencia_ficcion", "misterio", "aventura"]), "fecha_creacion": fecha(),
+                })
+                for id_personaje in rng.sample(personajes, len(personajes) // 2):
+                    filas["personajes_libros"].append({"id_personaje": id_personaje, "id_libro": id_libro})
+
+                for numero in range(1, perfil["capitulos_por_libro"] + 1):
+                    id_capitulo = siguiente("capitulo")
+                    datos.apuntar(id_usuario, "capitulo", id_capitulo)
+                    filas["capitulos"].append({
+                        "id_capitulo": id_capitulo, "id_libro": id_libro, "numero_capitulo": numero,
+                        "titulo_capitulo": f"Capítulo {numero}", "contenido_capitulo": _delta(rng, perfil["palabras_por_capitulo"]),
+                        "fecha_creacion": fecha(),
+                    })
+
+                for _ in range(perfil["mapas_por_libro"]):
+                    id_mapa = siguiente("mapa")
+                    datos.apuntar(id_usuario, "mapa", id_mapa)
+                    filas["mapas"].append({"id_mapa": id_mapa, "id_libro": id_libro, "nombre_mapa": f"Mapa {id_mapa}"})
+                    for _ in range(perfil["localizaciones_por_mapa"]):
+                        id_localizacion = siguiente("localizacion")
+                        datos.apuntar(id_usuario, "localizacion", id_localizacion)
+                        filas["localizaciones"].append({
+                            "id_localizacion": id_localizacion, "id_mapa": id_mapa,
+                            "nombre_localizacion": f"Lugar {id_localizacion}", "pais": "Reino sintético",
+                            "descripcion_localizacion": " ".join(rng.choice(PALABRAS) for _ in range(30)),
+                            "coordenada_x": rng.uniform(0, 8192), "coordenada_y": rng.uniform(0, 8192),
+                        })
+
+                for _ in range(perfil["notas_por_libro"]):
+                    id_nota = siguiente("nota")
+                    datos.apuntar(id_usuario, "nota", id_nota)
+                    filas["notas"].append({
+                        "id_nota": id_nota, "id_libro": id_libro, "titulo_nota": f"Nota {id_nota}",
+                        "contenido": " ".join(rng.choice(PALABRAS) for _ in range(60)),
+                    })
+
+                for _ in range(perfil["escaletas_por_libro"]):
+                    id_escaleta = siguiente("escaleta")
+                    datos.apuntar(id_usuario, "escaleta", id_escaleta)
+                    filas["escaletas"].append({
+                        "id_escaleta": id_escaleta, "id_libro": id_libro, "nombre_escaleta": f"Escaleta {id_escaleta}",
+                        "contenido_escaleta": "Estructura sintética",
+                    })
+                    for _ in range(perfil["secciones_por_escaleta"]):
+                        id_seccion = siguiente("seccion")
+                        datos.apuntar(id_usuario, "seccion", id_seccion)
+                        filas["secciones_escaleta"].append({
+                            "id_seccion": id_seccion, "id_escaleta": id_escaleta, "nombre_seccion": f"Sección {id_seccion}",
+                        })
+
+    for tabla in reversed(TABLAS):
+        await _insertar(database, tabla, filas[tabla])
+    return datos
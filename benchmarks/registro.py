@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+from databases import Database
+from passlib.context import CryptContext
+from datos_sinteticos import CLAVE_USUARIOS, correo_usuario, crear_esquema
+from carga import RAIZ, commit_actual, entorno_servidor, esperar_servidor, puerto_libre, resumir
+
+
+#Coste del registro según el número de usuarios. Antes el registro cargaba la tabla usuarios entera para ver si
+#el correo existía; ahora lo resuelve el índice único en el INSERT y /register/disponible hace una sonda por índice,
+#así que las latencias deberían ser las mismas con mil usuarios que con un millón.
+#La tabla usuarios se va llenando hasta cada tamaño de --tamanos y en cada uno se miden:
+#  disponible_<n>: GET /register/disponible con un correo y un seudónimo existentes
+#  registro_<n>: POST /register con correos nuevos (la mayor parte del tiempo es bcrypt)
+#  registro_duplicado_<n>: POST /register con correos existentes (se espera 400)
+#Antes de medir cada escenario se lanzan --calentamiento peticiones que no cuentan: recién cargada la tabla, las
+#páginas del índice todavía no están en la caché de la base de datos ni en la del sistema, y sin calentar el tamaño
+#mayor mediría esa primera lectura y no el coste de la sonda.
+#El JSON tiene el mismo formato que el de carga.py (benchmarks/comparar.py) y además el crecimiento del p50 entre
+#el tamaño menor y el mayor. Con --maximo-crecimiento falla (código 1) si alguno crece más de ese factor:
+#  python benchmarks/registro.py --tamanos 1000,100000,1000000 --maximo-crecimiento 2
+TAMANOS_POR_DEFECTO = "1000,100000,1000000"
+FILAS_POR_INSERT = 500
+
+
+def parsear_argumentos():
+    parser = argparse.ArgumentParser(description="Coste del registro de usuarios según el tamaño de la tabla usuarios")
+    parser.add_argument("--db", choices=["sqlite", "mysql"], default="sqlite")
+    parser.add_argument("--url", help="URL de la base de datos desechable (obligatoria con --db mysql)")
+    parser.add_argument("--tamanos", default=TAMANOS_POR_DEFECTO, help="números de usuarios separados por comas")
+    parser.add_argument("--peticiones", type=int, default=200, help="peticiones por escenario y tamaño")
+    parser.add_argument("--calentamiento", type=int, default=200, help="peticiones sin medir antes de cada escenario")
+    parser.add_argument("--concurrencia", type=int, default=8)
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--puerto", type=int, default=0, help="0 = uno libre")
+    parser.add_argument("--maximo-crecimiento", type=float, default=None)
+    parser.add_argument("--salida", help="fichero JSON de resultados; por defecto se imprime")
+    return parser.parse_args()
+
+
+#Añadir los usuarios sintéticos desde..hasta-1 con INSERT de varias filas. El índice da el correo y el seudónimo
+#(el id lo pone el autoincremento, que comparten con los usuarios que se registran). Todos tienen el mismo hash
+async def insertar_usuarios(database, desde, hasta, clave_hash):
+    for inicio in range(desde, hasta, FILAS_POR_INSERT):
+        marcadores = []
+        values = {"clave_acceso": clave_hash}
+        for indice in range(inicio, min(hasta, inicio + FILAS_POR_INSERT)):
+            marcadores.append(f"(:nombre_{indice}, :seudonimo_{indice}, :correo_{indice}, :clave_acceso)")
+            values.update({
+                f"nombre_{indice}": f"Usuario {indice}",
+                f"seudonimo_{indice}": f"autor{indice}",
+                f"correo_{indice}": correo_usuario(indice),
+            })
+        query = f"INSERT INTO usuarios (nombre_usuario, seudonimo, correo_electronico, clave_acceso) VALUES {', '.join(marcadores)}"
+        await database.execute(query, values)
+
+
+def peticiones_escenario(nombre, tamano, peticiones, rng):
+    lista = []
+    for indice in range(peticiones):
+        existente = rng.randrange(1, tamano + 1)
+        if nombre == "disponible":
+            lista.append(("GET", "/register/disponible", {"params": {"email": correo_usuario(existente), "seudonimo": f"autor{existente}"}}))
+        else:
+            correo = correo_usuario(existente) if nombre == "registro_duplicado" else f"nuevo{tamano}_{indice}@registro.benchmark"
+            lista.append(("POST", "/register", {"json": {"nombre": "Nuevo", "email": correo, "password": "registro-benchmark", "seudonimo": f"nuevo{indice}"}}))
+    return lista
+
+
+async def lanzar(cliente, lista, concurrencia, estado_esperado):
+    cola = list(lista)
+    latencias, consultas, estados = [], [], {}
+    errores = 0
+
+    async def cliente_virtual():
+        nonlocal errores
+        while cola:
+            metodo, ruta, opciones = cola.pop()
+            inicio = time.perf_counter()
+            try:
+                respuesta = await cliente.request(metodo, ruta, **opciones)
+            except httpx.HTTPError:
+                errores += 1
+                estados["transporte"] = estados.get("transporte", 0) + 1
+                continue
+            duracion = time.perf_counter() - inicio
+            estados[respuesta.status_code] = estados.get(respuesta.status_code, 0) + 1
+            if respuesta.status_code != estado_esperado:
+                errores += 1
+                continue
+            latencias.append(duracion)
+            if "x-db-queries" in respuesta.headers:
+                consultas.append(int(respuesta.headers["x-db-queries"]))
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(cliente_virtual() for _ in range(concurrencia)))
+    return resumir(latencias, errores, estados, consultas, time.perf_counter() - inicio)
+
+
+async def main():
+    args = parsear_argumentos()
+    if args.db == "mysql" and not args.url:
+        sys.exit("Con --db mysql hay que indicar --url de una base de datos desechable")
+    tamanos = sorted(int(tamano) for tamano in args.tamanos.split(","))
+    if args.db == "sqlite":
+        url = f"sqlite:///{os.path.join(tempfile.gettempdir(), 'escribdream_bench_registro.db')}"
+    else:
+        url = args.url
+
+    database = Database(url)
+    await database.connect()
+    await crear_esquema(database, args.db)
+    clave_hash = CryptContext(schemes=["bcrypt"], deprecated="auto").hash(CLAVE_USUARIOS)
+
+    puerto = args.puerto or puerto_libre()
+    base = f"http://127.0.0.1:{puerto}"
+    proceso = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(puerto),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=RAIZ, env=entorno_servidor(url),
+    )
+    rng = random.Random(args.semilla)
+    resultados = {}
+    usuarios = 0
+    try:
+        await esperar_servidor(base, proceso)
+        limites = httpx.Limits(max_connections=args.concurrencia, max_keepalive_connections=args.concurrencia)
+        async with httpx.AsyncClient(base_url=base, limits=limites, timeout=120) as cliente:
+            for tamano in tamanos:
+                inicio = time.perf_counter()
+                await insertar_usuarios(database, usuarios + 1, tamano + 1, clave_hash)
+                usuarios = tamano
+                print(f"{tamano} usuarios listos en {time.perf_counter() - inicio:.1f} s", file=sys.stderr)
+                for nombre, estado_esperado in (("disponible", 200), ("registro", 200), ("registro_duplicado", 400)):
+                    lista = peticiones_escenario(nombre, tamano, args.calentamiento + args.peticiones, rng)
+                    #Calentamiento con las primeras peticiones (no se repiten: los registros nuevos solo valen una vez)
+                    await lanzar(cliente, lista[:args.calentamiento], args.concurrencia, estado_esperado)
+                    clave = f"{nombre}_{tamano}"
+                    resultados[clave] = await lanzar(cliente, lista[args.calentamiento:], args.concurrencia, estado_esperado)
+                    print(f"{clave:32} {json.dumps(resultados[clave], ensure_ascii=False)}", file=sys.stderr)
+    finally:
+        proceso.terminate()
+        try:
+            proceso.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proceso.kill()
+        await database.disconnect()
+
+    crecimiento = {}
+    for nombre in ("disponible", "registro", "registro_duplicado"):
+        menor = resultados[f"{nombre}_{tamanos[0]}"]["p50_ms"]
+        mayor = resultados[f"{nombre}_{tamanos[-1]}"]["p50_ms"]
+        crecimiento[nombre] = round(mayor / menor, 2) if menor and mayor else None
+
+    informe = {
+        "commit": commit_actual(),
+        "fecha": datetime.now(timezone.utc).isoformat(),
+        "backend": args.db,
+        "python": sys.version.split()[0],
+        "usuarios": tamanos[-1],
+        "tamanos": tamanos,
+        "concurrencia": args.concurrencia,
+        "workers": 1,
+        "semilla": args.semilla,
+        "calentamiento": args.calentamiento,
+        "escenarios": resultados,
+        "crecimiento_p50": crecimiento,
+    }
+    salida = json.dumps(informe, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as fichero:
+            fichero.write(salida + "\n")
+    else:
+        print(salida)
+
+    fallos = [
+        f"{nombre}: el p50 crece x{factor} de {tamanos[0]} a {tamanos[-1]} usuarios (máximo x{args.maximo_crecimiento})"
+        for nombre, factor in crecimiento.items()
+        if args.maximo_crecimiento is not None and factor is not None and factor > args.maximo_crecimiento
+    ]
+    for fallo in fallos:
+        print(fallo, file=sys.stderr)
+    return 1 if fallos else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
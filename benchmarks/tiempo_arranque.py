@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+#Tiempo de importación de la aplicación (lo que tarda en arrancar cada worker y cada recarga con --reload).
+#Importa main N veces en procesos nuevos con python -X importtime y guarda la mediana y el p95 del total y
+#los módulos que más tardan. El JSON tiene el mismo formato que el de carga.py, así que sirve para CI:
+#  python benchmarks/tiempo_arranque.py --salida base.json
+#  python benchmarks/tiempo_arranque.py --salida nuevo.json --maximo-ms 1500
+#  python benchmarks/comparar.py base.json nuevo.json --umbral 15
+#Módulos que se cargan bajo demanda y no deberían aparecer al importar main
+DIFERIDOS = ("googleapiclient", "google_auth_oauthlib", "pdfkit", "requests", "passlib", "mysql.connector")
+
+
+def medir_importacion(modulo):
+    entorno = dict(os.environ)
+    entorno.setdefault("SECRET_KEY", "tiempo-arranque-clave-secreta-no-usar-en-produccion")
+    resultado = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {modulo}"],
+        cwd=RAIZ, env=entorno, capture_output=True, text=True
+    )
+    if resultado.returncode != 0:
+        raise RuntimeError(f"No se pudo importar {modulo}:\n{resultado.stderr[-2000:]}")
+
+    #Formato: "import time: self [us] | cumulative | imported package", con sangría según la profundidad
+    modulos = {}
+    total = 0
+    for linea in resultado.stderr.splitlines():
+        if not linea.startswith("import time:") or "cumulative" in linea:
+            continue
+        _, acumulado, nombre = [parte.strip() for parte in linea[len("import time:"):].split("|")]
+        modulos[nombre] = int(acumulado)
+        if nombre == modulo:
+            total = int(acumulado)
+    return total, modulos
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def commit_actual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Medir el tiempo de importación de la aplicación")
+    parser.add_argument("--modulo", default="main")
+    parser.add_argument("--repeticiones", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15, help="módulos más lentos que se listan")
+    parser.add_argument("--maximo-ms", type=float, default=None, help="falla (código 1) si la mediana lo supera")
+    parser.add_argument("--salida", default=None)
+    args = parser.parse_args()
+
+    #La primera importación compila los .pyc y no cuenta
+    medir_importacion(args.modulo)
+    totales = []
+    acumulados = {}
+    for _ in range(args.repeticiones):
+        total, modulos = medir_importacion(args.modulo)
+        totales.append(total / 1000)
+        for nombre, microsegundos in modulos.items():
+            acumulados.setdefault(nombre, []).append(microsegundos / 1000)
+
+    mas_lentos = sorted(((nombre, statistics.median(tiempos)) for nombre, tiempos in acumulados.items()
+                         if nombre != args.modulo), key=lambda par: par[1], reverse=True)[:args.top]
+    cargados = [nombre for nombre in DIFERIDOS if nombre in acumulados]
+
+    resultado = {
+        "commit": commit_actual(),
+        "fecha": datetime.now(timezone.utc).isoformat(),
+        "backend": "importtime",
+        "python": sys.version.split()[0],
+        "escenarios": {
+            f"importar_{args.modulo}": {
+                "peticiones": args.repeticiones,
+                "p50_ms": round(statistics.median(totales), 1),
+                "p95_ms": round(percentil(totales, 95), 1),
+                "max_ms": round(max(totales), 1),
+            }
+        },
+        "modulos_mas_lentos_ms": {nombre: round(tiempo, 1) for nombre, tiempo in mas_lentos},
+        "diferidos_cargados": cargados,
+    }
+    print(json.dumps(resultado, indent=2, ensure_ascii=False))
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as fichero:
+            json.dump(resultado, fichero, indent=2, ensure_ascii=False)
+
+    fallos = []
+    if cargados:
+        fallos.append(f"Se importan al arrancar módulos que deberían cargarse bajo demanda: {', '.join(cargados)}")
+    mediana = resultado["escenarios"][f"importar_{args.modulo}"]["p50_ms"]
+    if args.maximo_ms is not None and mediana > args.maximo_ms:
+        fallos.append(f"La importación tarda {mediana} ms (máximo {args.maximo_ms} ms)")
+    for fallo in fallos:
+        print(fallo, file=sys.stderr)
+    return 1 if fallos else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
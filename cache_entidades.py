@@ -0,0 +1,211 @@
+import asyncio
+import json
+import os
+from cachetools import TTLCache
+from fastapi.encoders import jsonable_encoder
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:
+    redis_asyncio = None
+
+
+#Caché de lecturas de entidades por clave primaria (libros, proyectos, personajes, capítulos...).
+#Tiene dos niveles: un LRU en memoria del proceso y, opcionalmente, un nivel compartido en Redis
+#(o cualquier servidor compatible) para que los workers compartan las entradas y las invalidaciones.
+#Cada entrada lleva etiquetas (proyecto, libro, usuario...) para poder invalidar en cascada.
+#Con varios workers hay que configurar ENTIDADES_CACHE_REDIS_URL: las invalidaciones se publican por Redis
+#y cada worker limpia su nivel local. Sin Redis cada worker solo ve sus propias invalidaciones,
+#por eso el TTL local por defecto es corto
+ENTIDADES_CACHE_SIZE = int(os.getenv("ENTIDADES_CACHE_SIZE", "5000"))
+ENTIDADES_CACHE_TTL = int(os.getenv("ENTIDADES_CACHE_TTL", "30"))
+ENTIDADES_CACHE_REDIS_URL = os.getenv("ENTIDADES_CACHE_REDIS_URL")
+
+CANAL_INVALIDACION = "escribdream:cache:invalidar"
+
+
+def _clave(tipo, id_entidad):
+    return f"{tipo}:{id_entidad}"
+
+
+#TTLCache que avisa de cada clave que sale de la caché (caducada, desalojada por tamaño o borrada) para que
+#CacheEntidades la quite también de sus etiquetas
+class _CacheLocal(TTLCache):
+    def __init__(self, maxsize, ttl, al_quitar):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.al_quitar = al_quitar
+
+    def expire(self, time=None):
+        caducadas = super().expire(time)
+        for clave, _ in caducadas:
+            self.al_quitar(clave)
+        return caducadas
+
+    def popitem(self):
+        clave, valor = super().popitem()
+        self.al_quitar(clave)
+        return clave, valor
+
+    def __delitem__(self, clave):
+        try:
+            super().__delitem__(clave)
+        finally:
+            self.al_quitar(clave)
+
+
+class CacheEntidades:
+    def __init__(self, maxsize=ENTIDADES_CACHE_SIZE, ttl=ENTIDADES_CACHE_TTL, redis_url=ENTIDADES_CACHE_REDIS_URL):
+        self.ttl = ttl
+        self.local = _CacheLocal(maxsize=maxsize, ttl=ttl, al_quitar=self._quitar_etiquetas)
+        #etiqueta -> claves que dependen de ella, solo para el nivel local. claves_etiquetas es el índice inverso:
+        #cuando una clave sale de la caché se quita de sus etiquetas y las que quedan vacías se borran, así que
+        #ninguno de los dos crece más que la propia caché
+        self.etiquetas = {}
+        self.claves_etiquetas = {}
+        self.compartido = None
+        if redis_url and redis_asyncio is not None:
+            self.compartido = redis_asyncio.from_url(redis_url)
+        self._suscripcion = None
+        #Se incrementa con cada invalidación: una lectura de la base de datos que empezó antes
+        #de una invalidación no se guarda, así no se cachea un valor que ya estaba obsoleto
+        self.generacion = 0
+        self.stats = {"hits_local": 0, "hits_compartido": 0, "misses": 0, "invalidaciones": 0}
+
+    async def get(self, tipo, id_entidad):
+        clave = _clave(tipo, id_entidad)
+        valor = self.local.get(clave)
+        if valor is not None:
+            self.stats["hits_local"] += 1
+            return valor
+
+        if self.compartido is not None:
+            try:
+                datos = await self.compartido.get(f"escribdream:{clave}")
+            except Exception:
+                datos = None
+            if datos is not None:
+                self.stats["hits_compartido"] += 1
+                valor = json.loads(datos)
+                self.local[clave] = valor
+                return valor
+
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, tipo, id_entidad, valor, etiquetas=(), generacion=None):
+        clave = _clave(tipo, id_entidad)
+        valor = jsonable_encoder(valor)
+        if generacion is not None and generacion != self.generacion:
+            return valor
+        self.local[clave] = valor
+        for etiqueta in etiquetas:
+            self.etiquetas.setdefault(_clave(*etiqueta), set()).add(clave)
+            self.claves_etiquetas.setdefault(clave, set()).add(_clave(*etiqueta))
+
+        if self.compartido is not None:
+            try:
+                async with self.compartido.pipeline(transaction=False) as pipe:
+                    pipe.set(f"escribdream:{clave}", json.dumps(valor), ex=self.ttl)
+                    for etiqueta in etiquetas:
+                        clave_etiqueta = f"escribdream:etiqueta:{_clave(*etiqueta)}"
+                        pipe.sadd(clave_etiqueta, clave)
+                        pipe.expire(clave_etiqueta, self.ttl)
+                    await pipe.execute()
+            except Exception:
+                pass
+        return valor
+
+    def _quitar_etiquetas(self, clave):
+        for etiqueta in self.claves_etiquetas.pop(clave, ()):
+            claves = self.etiquetas.get(etiqueta)
+            if claves is not None:
+                claves.discard(clave)
+                if not claves:
+                    del self.etiquetas[etiqueta]
+
+    def _borrar_local(self, claves):
+        for clave in claves:
+            self.local.pop(clave, None)
+
+    async def _publicar(self, claves):
+        try:
+            async with self.compartido.pipeline(transaction=False) as pipe:
+                pipe.delete(*[f"escribdream:{clave}" for clave in claves])
+                pipe.publish(CANAL_INVALIDACION, json.dumps(claves))
+                await pipe.execute()
+        except Exception:
+            pass
+
+    #Invalidar una entidad concreta (tras un PUT o DELETE)
+    async def invalidar(self, tipo, id_entidad):
+        clave = _clave(tipo, id_entidad)
+        self.generacion += 1
+        self.stats["invalidaciones"] += 1
+        self._borrar_local([clave])
+        if self.compartido is not None:
+            await self._publicar([clave])
+
+    #Invalidar varias entidades del mismo tipo con una sola publicación (operaciones por lotes)
+    async def invalidar_varios(self, tipo, ids):
+        claves = [_clave(tipo, id_entidad) for id_entidad in ids]
+        if not claves:
+            return
+        self.generacion += 1
+        self.stats["invalidaciones"] += len(claves)
+        self._borrar_local(claves)
+        if self.compartido is not None:
+            await self._publicar(claves)
+
+    #Invalidar todas las entidades que cuelgan de un padre (por ejemplo todos los capítulos de un libro)
+    async def invalidar_etiqueta(self, tipo, id_entidad):
+        etiqueta = _clave(tipo, id_entidad)
+        claves = set(self.etiquetas.pop(etiqueta, set()))
+        self.generacion += 1
+        self.stats["invalidaciones"] += 1
+
+        if self.compartido is not None:
+            try:
+                clave_etiqueta = f"escribdream:etiqueta:{etiqueta}"
+                miembros = await self.compartido.smembers(clave_etiqueta)
+                await self.compartido.delete(clave_etiqueta)
+                claves.update(miembro.decode() if isinstance(miembro, bytes) else miembro for miembro in miembros)
+            except Exception:
+                pass
+
+        self._borrar_local(claves)
+        if self.compartido is not None and claves:
+            await self._publicar(sorted(claves))
+
+    #Escuchar las invalidaciones publicadas por otros workers para limpiar el nivel local
+    async def _escuchar_invalidaciones(self):
+        pubsub = self.compartido.pubsub()
+        await pubsub.subscribe(CANAL_INVALIDACION)
+        try:
+            async for mensaje in pubsub.listen():
+                if mensaje.get("type") == "message":
+                    self.generacion += 1
+                    self._borrar_local(json.loads(mensaje["data"]))
+        finally:
+            await pubsub.close()
+
+    async def iniciar(self):
+        if self.compartido is not None and self._suscripcion is None:
+            self._suscripcion = asyncio.create_task(self._escuchar_invalidaciones())
+
+    async def cerrar(self):
+        if self._suscripcion is not None:
+            self._suscripcion.cancel()
+            self._suscripcion = None
+        if self.compartido is not None:
+            await self.compartido.aclose()
+
+    def hit_ratio(self):
+        hits = self.stats["hits_local"] + self.stats["hits_compartido"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def estadisticas(self):
+        return {**self.stats, "entradas_local": len(self.local), "hit_ratio": self.hit_ratio()}
+
+
+cache_entidades = CacheEntidades()
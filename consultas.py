@@ -0,0 +1,143 @@
+import logging
+import os
+import re
+from contextvars import ContextVar
+from functools import lru_cache
+from time import perf_counter
+from trazas import span
+
+
+#Registro de las consultas SQL que pasan por db_config.database: huella normalizada, duración y filas.
+#Las consultas que superan CONSULTAS_LENTAS_MS van al log de consultas lentas, y cada petición devuelve
+#en la cabecera Server-Timing cuántas consultas ha hecho y cuánto tiempo ha pasado en la base de datos
+CONSULTAS_LENTAS_MS = float(os.getenv("CONSULTAS_LENTAS_MS", "200"))
+
+#Si una misma huella se repite más de estas veces en una petición se avisa en el log (patrón N+1)
+CONSULTAS_REPETIDAS_AVISO = int(os.getenv("CONSULTAS_REPETIDAS_AVISO", "10"))
+
+#Poner a 0 para no enviar las cabeceras Server-Timing / X-DB-Queries
+CONSULTAS_CABECERAS = os.getenv("CONSULTAS_CABECERAS", "1") == "1"
+
+logger = logging.getLogger("escribdream.consultas")
+logger_lentas = logging.getLogger("escribdream.consultas_lentas")
+
+#Sustituciones para obtener la huella de una consulta: los literales y parámetros se cambian por ?
+#y las listas de IN se colapsan, así las consultas que solo cambian en los valores comparten huella
+PATRONES_HUELLA = (
+    (re.compile(r"'(?:[^'\\]|\\.)*'"), "?"),
+    (re.compile(r'"(?:[^"\\]|\\.)*"'), "?"),
+    (re.compile(r"(?<![:\w]):\w+"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(...)"),
+    #INSERT de varias filas: VALUES (...), (...), ... comparte huella sea cual sea el tamaño del lote
+    (re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+"), "(...)"),
+    (re.compile(r"\s+"), " "),
+)
+
+
+@lru_cache(maxsize=2048)
+def huella(query):
+    texto = str(query)
+    for patron, sustituto in PATRONES_HUELLA:
+        texto = patron.sub(sustituto, texto)
+    return texto.strip()
+
+
+class EstadisticasPeticion:
+    __slots__ = ("consultas", "tiempo", "huellas")
+
+    def __init__(self):
+        self.consultas = 0
+        self.tiempo = 0.0
+        self.huellas = {}
+
+
+_peticion_actual = ContextVar("consultas_peticion", default=None)
+
+#Acumulados de todo el proceso: huella -> [veces, segundos, máximo, filas]
+estadisticas_huellas = {}
+totales = {"consultas": 0, "segundos": 0.0, "lentas": 0}
+
+
+def registrar_consulta(query, duracion, filas=None):
+    texto_huella = huella(query)
+
+    totales["consultas"] += 1
+    totales["segundos"] += duracion
+    acumulado = estadisticas_huellas.get(texto_huella)
+    if acumulado is None:
+        acumulado = estadisticas_huellas[texto_huella] = [0, 0.0, 0.0, 0]
+    acumulado[0] += 1
+    acumulado[1] += duracion
+    acumulado[2] = max(acumulado[2], duracion)
+    acumulado[3] += filas or 0
+
+    peticion = _peticion_actual.get()
+    if peticion is not None:
+        peticion.consultas += 1
+        peticion.tiempo += duracion
+        peticion.huellas[texto_huella] = peticion.huellas.get(texto_huella, 0) + 1
+
+    if duracion * 1000 >= CONSULTAS_LENTAS_MS:
+        totales["lentas"] += 1
+        logger_lentas.warning("%.1f ms filas=%s %s", duracion * 1000, "-" if filas is None else filas, texto_huella)
+
+
+#Medir una consulta: la registra al terminar (aunque falle) y la traza como span hijo de la petición.
+#Quien la usa puede rellenar medicion.filas antes de salir
+class MedicionConsulta:
+    def __init__(self, operacion, query):
+        self.operacion = operacion
+        self.query = query
+        self.filas = None
+
+    def __enter__(self):
+        self.span = span(f"mysql {self.operacion}", {"db.system": "mysql", "db.operation": self.operacion, "db.statement": huella(self.query)}, cliente=True)
+        self.span_actual = self.span.__enter__()
+        self.inicio = perf_counter()
+        return self
+
+    def __exit__(self, tipo, excepcion, traza):
+        registrar_consulta(self.query, perf_counter() - self.inicio, self.filas)
+        if self.span_actual is not None and self.filas is not None:
+            self.span_actual.set_attribute("db.rows", self.filas)
+        return self.span.__exit__(tipo, excepcion, traza)
+
+
+#Las consultas más costosas del proceso, para inspeccionarlas desde una consola o un endpoint de depuración
+def consultas_mas_costosas(limite=20):
+    ordenadas = sorted(estadisticas_huellas.items(), key=lambda elemento: elemento[1][1], reverse=True)
+    return [
+        {"huella": texto_huella, "veces": veces, "segundos": segundos, "maximo": maximo, "filas": filas}
+        for texto_huella, (veces, segundos, maximo, filas) in ordenadas[:limite]
+    ]
+
+
+#Middleware ASGI: abre la contabilidad de la petición y añade las cabeceras al empezar la respuesta
+class ConsultasMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        peticion = EstadisticasPeticion()
+        token = _peticion_actual.set(peticion)
+
+        def send_con_consultas(mensaje):
+            if CONSULTAS_CABECERAS and mensaje["type"] == "http.response.start":
+                cabeceras = list(mensaje.get("headers", []))
+                cabeceras.append((b"server-timing", f'db;dur={peticion.tiempo * 1000:.1f};desc="{peticion.consultas} consultas"'.encode()))
+                cabeceras.append((b"x-db-queries", str(peticion.consultas).encode()))
+                mensaje = {**mensaje, "headers": cabeceras}
+            return send(mensaje)
+
+        try:
+            await self.app(scope, receive, send_con_consultas)
+        finally:
+            _peticion_actual.reset(token)
+            for texto_huella, veces in peticion.huellas.items():
+                if veces > CONSULTAS_REPETIDAS_AVISO:
+                    logger.warning("%s %s: la misma consulta se ha ejecutado %d veces (posible N+1): %s", scope["method"], scope["path"], veces, texto_huella)
@@ -0,0 +1,271 @@
+import asyncio
+import base64
+import logging
+import os
+import random
+import sys
+import uuid
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+from db_config import database
+from trazas import span
+
+
+#Bandeja de salida de correos. encolar_correo() inserta el mensaje en correos_pendientes y despierta al worker;
+#la petición no espera a Gmail. El worker reclama los pendientes por lotes de CORREO_LOTE (marcándolos con un
+#bloqueo para que otro worker no los envíe a la vez), los envía con una sola petición batch y:
+#  - si se envían, los marca como enviados y borra el cuerpo (puede llevar una contraseña temporal)
+#  - si fallan, los reprograma con espera exponencial (CORREO_ESPERA_BASE * 2^intentos, con algo de azar)
+#    hasta CORREO_MAX_INTENTOS, y después los deja como fallidos (también sin cuerpo)
+#Si un proceso muere con un lote reclamado, el bloqueo caduca a los CORREO_BLOQUEO segundos y se reintenta.
+#Transportes: "gmail" (por defecto) o "falso", que guarda los mensajes en memoria, para pruebas y benchmarks
+CORREO_TRANSPORTE = os.getenv("CORREO_TRANSPORTE", "gmail")
+CORREO_LOTE = int(os.getenv("CORREO_LOTE", "50"))
+CORREO_MAX_INTENTOS = int(os.getenv("CORREO_MAX_INTENTOS", "8"))
+CORREO_ESPERA_BASE = float(os.getenv("CORREO_ESPERA_BASE", "30"))
+CORREO_ESPERA_MAXIMA = float(os.getenv("CORREO_ESPERA_MAXIMA", "3600"))
+CORREO_BLOQUEO = float(os.getenv("CORREO_BLOQUEO", "300"))
+CORREO_INTERVALO = float(os.getenv("CORREO_INTERVALO", "60"))
+
+ALCANCES_GMAIL = ['https://www.googleapis.com/auth/gmail.send']
+FICHERO_TOKEN = 'token.json'
+FICHERO_CREDENCIALES = 'credentials.json'
+
+logger = logging.getLogger("escribdream.correos")
+
+_despertar = None
+_tarea = None
+#Contadores para /metrics
+estadisticas = {"encolados": 0, "enviados": 0, "reintentos": 0, "fallidos": 0, "errores": 0}
+
+
+class TransporteGmail:
+    def __init__(self):
+        #Las credenciales y el cliente de la API se crean una vez y se reutilizan; las credenciales se
+        #refrescan cuando caducan
+        self.credenciales = None
+        self.servicio = None
+
+    def _credenciales_validas(self):
+        from google.oauth2.credentials import Credentials
+        from google.auth.transport.requests import Request
+        if self.credenciales is None:
+            if not os.path.exists(FICHERO_TOKEN):
+                raise RuntimeError("No hay token de Gmail: ejecuta 'python correos.py autorizar' para generarlo")
+            self.credenciales = Credentials.from_authorized_user_file(FICHERO_TOKEN, ALCANCES_GMAIL)
+        if not self.credenciales.valid:
+            if not (self.credenciales.expired and self.credenciales.refresh_token):
+                raise RuntimeError("El token de Gmail no es válido: ejecuta 'python correos.py autorizar' para renovarlo")
+            self.credenciales.refresh(Request())
+            with open(FICHERO_TOKEN, 'w') as token:
+                token.write(self.credenciales.to_json())
+        return self.credenciales
+
+    def _servicio(self):
+        credenciales = self._credenciales_validas()
+        if self.servicio is None:
+            from googleapiclient.discovery import build
+            self.servicio = build('gmail', 'v1', credentials=credenciales, cache_discovery=False)
+        return self.servicio
+
+    #Se ejecuta en un hilo. mensajes: lista de (id, mensaje MIME). Devuelve id -> error (None si se envió)
+    def enviar_lote(self, mensajes):
+        servicio = self._servicio()
+        resultados = {}
+
+        def callback(request_id, respuesta, excepcion):
+            resultados[int(request_id)] = str(excepcion) if excepcion is not None else None
+
+        lote = servicio.new_batch_http_request(callback=callback)
+        for id_correo, mensaje in mensajes:
+            cuerpo = {'raw': base64.urlsafe_b64encode(mensaje.as_bytes()).decode()}
+            lote.add(servicio.users().messages().send(userId='me', body=cuerpo), request_id=str(id_correo))
+        lote.execute()
+        return resultados
+
+
+class TransporteFalso:
+    def __init__(self):
+        self.enviados = []
+        #Ids que fallarán la próxima vez que se intenten enviar (para probar los reintentos)
+        self.fallar = set()
+
+    def enviar_lote(self, mensajes):
+        resultados = {}
+        for id_correo, mensaje in mensajes:
+            if id_correo in self.fallar:
+                self.fallar.discard(id_correo)
+                resultados[id_correo] = "Fallo simulado"
+            else:
+                self.enviados.append(mensaje)
+                resultados[id_correo] = None
+        return resultados
+
+
+TRANSPORTES = {"gmail": TransporteGmail, "falso": TransporteFalso}
+transporte = TRANSPORTES[CORREO_TRANSPORTE]()
+
+
+def _ahora():
+    return datetime.utcnow().replace(microsecond=0)
+
+
+def espera_reintento(intentos):
+    espera = min(CORREO_ESPERA_MAXIMA, CORREO_ESPERA_BASE * 2 ** (intentos - 1))
+    return espera * random.uniform(0.8, 1.2)
+
+
+async def encolar_correo(destinatario, asunto, cuerpo):
+    query = """
+        INSERT INTO correos_pendientes (destinatario, asunto, cuerpo, estado, intentos, siguiente_intento)
+        VALUES (:destinatario, :asunto, :cuerpo, 'pendiente', 0, :siguiente_intento)
+    """
+    values = {"destinatario": destinatario, "asunto": asunto, "cuerpo": cuerpo, "siguiente_intento": _ahora()}
+    id_correo = await database.execute(query=query, values=values)
+    estadisticas["encolados"] += 1
+    if _despertar is not None:
+        _despertar.set()
+    return id_correo
+
+
+#Reclamar un lote de pendientes cuyo intento ya toca. El UPDATE vuelve a comprobar las condiciones, así que
+#si otro worker reclamó antes alguna fila, esa no se lleva el bloqueo de este
+async def _reclamar():
+    ahora = _ahora()
+    candidatos = await database.fetch_all(
+        query=f"""SELECT id_correo FROM correos_pendientes
+            WHERE estado = 'pendiente' AND siguiente_intento <= :ahora ORDER BY siguiente_intento LIMIT {CORREO_LOTE}""",
+        values={"ahora": ahora}
+    )
+    if not candidatos:
+        return []
+    bloqueo = str(uuid.uuid4())
+    ids = ", ".join(str(int(fila["id_correo"])) for fila in candidatos)
+    await database.execute(
+        query=f"""UPDATE correos_pendientes SET bloqueo = :bloqueo, siguiente_intento = :caduca
+            WHERE id_correo IN ({ids}) AND estado = 'pendiente' AND siguiente_intento <= :ahora""",
+        values={"bloqueo": bloqueo, "caduca": ahora + timedelta(seconds=CORREO_BLOQUEO), "ahora": ahora}
+    )
+    return await database.fetch_all(
+        query="SELECT id_correo, destinatario, asunto, cuerpo, intentos FROM correos_pendientes WHERE bloqueo = :bloqueo",
+        values={"bloqueo": bloqueo}
+    )
+
+
+def _mensaje(fila):
+    mensaje = MIMEText(fila["cuerpo"] or "")
+    mensaje['to'] = fila["destinatario"]
+    mensaje['from'] = os.getenv("EMAIL")
+    mensaje['subject'] = fila["asunto"]
+    return mensaje
+
+
+async def _enviar(filas):
+    mensajes = [(fila["id_correo"], _mensaje(fila)) for fila in filas]
+    try:
+        with span("gmail batch users.messages.send", {"rpc.system": "google_api", "rpc.service": "gmail", "correos": len(mensajes)}, cliente=True):
+            resultados = await asyncio.to_thread(transporte.enviar_lote, mensajes)
+    except Exception as error:
+        logger.warning("No se pudo enviar el lote de correos: %s", error)
+        resultados = {fila["id_correo"]: str(error) or type(error).__name__ for fila in filas}
+
+    enviados = {fila["id_correo"] for fila in filas if fila["id_correo"] in resultados and resultados[fila["id_correo"]] is None}
+    if enviados:
+        await database.execute(
+            query=f"""UPDATE correos_pendientes SET estado = 'enviado', cuerpo = NULL, bloqueo = NULL, ultimo_error = NULL,
+                intentos = intentos + 1, fecha_envio = :ahora WHERE id_correo IN ({', '.join(str(int(id_correo)) for id_correo in sorted(enviados))})""",
+            values={"ahora": _ahora()}
+        )
+        estadisticas["enviados"] += len(enviados)
+
+    fallidos = [fila for fila in filas if fila["id_correo"] not in enviados]
+    if fallidos:
+        valores = []
+        for fila in fallidos:
+            intentos = fila["intentos"] + 1
+            definitivo = intentos >= CORREO_MAX_INTENTOS
+            valores.append({
+                "id_correo": fila["id_correo"],
+                "estado": "fallido" if definitivo else "pendiente",
+                "intentos": intentos,
+                "siguiente_intento": _ahora() + timedelta(seconds=espera_reintento(intentos)),
+                "ultimo_error": resultados.get(fila["id_correo"], "Sin respuesta del transporte"),
+            })
+            estadisticas["fallidos" if definitivo else "reintentos"] += 1
+        await database.execute_many(
+            query="""UPDATE correos_pendientes SET estado = :estado, intentos = :intentos, siguiente_intento = :siguiente_intento,
+                ultimo_error = :ultimo_error, bloqueo = NULL, cuerpo = CASE WHEN :estado = 'fallido' THEN NULL ELSE cuerpo END
+                WHERE id_correo = :id_correo""",
+            values=valores
+        )
+
+
+async def procesar_pendientes():
+    while True:
+        filas = await _reclamar()
+        if not filas:
+            return
+        await _enviar(filas)
+
+
+async def _segundos_hasta_siguiente():
+    siguiente = await database.fetch_val(query="SELECT MIN(siguiente_intento) FROM correos_pendientes WHERE estado = 'pendiente'")
+    if siguiente is None:
+        return CORREO_INTERVALO
+    if isinstance(siguiente, str):
+        siguiente = datetime.fromisoformat(siguiente)
+    return min(CORREO_INTERVALO, max(0.5, (siguiente - _ahora()).total_seconds()))
+
+
+#Bucle del worker: envía todo lo que toca y duerme hasta el siguiente reintento o hasta que lo despierten
+async def _worker():
+    while True:
+        _despertar.clear()
+        espera = CORREO_INTERVALO
+        try:
+            await procesar_pendientes()
+            espera = await _segundos_hasta_siguiente()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            estadisticas["errores"] += 1
+            logger.exception("Error en el envío de correos; se reintentará")
+        try:
+            await asyncio.wait_for(_despertar.wait(), timeout=espera)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def iniciar_correos():
+    global _despertar, _tarea
+    if _tarea is None:
+        _despertar = asyncio.Event()
+        _tarea = asyncio.create_task(_worker())
+
+
+async def cerrar_correos():
+    global _tarea
+    if _tarea is not None:
+        _tarea.cancel()
+        try:
+            await _tarea
+        except asyncio.CancelledError:
+            pass
+        _tarea = None
+
+
+#Autorización inicial de Gmail (abre el navegador). El servidor nunca lanza este flujo: solo usa y refresca
+#el token.json que se genera aquí
+def autorizar():
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    flow = InstalledAppFlow.from_client_secrets_file(FICHERO_CREDENCIALES, ALCANCES_GMAIL, redirect_uri='http://localhost/htdocs/frontend_escribdream_javascript_alpha/views/login.html')
+    credenciales = flow.run_local_server(port=0)
+    with open(FICHERO_TOKEN, 'w') as token:
+        token.write(credenciales.to_json())
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["autorizar"]:
+        autorizar()
+    else:
+        print("Uso: python correos.py autorizar")
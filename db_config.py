@@ -1,6 +1,7 @@
+import os
 from fastapi import FastAPI, Depends
 from databases import Database
-import mysql.connector
+from consultas import MedicionConsulta
 
 # Configuración de la conexión a la base de datos escribdream_prueba_5 en localhost
 # db_config = {
@@ -12,18 +13,72 @@ import mysql.connector
 #     'port': '3306'
 # }
 
+#Los valores se pueden cambiar con variables de entorno (por ejemplo para los benchmarks con una base de datos desechable)
 db_config = {
-    'host': '172.19.0.2',
-    'user': 'root',
-    'password': '',
-    'database': 'escribdream_mysql',
-    'port': '3000'
+    'host': os.getenv('DB_HOST', '172.19.0.2'),
+    'user': os.getenv('DB_USER', 'root'),
+    'password': os.getenv('DB_PASSWORD', ''),
+    'database': os.getenv('DB_NAME', 'escribdream_mysql'),
+    'port': os.getenv('DB_PORT', '3000')
 }
 
-DATABASE_URL = f"mysql://{db_config['user']}:{db_config['password']}@{db_config['host']}/{db_config['database']}"
-database = Database(DATABASE_URL)
+#DATABASE_URL tiene prioridad sobre db_config para el pool asíncrono (admite sqlite+aiosqlite:///...)
+DATABASE_URL = os.getenv("DATABASE_URL", f"mysql://{db_config['user']}:{db_config['password']}@{db_config['host']}/{db_config['database']}")
 
+
+#Database que mide y traza cada consulta (huella, duración y filas) con consultas.MedicionConsulta.
+#execute devuelve el último id insertado, no las filas afectadas, por eso en ese caso no hay número de filas
+class DatabaseMedida(Database):
+    async def fetch_all(self, query, values=None):
+        with MedicionConsulta("fetch_all", query) as medicion:
+            resultado = await super().fetch_all(query, values)
+            medicion.filas = len(resultado)
+            return resultado
+
+    async def fetch_one(self, query, values=None):
+        with MedicionConsulta("fetch_one", query) as medicion:
+            resultado = await super().fetch_one(query, values)
+            medicion.filas = 0 if resultado is None else 1
+            return resultado
+
+    async def fetch_val(self, query, values=None, column=0):
+        with MedicionConsulta("fetch_val", query) as medicion:
+            medicion.filas = 1
+            return await super().fetch_val(query, values, column=column)
+
+    async def execute(self, query, values=None):
+        with MedicionConsulta("execute", query):
+            return await super().execute(query, values)
+
+    async def execute_many(self, query, values):
+        with MedicionConsulta("execute_many", query) as medicion:
+            medicion.filas = len(values)
+            return await super().execute_many(query, values)
+
+    async def iterate(self, query, values=None):
+        with MedicionConsulta("iterate", query) as medicion:
+            medicion.filas = 0
+            async for fila in super().iterate(query, values):
+                medicion.filas += 1
+                yield fila
+
+
+database = DatabaseMedida(DATABASE_URL)
+
+
+#Indica si el error es una violación de un índice único (MySQL 1062 o UNIQUE de SQLite) que afecta a la columna.
+#MySQL nombra el índice (idx_<tabla>_<columna>) tras "for key" y SQLite nombra la columna
+def clave_duplicada(error, columna):
+    if type(error).__name__ != "IntegrityError":
+        return False
+    mensaje = str(error)
+    if error.args and error.args[0] == 1062:
+        return columna in mensaje.rsplit(" for key ", 1)[-1]
+    return mensaje.startswith("UNIQUE constraint failed") and columna in mensaje
+
+#mysql.connector solo lo usan las rutas antiguas síncronas: se importa al abrir la primera conexión
 def connectToDatabase():
+    import mysql.connector
     connection = mysql.connector.connect(
         host=db_config['host'],
         user=db_config['user'],
@@ -45,6 +100,13 @@ def getAllUsers(connection):
 
     return result
 
+#Estado del pool de conexiones asíncrono (para las métricas). None si todavía no está conectado
+def estado_pool():
+    pool = getattr(database._backend, "_pool", None)
+    if pool is None:
+        return None
+    return {"tamano": pool.size, "libres": pool.freesize, "maximo": pool.maxsize}
+
 # app nos permitirá definir los eventos de inicio y finalización de la aplicación
 app = FastAPI()
 
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import os
+from db_config import database
+from imagenes import eliminar_imagen
+
+
+#Eliminación diferida de usuarios, proyectos y libros.
+#El endpoint solo marca la fila con eliminado_en (una escritura pequeña) y despierta al worker.
+#Desde ese momento el recurso ya no aparece en los mapas de acceso ni en los listados.
+#El worker borra después los hijos por lotes de ELIMINACION_LOTE filas, cada lote en su propia sentencia,
+#así ningún DELETE mantiene bloqueos mucho tiempo ni choca con las claves ajenas, y al final borra la fila marcada.
+#También borra del disco las imágenes de las filas que elimina.
+#Las marcas quedan en la base de datos: si el proceso se reinicia a medias, el worker retoma lo pendiente al
+#arrancar y cada ELIMINACION_INTERVALO segundos. Si dos workers procesan el mismo árbol no pasa nada:
+#borrar filas o ficheros que ya no existen no tiene efecto
+ELIMINACION_LOTE = int(os.getenv("ELIMINACION_LOTE", "500"))
+
+#Pausa entre lotes para dejar paso a las peticiones normales
+ELIMINACION_PAUSA = float(os.getenv("ELIMINACION_PAUSA", "0.05"))
+
+ELIMINACION_INTERVALO = float(os.getenv("ELIMINACION_INTERVALO", "300"))
+
+logger = logging.getLogger("escribdream.eliminaciones")
+
+#Tipo -> (tabla, columna id, columna de imagen)
+RAICES = {
+    "usuario": ("usuarios", "id_usuario", "imagen_perfil"),
+    "proyecto": ("proyectos", "id_proyecto", "imagen_portada"),
+    "libro": ("libros", "id_libro", "imagen_portada"),
+}
+
+#Tipo -> hijos como (tabla, columna id, columna que apunta al padre, columna de imagen, tipo del hijo si tiene hijos).
+#Cada hijo se vacía antes de borrar su fila
+HIJOS = {
+    "usuario": [
+        ("proyectos", "id_proyecto", "id_usuario", "imagen_portada", "proyecto"),
+    ],
+    "proyecto": [
+        ("libros", "id_libro", "id_proyecto", "imagen_portada", "libro"),
+        ("lineas_de_tiempo", "id_linea_tiempo", "id_proyecto", None, "linea_tiempo"),
+        ("personajes", "id_personaje", "id_proyecto", "imagen_personaje", "personaje"),
+    ],
+    "libro": [
+        ("capitulos", "id_capitulo", "id_libro", None, None),
+        ("notas", "id_nota", "id_libro", None, None),
+        ("escaletas", "id_escaleta", "id_libro", None, "escaleta"),
+        ("mapas", "id_mapa", "id_libro", "imagen_mapa", "mapa"),
+        ("personajes_libros", "id_personaje", "id_libro", None, None),
+    ],
+    "personaje": [
+        ("personajes_libros", "id_libro", "id_personaje", None, None),
+    ],
+    "escaleta": [
+        ("secciones_escaleta", "id_seccion", "id_escaleta", None, None),
+    ],
+    "mapa": [
+        ("localizaciones", "id_localizacion", "id_mapa", None, None),
+    ],
+    "linea_tiempo": [
+        ("eventos", "id_evento", "id_linea_tiempo", None, None),
+    ],
+}
+
+_despertar = None
+_tarea = None
+#Contadores para /metrics
+estadisticas = {"pendientes": 0, "filas_eliminadas": 0, "imagenes_eliminadas": 0, "errores": 0}
+
+
+#Marcar un recurso como eliminado y avisar al worker. Devuelve False si no existía o ya estaba marcado
+async def marcar_eliminado(tipo, id_recurso):
+    tabla, columna_id, _ = RAICES[tipo]
+    marcado = await database.fetch_one(
+        query=f"SELECT {columna_id} FROM {tabla} WHERE {columna_id} = :id AND eliminado_en IS NULL",
+        values={"id": id_recurso}
+    )
+    if marcado is None:
+        return False
+    await database.execute(
+        query=f"UPDATE {tabla} SET eliminado_en = CURRENT_TIMESTAMP WHERE {columna_id} = :id AND eliminado_en IS NULL",
+        values={"id": id_recurso}
+    )
+    if _despertar is not None:
+        _despertar.set()
+    return True
+
+
+def _borrar_imagenes(nombres):
+    for nombre in nombres:
+        if nombre and eliminar_imagen(nombre):
+            estadisticas["imagenes_eliminadas"] += 1
+
+
+#Vaciar los hijos de un recurso lote a lote (en profundidad: los nietos de cada lote se borran antes que el lote)
+async def _eliminar_hijos(tipo, id_recurso):
+    for tabla, columna_id, columna_padre, columna_imagen, tipo_hijo in HIJOS.get(tipo, ()):
+        columnas = f"{columna_id}, {columna_imagen}" if columna_imagen else columna_id
+        while True:
+            filas = await database.fetch_all(
+                query=f"SELECT {columnas} FROM {tabla} WHERE {columna_padre} = :id LIMIT {ELIMINACION_LOTE}",
+                values={"id": id_recurso}
+            )
+            if not filas:
+                break
+            ids = [fila[columna_id] for fila in filas]
+            if tipo_hijo is not None:
+                for id_hijo in ids:
+                    await _eliminar_hijos(tipo_hijo, id_hijo)
+            await database.execute(
+                query=f"DELETE FROM {tabla} WHERE {columna_padre} = :id AND {columna_id} IN ({', '.join(str(int(id_fila)) for id_fila in ids)})",
+                values={"id": id_recurso}
+            )
+            estadisticas["filas_eliminadas"] += len(ids)
+            if columna_imagen:
+                _borrar_imagenes(fila[columna_imagen] for fila in filas)
+            await asyncio.sleep(ELIMINACION_PAUSA)
+
+
+async def eliminar_arbol(tipo, id_recurso):
+    tabla, columna_id, columna_imagen = RAICES[tipo]
+    raiz = await database.fetch_one(query=f"SELECT {columna_imagen} FROM {tabla} WHERE {columna_id} = :id", values={"id": id_recurso})
+    await _eliminar_hijos(tipo, id_recurso)
+    await database.execute(query=f"DELETE FROM {tabla} WHERE {columna_id} = :id", values={"id": id_recurso})
+    estadisticas["filas_eliminadas"] += 1
+    if raiz is not None:
+        _borrar_imagenes([raiz[columna_imagen]])
+
+
+async def _pendientes():
+    pendientes = []
+    for tipo, (tabla, columna_id, _) in RAICES.items():
+        filas = await database.fetch_all(query=f"SELECT {columna_id} FROM {tabla} WHERE eliminado_en IS NOT NULL ORDER BY eliminado_en")
+        pendientes.extend((tipo, fila[columna_id]) for fila in filas)
+    return pendientes
+
+
+#Bucle del worker: procesa todo lo marcado y espera a que lo despierten (o a que pase el intervalo)
+async def _worker():
+    while True:
+        _despertar.clear()
+        try:
+            pendientes = await _pendientes()
+            estadisticas["pendientes"] = len(pendientes)
+            for tipo, id_recurso in pendientes:
+                await eliminar_arbol(tipo, id_recurso)
+                estadisticas["pendientes"] -= 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            estadisticas["errores"] += 1
+            logger.exception("Error en la eliminación diferida; se reintentará")
+        try:
+            await asyncio.wait_for(_despertar.wait(), timeout=ELIMINACION_INTERVALO)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def iniciar_eliminaciones():
+    global _despertar, _tarea
+    if _tarea is None:
+        _despertar = asyncio.Event()
+        _tarea = asyncio.create_task(_worker())
+
+
+async def cerrar_eliminaciones():
+    global _tarea
+    if _tarea is not None:
+        _tarea.cancel()
+        try:
+            await _tarea
+        except asyncio.CancelledError:
+            pass
+        _tarea = None
@@ -1,22 +1,17 @@
-import base64
+import asyncio
 import json
 from fastapi import FastAPI, HTTPException, status, Depends, APIRouter, Query
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from typing import Optional
-from httplib2 import Credentials
 import jwt
-from passlib.context import CryptContext
 from datetime import datetime, timedelta
 import os
-from db_config import connectToDatabase, closeConnection, getAllUsers
+from db_config import connectToDatabase, closeConnection, getAllUsers, database, clave_duplicada
 from dotenv import load_dotenv
 from pydantic import BaseModel, EmailStr
 import smtplib
-from email.mime.text import MIMEText
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
+from seguridad import SECRET_KEY, ALGORITHM, oauth2_scheme, get_id_usuario_actual
+from correos import encolar_correo
 
 
 load_dotenv()
@@ -27,20 +22,27 @@ router = APIRouter(
 )
 
 
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
 SECRET_KEY2 = os.getenv("SECRET_KEY2")
 ALGORITHM2 = "RS256"
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-oauth2_scheme = OAuth2PasswordBearer("/token")
+#passlib y las librerías de Google se importan la primera vez que se usan: la mayoría de los workers no llegan
+#a enviar correos y así el arranque (y cada recarga con --reload) no paga su importación
+_pwd_context = None
+
+
+def get_pwd_context():
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        _pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return _pwd_context
 
 
 #Verificar contraseña con hash
 def verify_password(password, password_hash):
-    return pwd_context.verify(password, password_hash)
+    return get_pwd_context().verify(password, password_hash)
 
 
 #Obtener el usuario en caso de que este en la bbdd
@@ -72,6 +74,9 @@ def authenticate_user(username, password):
     user = get_user(username)
     if not user:
         return None 
+    #Cuenta marcada como eliminada, pendiente de que el worker de eliminaciones la borre
+    if user.get("eliminado_en") is not None:
+        return None
     if not verify_password(password, user['clave_acceso']):
         return None  
     return user
@@ -86,28 +91,6 @@ def create_access_token(data: str, expires_delta: timedelta):
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
 
-def decode_jwt(token: str) -> dict:
-    #Separar el token en sus tres partes (header, payload, signature)
-    base64_url = token.split('.')[1]
-
-    #Reemplazar '-' con '+' y '_' con '/'
-    base64_url = base64_url.replace('-', '+').replace('_', '/')
-
-    #Añadir padding si es necesario
-    padding = '=' * (4 - len(base64_url) % 4)
-    base64_url += padding
-
-    #Decodificar Base64
-    base64_bytes = base64.b64decode(base64_url)
-
-    #Convertir bytes a string
-    json_payload = base64_bytes.decode('utf-8')
-
-    #Convertir JSON a diccionario
-    return json.loads(json_payload)
-
-
-
 #------------------------------------------------------------------------------------------------------------
 
 #Ruta para el token cuando un usuario inicie sesion
@@ -130,58 +113,36 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     return {'ok':True, 'access_token': access_token, 'token_type': 'bearer'}
 
 #Ruta para desencriptar el token y devolver el id del usuario
+#La verificación se hace una sola vez en la dependencia get_id_usuario_actual, que cachea los tokens ya verificados
 @router.get("/token/data")
-async def read_users_me(token: str = Depends(oauth2_scheme)):
-    
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        id_usuario: str = payload.get("sub")
-        
-        #si falla usaremos la funcion decode_jwt
-        try:
-            payload = decode_jwt(token)
-            id_usuario = payload.get("sub")
-        except:
-            raise HTTPException(status_code=403, detail="Token google inválido")
-        
-        
-        if id_usuario is None:
-            raise HTTPException(status_code=403, detail="Se requiere autenticación")
-        return {"ok":True, "id_usuario": id_usuario}
-    
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=403, detail="Token expirado")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=403, detail="Token normal inválido")
+async def read_users_me(id_usuario: int = Depends(get_id_usuario_actual)):
+    return {"ok":True, "id_usuario": id_usuario}
 
 
 #Funcion para cifrar la contraseña
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 
 
-#Funcion para obtener el correo electrónico de un usuario de la base de datos
-def get_correo_electronico(email):
-    connection = connectToDatabase()
-    result = getAllUsers(connection)
-    closeConnection(connection)
+#Comprobar si un valor ya está en uso con una sonda por índice (correo_electronico es único y seudonimo tiene
+#índice, migraciones/004 y 005): el coste no depende del número de usuarios
+async def valor_en_uso(columna, valor):
+    fila = await database.fetch_one(query=f"SELECT 1 FROM usuarios WHERE {columna} = :valor LIMIT 1", values={"valor": valor})
+    return fila is not None
 
-    for user in result:
-        if user["correo_electronico"] == email:
-            return user["correo_electronico"]
-    return None
 
-#Funcion para verificar si un seudónimo ya está en uso
-def get_seudonimo(apodo):
-    connection = connectToDatabase()
-    result = getAllUsers(connection)
-    closeConnection(connection)
-
-    for user in result:
-        if user["seudonimo"] == apodo:
-            return user["seudonimo"]
-    return None
+#Ruta para que el formulario de registro compruebe el correo y el seudónimo mientras se escriben
+@router.get("/register/disponible")
+async def comprobar_disponibilidad(email: Optional[str] = None, seudonimo: Optional[str] = None):
+    if not email and not seudonimo:
+        raise HTTPException(status_code=400, detail="Indica un correo electrónico o un seudónimo.")
+    disponibles = {}
+    if email:
+        disponibles["email"] = not await valor_en_uso("correo_electronico", email)
+    if seudonimo:
+        disponibles["seudonimo"] = not await valor_en_uso("seudonimo", seudonimo)
+    return {"ok": True, "content": disponibles}
 
 #Ruta para registrar un usuario
 
@@ -198,38 +159,43 @@ class UserRegistration(BaseModel):
 @router.post("/register")
 async def register_user(user_data: UserRegistration):
     
-    nombre = user_data.nombre
-    primer_apellido = user_data.primer_apellido
-    segundo_apellido = user_data.segundo_apellido
-    email = user_data.email
-    password = user_data.password
-    seudonimo = user_data.seudonimo
-    fecha_nacimiento = user_data.fecha_nacimiento
+    #Cadena vacía = sin fecha ni seudónimo
+    fecha_nacimiento = user_data.fecha_nacimiento or None
+    seudonimo = user_data.seudonimo or None
     
     #Debemos comprobar que el formato de la fecha sea el adecuado, siempre que exista fecha
-    if fecha_nacimiento != '':
+    if fecha_nacimiento is not None:
         try:
             fecha_nacimiento = datetime.strptime(fecha_nacimiento, '%Y-%m-%d')
         except ValueError:
             raise HTTPException(status_code=400, detail="El formato de la fecha de nacimiento no es válido.")
     
-    #Debemos comprobar que el correo electrónico no exista ya en la base de datos
-    if get_correo_electronico(email) is not None:
-        raise HTTPException(status_code=400, detail="El correo electrónico ya está en uso.")
-    
-    #El seudónimo tampoco puede estar en uso
-    #if get_seudonimo(seudonimo) is not None:
-    #   raise HTTPException(status_code=400, detail="El seudónimo ya está en uso.")
+    #bcrypt es lento a propósito: se calcula en un hilo para no parar el bucle de eventos
+    clave_hash = await asyncio.to_thread(get_password_hash, user_data.password)
     
+    #El correo electrónico no se busca antes: el índice único de correo_electronico (migraciones/004) rechaza el
+    #duplicado en el propio INSERT, también si llegan dos registros del mismo correo a la vez
+    query = """
+        INSERT INTO usuarios (nombre_usuario, primer_apellido, segundo_apellido, seudonimo, correo_electronico, clave_acceso, fecha_nacimiento)
+        VALUES (:nombre_usuario, :primer_apellido, :segundo_apellido, :seudonimo, :correo_electronico, :clave_acceso, :fecha_nacimiento)
+    """
+    values = {
+        "nombre_usuario": user_data.nombre,
+        "primer_apellido": user_data.primer_apellido,
+        "segundo_apellido": user_data.segundo_apellido,
+        "seudonimo": seudonimo,
+        "correo_electronico": user_data.email,
+        "clave_acceso": clave_hash,
+        "fecha_nacimiento": fecha_nacimiento,
+    }
+    try:
+        await database.execute(query=query, values=values)
+    except Exception as error:
+        if clave_duplicada(error, "correo_electronico"):
+            raise HTTPException(status_code=400, detail="El correo electrónico ya está en uso.")
+        raise
     
-    connection = connectToDatabase()
-    cursor = connection.cursor(dictionary=True)
-    query = "INSERT INTO usuarios (nombre_usuario, primer_apellido, segundo_apellido, seudonimo, correo_electronico, clave_acceso, fecha_nacimiento) VALUES (%s, %s, %s, %s, %s, %s, %s)"
-    values = (nombre, primer_apellido, segundo_apellido, seudonimo, email, get_password_hash(password), fecha_nacimiento)
-
-    cursor.execute(query, values)
-    connection.commit()
-    closeConnection(connection)
+    #El seudónimo no tiene que ser único (la comprobación estaba desactivada); /register/disponible solo lo informa
     return {"message":"Usuario registrado con éxito."}
 
 
@@ -242,41 +208,36 @@ class GoogleUser(BaseModel):
 
 
 
+#Un solo INSERT sobre el índice único de correo_electronico (migraciones/004): si el correo ya existe no inserta
+#y LAST_INSERT_ID(id_usuario) hace que la sentencia devuelva el id de la cuenta existente. Sin SELECT previo
+#ni posterior y sin carreras si dos pestañas inician sesión a la vez.
+#SQLite (benchmarks) no tiene ON DUPLICATE KEY: usa ON CONFLICT ... RETURNING
+QUERY_UPSERT_GOOGLE_MYSQL = """
+    INSERT INTO usuarios (nombre_usuario, correo_electronico, imagen_perfil)
+    VALUES (:nombre_usuario, :correo_electronico, :imagen_perfil)
+    ON DUPLICATE KEY UPDATE id_usuario = LAST_INSERT_ID(id_usuario)
+"""
+QUERY_UPSERT_GOOGLE_SQLITE = """
+    INSERT INTO usuarios (nombre_usuario, correo_electronico, imagen_perfil)
+    VALUES (:nombre_usuario, :correo_electronico, :imagen_perfil)
+    ON CONFLICT (correo_electronico) DO UPDATE SET correo_electronico = excluded.correo_electronico
+    RETURNING id_usuario
+"""
+
+
 @router.post("/verification/account/google")
 async def register_google_user(user: GoogleUser):
-    email = user.email
-    
-    #Verificar si el usuario ya existe
-    connection = connectToDatabase()
-    cursor = connection.cursor(dictionary=True)
-    query = "SELECT * FROM usuarios WHERE correo_electronico = %s"
-    cursor.execute(query, (email,))
-    existing_user = cursor.fetchone()
-    
-    if existing_user:
-        closeConnection(connection)
-        #Crear token de acceso
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(data=existing_user['id_usuario'], expires_delta=access_token_expires)
-        return {"message": "Usuario autenticado con éxito.", "access_token": access_token, "token_type": "bearer"}    
-    #El usuario no eciste
-    query = """
-    INSERT INTO usuarios (nombre_usuario, correo_electronico, imagen_perfil) 
-    VALUES (%s, %s, %s)
-    """
-    cursor.execute(query, (user.name, email, user.picture))
-    connection.commit()
-    
-    cursor.execute("SELECT * FROM usuarios WHERE correo_electronico = %s", (email,))
-    new_user = cursor.fetchone()
-    
-    closeConnection(connection)
+    values = {"nombre_usuario": user.name, "correo_electronico": user.email, "imagen_perfil": user.picture}
+    if database.url.dialect == "sqlite":
+        id_usuario = await database.fetch_val(query=QUERY_UPSERT_GOOGLE_SQLITE, values=values)
+    else:
+        id_usuario = await database.execute(query=QUERY_UPSERT_GOOGLE_MYSQL, values=values)
     
     #Crear token de acceso
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(data=new_user['id_usuario'], expires_delta=access_token_expires)
+    access_token = create_access_token(data=id_usuario, expires_delta=access_token_expires)
     
-    return {"message": "Usuario registrado con éxito.", "access_token": access_token, "token_type": "bearer"} 
+    return {"message": "Usuario autenticado con éxito.", "access_token": access_token, "token_type": "bearer"} 
     
     
     
@@ -286,47 +247,14 @@ class EmailSchema(BaseModel):
     email: EmailStr
     temp_password: str
 
-# Cargar las credenciales de OAuth 2.0
-def load_credentials():
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', ['https://www.googleapis.com/auth/gmail.send'])
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', ['https://www.googleapis.com/auth/gmail.send'], redirect_uri='http://localhost/htdocs/frontend_escribdream_javascript_alpha/views/login.html')
-            creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-    return creds
-
-def send_email_via_gmail(email, temp_password):
-    creds = load_credentials()
-    service = build('gmail', 'v1', credentials=creds)
-    
-    message = MIMEText(f"Bienvenido a Escribdream. Su contraseña temporal es: --> {temp_password} <--. Asegúrese de cambiarla lo antes posible.")
-    message['to'] = email
-    message['from'] = os.getenv("EMAIL")
-    message['subject'] = "Contraseña temporal"
-    
-    raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-    body = {'raw': raw_message}
-    
-    try:
-        message = service.users().messages().send(userId='me', body=body).execute()
-        print(f'Message Id: {message["id"]}')
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error al enviar el correo: {str(e)}")
 
+#El correo se guarda en la bandeja de salida y lo envía el worker de correos.py (con reintentos si Gmail falla)
 @router.post("/send/email")
 async def send_email(email_data: EmailSchema):
     email = email_data.email
     temp_password = email_data.temp_password
 
-    try:
-        send_email_via_gmail(email, temp_password)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error al enviar el correo: {str(e)}")
+    cuerpo = f"Bienvenido a Escribdream. Su contraseña temporal es: --> {temp_password} <--. Asegúrese de cambiarla lo antes posible."
+    id_correo = await encolar_correo(email, "Contraseña temporal", cuerpo)
     
-    return {"message": "Correo enviado con éxito."}
\ No newline at end of file
+    return {"message": "Correo encolado para su envío.", "id_correo": id_correo}
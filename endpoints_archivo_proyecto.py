@@ -0,0 +1,422 @@
+import asyncio
+import base64
+import io
+import itertools
+import json
+import os
+import uuid
+import zipfile
+from enum import Enum
+from typing import Dict, Any
+from fastapi import APIRouter, Depends, File, HTTPException, Query, UploadFile
+from fastapi.responses import StreamingResponse
+from db_config import database
+from seguridad import oauth2_scheme, get_id_usuario_actual
+from permisos import verificar_acceso
+from imagenes import STORAGE_PATH, programar_variantes
+from lotes import FILAS_POR_INSERT, consulta_insert, insertar_filas
+
+
+#Exportación e importación de un proyecto completo en un solo archivo.
+#El archivo es una secuencia de líneas JSON (ndjson): una cabecera, las filas de cada tabla en orden de padres
+#a hijos ({"tabla": ..., "fila": {...}}) y las imágenes de user_storage en trozos en base64.
+#En formato zip las filas van en proyecto.ndjson y las imágenes como ficheros en imagenes/.
+#Las filas se leen de la base de datos por páginas y se envían según se generan, así que ni la exportación
+#ni la importación cargan el proyecto entero en memoria
+FORMATO_ARCHIVO = "escribdream-proyecto"
+VERSION_ARCHIVO = 1
+NOMBRE_DATOS = "proyecto.ndjson"
+CARPETA_IMAGENES = "imagenes/"
+
+EXPORTACION_PAGINA = int(os.getenv("EXPORTACION_PAGINA", "1000"))
+#Tamaño de los trozos de la respuesta y de las imágenes dentro del ndjson
+TROZO_BYTES = 256 * 1024
+
+FECHAS = ["fecha_creacion", "fecha_modificacion"]
+LIBROS_DEL_PROYECTO = "JOIN libros l ON t.id_libro = l.id_libro WHERE l.id_proyecto = :id_proyecto AND l.eliminado_en IS NULL"
+
+
+class TablaArchivo:
+    def __init__(self, tabla, ids, columnas, origen, referencias=None, imagen=None, por_defecto=None):
+        self.tabla = tabla
+        #Columnas que identifican la fila (y por las que se pagina). Si es una sola, es el autoincremento
+        self.ids = ids
+        self.columnas = columnas
+        #FROM ... WHERE que limita la tabla (alias t) al proyecto :id_proyecto
+        self.origen = origen
+        #Columna que apunta a otra tabla del archivo -> esa tabla. Se traducen a los ids nuevos al importar
+        self.referencias = referencias or {}
+        self.imagen = imagen
+        #Valor de las columnas que no traen los archivos exportados antes de que existieran
+        self.por_defecto = por_defecto or {}
+
+    @property
+    def autoincremento(self):
+        return self.ids[0] if len(self.ids) == 1 else None
+
+
+#Orden de padres a hijos: al importar cada fila encuentra ya traducidos los ids de los que depende.
+#Solo se aceptan estas tablas y columnas al importar
+TABLAS_ARCHIVO = [
+    TablaArchivo("proyectos", ("id_proyecto",),
+        ["nombre_proyecto", "tipo_proyecto", "descripcion_proyecto", "estado_proyecto", "libros_asociados", "fecha_finalizacion", "etiquetas_proyecto", "imagen_portada"] + FECHAS,
+        "proyectos t WHERE t.id_proyecto = :id_proyecto", imagen="imagen_portada"),
+    TablaArchivo("personajes", ("id_personaje",),
+        ["nombre_personaje", "descripcion_personaje", "genero", "rol_personaje", "estado_vital", "imagen_personaje"] + FECHAS,
+        "personajes t WHERE t.id_proyecto = :id_proyecto", {"id_proyecto": "proyectos"}, imagen="imagen_personaje"),
+    TablaArchivo("lineas_de_tiempo", ("id_linea_tiempo",),
+        ["nombre_linea_tiempo", "descripcion_lineatiempo"] + FECHAS,
+        "lineas_de_tiempo t WHERE t.id_proyecto = :id_proyecto", {"id_proyecto": "proyectos"}),
+    TablaArchivo("eventos", ("id_evento",),
+        ["nombre_evento", "descripcion_evento", "posicion_inicio", "posicion_fin", "orden"] + FECHAS,
+        "eventos t JOIN lineas_de_tiempo lt ON t.id_linea_tiempo = lt.id_linea_tiempo WHERE lt.id_proyecto = :id_proyecto", {"id_linea_tiempo": "lineas_de_tiempo"},
+        por_defecto={"posicion_inicio": 0, "orden": 0}),
+    TablaArchivo("libros", ("id_libro",),
+        ["titulo_libro", "genero_libro", "descripcion_libro", "imagen_portada", "estado_libro", "fecha_finalizacion"] + FECHAS,
+        "libros t WHERE t.id_proyecto = :id_proyecto AND t.eliminado_en IS NULL", {"id_proyecto": "proyectos"}, imagen="imagen_portada"),
+    TablaArchivo("personajes_libros", ("id_libro", "id_personaje"), [],
+        "personajes_libros t " + LIBROS_DEL_PROYECTO, {"id_libro": "libros", "id_personaje": "personajes"}),
+    TablaArchivo("capitulos", ("id_capitulo",),
+        ["numero_capitulo", "titulo_capitulo", "contenido_capitulo", "estado_capitulo"] + FECHAS,
+        "capitulos t " + LIBROS_DEL_PROYECTO, {"id_libro": "libros"}),
+    TablaArchivo("notas", ("id_nota",),
+        ["titulo_nota", "contenido"] + FECHAS,
+        "notas t " + LIBROS_DEL_PROYECTO, {"id_libro": "libros"}),
+    TablaArchivo("escaletas", ("id_escaleta",),
+        ["nombre_escaleta", "descripcion_escaleta", "contenido_escaleta", "notas_escaleta", "estado_escaleta"] + FECHAS,
+        "escaletas t " + LIBROS_DEL_PROYECTO, {"id_libro": "libros"}),
+    TablaArchivo("secciones_escaleta", ("id_seccion",),
+        ["nombre_seccion", "descripcion_seccion"] + FECHAS,
+        "secciones_escaleta t JOIN escaletas e ON t.id_escaleta = e.id_escaleta JOIN libros l ON e.id_libro = l.id_libro WHERE l.id_proyecto = :id_proyecto AND l.eliminado_en IS NULL",
+        {"id_escaleta": "escaletas"}),
+    TablaArchivo("mapas", ("id_mapa",),
+        ["nombre_mapa", "descripcion_mapa", "detalles_mapa", "imagen_mapa"] + FECHAS,
+        "mapas t " + LIBROS_DEL_PROYECTO, {"id_libro": "libros"}, imagen="imagen_mapa"),
+    TablaArchivo("localizaciones", ("id_localizacion",),
+        ["nombre_localizacion", "ciudad", "provincia", "pais", "descripcion_localizacion", "tipo_terreno", "clima", "poblacion",
+         "flora_fauna", "caracteristicas_destacadas", "leyendas_historias", "coordenada_x", "coordenada_y", "poligono"] + FECHAS,
+        "localizaciones t JOIN mapas m ON t.id_mapa = m.id_mapa JOIN libros l ON m.id_libro = l.id_libro WHERE l.id_proyecto = :id_proyecto AND l.eliminado_en IS NULL",
+        {"id_mapa": "mapas"}),
+]
+
+TABLAS_POR_NOMBRE = {definicion.tabla: definicion for definicion in TABLAS_ARCHIVO}
+
+
+class FormatoArchivo(str, Enum):
+    zip = "zip"
+    ndjson = "ndjson"
+
+
+router = APIRouter(
+    prefix="/api/escribdream",
+    tags=["archivo de proyecto"],
+    dependencies=[Depends(verificar_acceso)]
+)
+
+
+def _linea(objeto):
+    return (json.dumps(objeto, default=str, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+#Recorrer una tabla del proyecto por páginas ordenadas por sus ids (paginación por clave, sin OFFSET)
+async def _filas(definicion, id_proyecto):
+    columnas = list(definicion.ids) + [columna for columna in definicion.referencias if columna not in definicion.ids] + definicion.columnas
+    seleccion = ", ".join(f"t.{columna}" for columna in columnas)
+    orden = ", ".join(f"t.{columna}" for columna in definicion.ids)
+    ultimo = None
+    while True:
+        values = {"id_proyecto": id_proyecto}
+        condicion = ""
+        if ultimo is not None:
+            if len(definicion.ids) == 1:
+                condicion = f" AND t.{definicion.ids[0]} > :ultimo_0"
+            else:
+                primera, segunda = definicion.ids
+                condicion = f" AND (t.{primera} > :ultimo_0 OR (t.{primera} = :ultimo_0 AND t.{segunda} > :ultimo_1))"
+            values.update({f"ultimo_{indice}": valor for indice, valor in enumerate(ultimo)})
+        query = f"SELECT {seleccion} FROM {definicion.origen}{condicion} ORDER BY {orden} LIMIT {EXPORTACION_PAGINA}"
+        filas = await database.fetch_all(query=query, values=values)
+        for fila in filas:
+            yield dict(fila)
+        if len(filas) < EXPORTACION_PAGINA:
+            return
+        ultimo = [filas[-1][columna] for columna in definicion.ids]
+
+
+#Líneas de datos del archivo. Va apuntando en imagenes los ficheros que referencian las filas
+async def _lineas_datos(id_proyecto, imagenes):
+    yield _linea({"formato": FORMATO_ARCHIVO, "version": VERSION_ARCHIVO})
+    for definicion in TABLAS_ARCHIVO:
+        async for fila in _filas(definicion, id_proyecto):
+            if definicion.imagen and fila.get(definicion.imagen):
+                imagenes.add(os.path.basename(fila[definicion.imagen]))
+            yield _linea({"tabla": definicion.tabla, "fila": fila})
+
+
+#Las lecturas del disco van en un hilo, como en la importación, para no parar el worker con imágenes grandes
+async def _trozos_imagen(nombre):
+    ruta = os.path.join(STORAGE_PATH, nombre)
+    if not await asyncio.to_thread(os.path.isfile, ruta):
+        return
+    fichero = await asyncio.to_thread(open, ruta, "rb")
+    try:
+        while True:
+            trozo = await asyncio.to_thread(fichero.read, TROZO_BYTES)
+            if not trozo:
+                return
+            yield trozo
+    finally:
+        fichero.close()
+
+
+async def _exportar_ndjson(id_proyecto):
+    imagenes = set()
+    pendiente = bytearray()
+    async for linea in _lineas_datos(id_proyecto, imagenes):
+        pendiente += linea
+        if len(pendiente) >= TROZO_BYTES:
+            yield bytes(pendiente)
+            pendiente.clear()
+    if pendiente:
+        yield bytes(pendiente)
+    for nombre in sorted(imagenes):
+        async for trozo in _trozos_imagen(nombre):
+            yield _linea({"imagen": nombre, "datos": base64.b64encode(trozo).decode("ascii")})
+
+
+#Destino de zipfile que no se puede rebobinar: zipfile escribe entonces descriptores de datos tras cada fichero
+#y todo lo escrito se puede ir enviando según llega
+class _SalidaZip(io.RawIOBase):
+    def __init__(self):
+        self.pendiente = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        self.pendiente += datos
+        return len(datos)
+
+    def vaciar(self):
+        datos = bytes(self.pendiente)
+        self.pendiente.clear()
+        return datos
+
+
+#La compresión se hace en un hilo: las líneas se juntan en trozos de TROZO_BYTES y cada trozo se comprime
+#de una vez, para no parar el worker con DEFLATE durante toda la descarga
+async def _exportar_zip(id_proyecto):
+    salida = _SalidaZip()
+    imagenes = set()
+    with zipfile.ZipFile(salida, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as archivo:
+        with archivo.open(NOMBRE_DATOS, "w", force_zip64=True) as datos:
+            pendiente = bytearray()
+            async for linea in _lineas_datos(id_proyecto, imagenes):
+                pendiente += linea
+                if len(pendiente) >= TROZO_BYTES:
+                    await asyncio.to_thread(datos.write, bytes(pendiente))
+                    pendiente.clear()
+                    if len(salida.pendiente) >= TROZO_BYTES:
+                        yield salida.vaciar()
+            await asyncio.to_thread(datos.write, bytes(pendiente))
+            await asyncio.to_thread(datos.close)
+        #Las imágenes ya van comprimidas: se guardan tal cual
+        for nombre in sorted(imagenes):
+            with archivo.open(zipfile.ZipInfo(CARPETA_IMAGENES + nombre), "w", force_zip64=True) as destino:
+                async for trozo in _trozos_imagen(nombre):
+                    await asyncio.to_thread(destino.write, trozo)
+                    if len(salida.pendiente) >= TROZO_BYTES:
+                        yield salida.vaciar()
+    yield salida.vaciar()
+
+
+#ENDPOINT PARA EXPORTAR UN PROYECTO COMPLETO (libros, capítulos, escaletas, notas, mapas, líneas de tiempo,
+#personajes e imágenes) COMO ZIP O NDJSON. La respuesta se genera y se envía por partes
+@router.get("/proyectos/{id_proyecto}/exportar")
+async def exportar_proyecto(id_proyecto: int, formato: FormatoArchivo = Query(FormatoArchivo.zip), token: str = Depends(oauth2_scheme)):
+    if formato == FormatoArchivo.zip:
+        contenido, media_type = _exportar_zip(id_proyecto), "application/zip"
+    else:
+        contenido, media_type = _exportar_ndjson(id_proyecto), "application/x-ndjson"
+    cabeceras = {"Content-Disposition": f'attachment; filename="proyecto_{id_proyecto}.{formato.value}"'}
+    return StreamingResponse(contenido, media_type=media_type, headers=cabeceras)
+
+
+#Estado de una importación: traducción de ids viejos a nuevos, filas pendientes de insertar e imágenes
+class _Importacion:
+    def __init__(self, id_usuario):
+        self.id_usuario = id_usuario
+        self.ids = {definicion.tabla: {} for definicion in TABLAS_ARCHIVO}
+        self.tabla_actual = None
+        self.pendientes = []
+        self.contadores = {}
+        self.huerfanas = 0
+        #nombre en el archivo -> nombre nuevo en user_storage
+        self.imagenes = {}
+        self.ficheros_escritos = []
+        self.version_leida = False
+
+    def _nombre_imagen(self, nombre):
+        nombre = os.path.basename(nombre)
+        if nombre not in self.imagenes:
+            self.imagenes[nombre] = f"{uuid.uuid4()}{os.path.splitext(nombre)[1]}"
+        return self.imagenes[nombre]
+
+    async def linea(self, objeto):
+        if not self.version_leida:
+            if objeto.get("formato") != FORMATO_ARCHIVO:
+                raise HTTPException(status_code=400, detail="El archivo no es una exportación de proyecto de escribdream")
+            if objeto.get("version") != VERSION_ARCHIVO:
+                raise HTTPException(status_code=400, detail="Versión de archivo no soportada")
+            self.version_leida = True
+        elif "imagen" in objeto:
+            await asyncio.to_thread(self.escribir_imagen_base64, objeto["imagen"], objeto["datos"])
+        elif "tabla" in objeto:
+            await self.fila(objeto["tabla"], objeto["fila"])
+
+    async def fila(self, tabla, fila):
+        definicion = TABLAS_POR_NOMBRE.get(tabla)
+        if definicion is None:
+            raise HTTPException(status_code=400, detail=f"Tabla desconocida en el archivo: {tabla}")
+        if tabla != self.tabla_actual:
+            await self.volcar()
+            self.tabla_actual = tabla
+        if tabla == "proyectos" and (self.ids["proyectos"] or self.pendientes):
+            raise HTTPException(status_code=400, detail="El archivo contiene más de un proyecto")
+        #Las filas cuyo padre no está en el archivo se descartan
+        for columna, tabla_padre in definicion.referencias.items():
+            if fila.get(columna) not in self.ids[tabla_padre]:
+                self.huerfanas += 1
+                return
+        self.pendientes.append(fila)
+        if len(self.pendientes) >= FILAS_POR_INSERT:
+            await self.volcar()
+
+    async def volcar(self):
+        if not self.pendientes:
+            return
+        definicion = TABLAS_POR_NOMBRE[self.tabla_actual]
+        filas = []
+        for fila in self.pendientes:
+            nueva = {columna: fila.get(columna, definicion.por_defecto.get(columna)) for columna in definicion.columnas}
+            for columna, tabla_padre in definicion.referencias.items():
+                nueva[columna] = self.ids[tabla_padre][fila[columna]]
+            if definicion.imagen and nueva.get(definicion.imagen):
+                nueva[definicion.imagen] = self._nombre_imagen(nueva[definicion.imagen])
+            if definicion.tabla == "proyectos":
+                nueva["id_usuario"] = self.id_usuario
+            filas.append(nueva)
+        columnas = list(filas[0])
+
+        if definicion.autoincremento:
+            ids_nuevos = await insertar_filas(definicion.tabla, columnas, filas)
+            traduccion = self.ids[definicion.tabla]
+            for fila, id_nuevo in zip(self.pendientes, ids_nuevos):
+                traduccion[fila[definicion.autoincremento]] = id_nuevo
+        else:
+            query, values = consulta_insert(definicion.tabla, columnas, filas)
+            await database.execute(query=query, values=values)
+        self.contadores[definicion.tabla] = self.contadores.get(definicion.tabla, 0) + len(filas)
+        self.pendientes = []
+
+    def escribir_imagen(self, nombre, datos):
+        nombre = os.path.basename(nombre)
+        #Imagen que no referencia ninguna fila importada
+        if nombre not in self.imagenes:
+            return
+        ruta = os.path.join(STORAGE_PATH, self.imagenes[nombre])
+        if ruta not in self.ficheros_escritos:
+            self.ficheros_escritos.append(ruta)
+        with open(ruta, "ab") as fichero:
+            fichero.write(datos)
+
+    def escribir_imagen_base64(self, nombre, datos):
+        self.escribir_imagen(nombre, base64.b64decode(datos))
+
+    def descartar_imagenes(self):
+        for ruta in self.ficheros_escritos:
+            if os.path.exists(ruta):
+                os.remove(ruta)
+
+
+def _lineas_fichero(fichero):
+    for numero, linea in enumerate(fichero, start=1):
+        linea = linea.strip()
+        if not linea:
+            continue
+        try:
+            yield json.loads(linea)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Línea {numero} del archivo no es JSON válido")
+
+
+def _leer_lote(objetos):
+    return list(itertools.islice(objetos, FILAS_POR_INSERT))
+
+
+#La lectura, descompresión y decodificación del archivo se hacen en un hilo, FILAS_POR_INSERT líneas cada vez,
+#para que un archivo grande no pare el bucle de eventos; en el bucle solo quedan los INSERT
+async def _importar_lineas(importacion, fichero):
+    objetos = _lineas_fichero(fichero)
+    while True:
+        lote = await asyncio.to_thread(_leer_lote, objetos)
+        if not lote:
+            break
+        for objeto in lote:
+            await importacion.linea(objeto)
+    await importacion.volcar()
+
+
+#Se ejecuta en un hilo: copia a user_storage las imágenes del zip que referencian filas importadas
+def _extraer_imagenes(archivo, importacion):
+    for nombre in archivo.namelist():
+        if nombre.startswith(CARPETA_IMAGENES) and not nombre.endswith("/"):
+            with archivo.open(nombre) as origen:
+                while True:
+                    trozo = origen.read(TROZO_BYTES)
+                    if not trozo:
+                        break
+                    importacion.escribir_imagen(nombre[len(CARPETA_IMAGENES):], trozo)
+
+
+async def _importar(importacion, file):
+    cabecera = await file.read(4)
+    await file.seek(0)
+    if cabecera.startswith(b"PK"):
+        try:
+            archivo = await asyncio.to_thread(zipfile.ZipFile, file.file)
+        except zipfile.BadZipFile:
+            raise HTTPException(status_code=400, detail="El zip está dañado")
+        with archivo:
+            if NOMBRE_DATOS not in archivo.namelist():
+                raise HTTPException(status_code=400, detail=f"El zip no contiene {NOMBRE_DATOS}")
+            with archivo.open(NOMBRE_DATOS) as datos:
+                await _importar_lineas(importacion, datos)
+            await asyncio.to_thread(_extraer_imagenes, archivo, importacion)
+    else:
+        await _importar_lineas(importacion, file.file)
+    if not importacion.ids["proyectos"]:
+        raise HTTPException(status_code=400, detail="El archivo no contiene ningún proyecto")
+
+
+#ENDPOINT PARA IMPORTAR UN PROYECTO EXPORTADO (zip o ndjson). Se crea como un proyecto nuevo del usuario
+#con ids nuevos; todas las filas se insertan en una sola transacción y, si algo falla, no queda nada a medias
+@router.post("/proyectos/importar", response_model=Dict[str, Any])
+async def importar_proyecto(file: UploadFile = File(...), token: str = Depends(oauth2_scheme), id_usuario_actual: int = Depends(get_id_usuario_actual)):
+    importacion = _Importacion(id_usuario_actual)
+    try:
+        async with database.transaction():
+            await _importar(importacion, file)
+    except Exception:
+        importacion.descartar_imagenes()
+        raise
+
+    for nombre in importacion.imagenes.values():
+        if os.path.exists(os.path.join(STORAGE_PATH, nombre)):
+            programar_variantes(nombre)
+    id_proyecto = next(iter(importacion.ids["proyectos"].values()))
+    return {
+        "ok": True,
+        "message": "Proyecto importado exitosamente",
+        "content": {"id_proyecto": id_proyecto, "filas": importacion.contadores, "filas_descartadas": importacion.huerfanas},
+    }
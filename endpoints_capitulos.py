@@ -1,25 +1,25 @@
 from io import BytesIO
 from fastapi import APIRouter, Query, HTTPException, Depends
-from fastapi.responses import FileResponse
 from fastapi.security import OAuth2PasswordBearer
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel
 from enum import Enum
 import datetime
 from db_config import database
-import pdfkit
-import tempfile
+from seguridad import oauth2_scheme, get_id_usuario_actual
+from cache_entidades import cache_entidades
+from permisos import MapaAcceso, get_mapa_acceso, verificar_acceso, filtro_acceso
+from exportaciones import exportar
 import os
 import json
-import subprocess
 
 
 router = APIRouter(
     prefix="/api/escribdream",
-    tags=["capitulos"]
+    tags=["capitulos"],
+    dependencies=[Depends(verificar_acceso)]
 )
 
-oauth2_scheme = OAuth2PasswordBearer("/token")
 
 
 class EstadoCapituloEnum(str, Enum):
@@ -46,11 +46,12 @@ class Capitulo(BaseModel):
 @router.get("/capitulos", response_model=Dict[str, Any])
 async def get_capitulos(
     token: str = Depends(oauth2_scheme),
+    acceso: MapaAcceso = Depends(get_mapa_acceso),
     estado_capitulo: Optional[EstadoCapituloEnum] = Query(None),
     fecha_creacion: Optional[str] = Query(None),
     fecha_modificacion: Optional[str] = Query(None)
 ):
-    query = "SELECT * FROM capitulos WHERE 1=1"
+    query = f"SELECT * FROM capitulos WHERE {filtro_acceso('id_libro', acceso.ids('libro'))}"
     values = {}
 
     if estado_capitulo:
@@ -127,12 +128,18 @@ async def get_capitulos_libro_fecha_modificacion(id_libro: int, fecha_modificaci
 
 #Obtener un capítulo por id_capitulo
 @router.get("/capitulos/{id_capitulo}", response_model=Dict[str, Any])
-async def get_capitulo(id_capitulo: int, token: str = Depends(oauth2_scheme)):
+async def get_capitulo(id_capitulo: int, token: str = Depends(oauth2_scheme), id_usuario_actual: int = Depends(get_id_usuario_actual)):
+    capitulo_cache = await cache_entidades.get("capitulo", id_capitulo)
+    if capitulo_cache is not None:
+        return {"ok": True, "content": capitulo_cache}
+    
+    generacion = cache_entidades.generacion
     query = "SELECT * FROM capitulos WHERE id_capitulo = :id_capitulo"
     values = {"id_capitulo": id_capitulo}
     capitulo = await database.fetch_one(query=query, values=values)
     if not capitulo:
         raise HTTPException(status_code=404, detail="No se encontró el capítulo")
+    await cache_entidades.set("capitulo", id_capitulo, dict(capitulo), etiquetas=[("libro", capitulo["id_libro"]), ("usuario", id_usuario_actual)], generacion=generacion)
     return {"ok": True, "content": dict(capitulo)}
 
 
@@ -206,6 +213,7 @@ async def update_capitulo(id_capitulo: int, capitulo: UpdateCapitulo, token: str
     query = f"UPDATE capitulos SET {', '.join(fields)} WHERE id_capitulo = :id_capitulo"
     
     await database.execute(query=query, values=values)
+    await cache_entidades.invalidar("capitulo", id_capitulo)
     return {"message": "Capítulo actualizado correctamente"}
     
     
@@ -222,6 +230,7 @@ async def delete_capitulo(id_capitulo: int, token: str = Depends(oauth2_scheme))
     query = "DELETE FROM capitulos WHERE id_capitulo = :id_capitulo"
     values = {"id_capitulo": id_capitulo}
     await database.execute(query=query, values=values)
+    await cache_entidades.invalidar("capitulo", id_capitulo)
     return {"message": "Capítulo eliminado correctamente"}
 
 #ENDPOINT PARA ELIMINAR TODOS LOS CAPITULOS DE UN LIBRO
@@ -230,28 +239,23 @@ async def delete_capitulos_libro(id_libro: int, token: str = Depends(oauth2_sche
     query = "DELETE FROM capitulos WHERE id_libro = :id_libro"
     values = {"id_libro": id_libro}
     await database.execute(query=query, values=values)
+    await cache_entidades.invalidar_etiqueta("libro", id_libro)
     return {"message": "Capítulos eliminados correctamente"}
 
 
 
 
 
-def convert_delta_to_html(delta_json):
-    process = subprocess.Popen(
-        ['node', 'node_scripts/convertDeltaToHtml.js', json.dumps(delta_json)],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
-        raise Exception(f"Node.js script error: {stderr.decode('utf-8')}")
-    return stdout.decode('utf-8')
+class FormatoExportacionEnum(str, Enum):
+    html = "html"
+    pdf = "pdf"
+    epub = "epub"
+    docx = "docx"
 
 
-@router.get("/capitulos/libro/{id_libro}/pdf", response_class=FileResponse)
-async def get_capitulos_libro_pdf(id_libro: int, token: str = Depends(oauth2_scheme)):
+async def exportar_libro(id_libro: int, formato: str, nombre_fichero: str):
     # Obtener los capítulos del libro desde la base de datos
-    query = "SELECT * FROM capitulos WHERE id_libro = :id_libro"
+    query = "SELECT numero_capitulo, titulo_capitulo, contenido_capitulo FROM capitulos WHERE id_libro = :id_libro ORDER BY numero_capitulo, id_capitulo"
     values = {"id_libro": id_libro}
     capitulos = await database.fetch_all(query=query, values=values)
     
@@ -270,93 +274,17 @@ async def get_capitulos_libro_pdf(id_libro: int, token: str = Depends(oauth2_sch
     if not libro_info:
         raise HTTPException(status_code=404, detail="No se encontró el libro")
     
-    titulo_libro = libro_info['titulo_libro']
-    autor_libro = libro_info['nombre_usuario']
-    
-    # Plantilla HTML para el contenido del PDF
-    html_template = """
-        <!DOCTYPE html>
-        <html lang="es">
-
-        <head>
-            <meta charset="UTF-8">
-            <title>{titulo_libro}</title>
-            <style>
-                body {{
-                    font-family: Arial, sans-serif;
-                    margin: 40px;
-                    line-height: 1.6;
-                }}
-
-                h1, h2, h3, h4 {{
-                    text-align: center;
-                    page-break-after: avoid;
-                }}
-
-                h1 {{
-                    font-size: 2.5em;
-                    margin-bottom: 0.5em;
-                }}
-
-                h2 {{
-                    font-size: 2em;
-                    margin-top: 2em;
-                    margin-bottom: 0.5em;
-                }}
-
-                h3 {{
-                    font-size: 1.75em;
-                    margin-top: 1.5em;
-                    margin-bottom: 0.5em;
-                }}
-
-                p {{
-                    text-align: justify;
-                }}
-
-                .chapter {{
-                    page-break-before: always;
-                    page-break-inside: avoid;
-                }}
-            </style>
-        </head>
-
-        <body>
-            <h1>{titulo_libro}</h1>
-            <h3>Por {autor_libro}</h3>
-            <hr>
-            {contenido}
-        </body>
-
-        </html>
-        """
-    
-    # Generar el contenido HTML para el PDF
-    html_content = html_template.format(titulo_libro=titulo_libro, autor_libro=autor_libro, contenido="")
-    
-    for capitulo in capitulos:
-        delta = json.loads(capitulo['contenido_capitulo'])
-        html_fragment = convert_delta_to_html(delta)
-
-        html_content += f"<div class='chapter'>"
-        html_content += f"<h2>Capítulo {capitulo['numero_capitulo']}: {capitulo['titulo_capitulo']}</h2>"
-        html_content += html_fragment
-        html_content += f"</div>"
-    
-    # Guardar el contenido HTML en un archivo para depuración (opcional)
-    with open("debug.html", "w", encoding="utf-8") as f:
-        f.write(html_content)
-    
-    # Configurar pdfkit con la ruta de wkhtmltopdf si es necesario
-    config = pdfkit.configuration(wkhtmltopdf=r"C:\Program Files\wkhtmltopdf\bin\wkhtmltopdf.exe")
+    libro = {"titulo_libro": libro_info['titulo_libro'], "autor": libro_info['nombre_usuario']}
+    return await exportar(formato, libro, [dict(capitulo) for capitulo in capitulos], nombre_fichero)
+
+
+#ENDPOINT PARA EXPORTAR LOS CAPITULOS DE UN LIBRO EN PDF
+@router.get("/capitulos/libro/{id_libro}/pdf")
+async def get_capitulos_libro_pdf(id_libro: int, token: str = Depends(oauth2_scheme)):
+    return await exportar_libro(id_libro, "pdf", f"libro_{id_libro}_capitulos")
 
-    # Crear un archivo temporal para el PDF
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-        tmp_file_path = tmp_file.name
-        pdfkit.from_string(html_content, tmp_file_path, configuration=config)
-    
-    # Enviar el archivo PDF como respuesta
-    return FileResponse(tmp_file_path, filename=f"libro_{id_libro}_capitulos.pdf", media_type='application/pdf')
 
-    # Limpieza del archivo temporal después de enviarlo (opcional)
-    os.remove(tmp_file_path)
\ No newline at end of file
+#ENDPOINT PARA EXPORTAR LOS CAPITULOS DE UN LIBRO EN HTML, PDF, EPUB O DOCX
+@router.get("/capitulos/libro/{id_libro}/exportar")
+async def exportar_capitulos_libro(id_libro: int, formato: FormatoExportacionEnum = Query(...), token: str = Depends(oauth2_scheme)):
+    return await exportar_libro(id_libro, formato.value, f"libro_{id_libro}")
@@ -5,13 +5,15 @@ from pydantic import BaseModel
 from enum import Enum
 import datetime
 from db_config import database
+from seguridad import oauth2_scheme
+from permisos import MapaAcceso, get_mapa_acceso, verificar_acceso, filtro_acceso
 
 router = APIRouter(
     prefix="/api/escribdream",
-    tags=["escaletas"]
+    tags=["escaletas"],
+    dependencies=[Depends(verificar_acceso)]
 )
 
-oauth2_scheme = OAuth2PasswordBearer("/token")
 
 
 class EstadoEscaleta(str, Enum):
@@ -35,12 +37,13 @@ class Escaleta(BaseModel):
 @router.get("/escaletas", response_model=Dict[str, Any])
 async def get_escaletas(
     token: str = Depends(oauth2_scheme),
+    acceso: MapaAcceso = Depends(get_mapa_acceso),
     estado_escaleta: Optional[EstadoEscaleta] = Query(None),
     fecha_creacion: Optional[str] = Query(None),
     fecha_modificacion: Optional[str] = Query(None)
 ):
     
-    query = "SELECT * FROM escaletas WHERE 1=1"
+    query = f"SELECT * FROM escaletas WHERE {filtro_acceso('id_libro', acceso.ids('libro'))}"
     values = {}
     
 
@@ -1,9 +1,13 @@
+import os
 from fastapi import APIRouter, Query, HTTPException, Depends
 from fastapi.security import OAuth2PasswordBearer
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 from pydantic import BaseModel
 from db_config import database
+from seguridad import oauth2_scheme
+from permisos import MapaAcceso, get_mapa_acceso, verificar_acceso, verificar_ids, filtro_acceso
+from lotes import comprobar_lote, insertar_lote, actualizar_lote, eliminar_lote
 
 class Evento(BaseModel):
     id_evento: int
@@ -12,23 +16,94 @@ class Evento(BaseModel):
     descripcion_evento: str
     fecha_creacion: datetime
     fecha_modificacion: datetime
+    posicion_inicio: Optional[float] = None
+    posicion_fin: Optional[float] = None
     
     
 router = APIRouter(
     prefix="/api/escribdream",
-    tags=["eventos"]
+    tags=["eventos"],
+    dependencies=[Depends(verificar_acceso)]
 )
 
-oauth2_scheme = OAuth2PasswordBearer("/token")
+
+#Cronología de los eventos. Cada evento tiene una posición en el tiempo de la historia (posicion_inicio y, si dura,
+#posicion_fin), en las unidades que elija el autor (años, días, capítulos...), y un orden para los eventos que
+#comparten posición. El orden cronológico es (posicion_inicio, orden, id_evento) y el índice
+#(id_linea_tiempo, posicion_inicio, orden) de migraciones/006 sirve las ventanas, los vecinos y el listado
+#ordenado sin ordenar en memoria.
+#El orden es un rango con huecos: los eventos nuevos se colocan ORDEN_HUECO detrás del último de su posición y
+#al mover un evento entre dos se le da el punto medio, así que reordenar es un UPDATE de una fila. Si el hueco
+#se agota solo se renumeran los eventos de esa posición, nunca la línea de tiempo entera
+ORDEN_HUECO = 1024.0
+ORDEN_SEPARACION_MINIMA = 1e-6
+EVENTOS_VENTANA_MAXIMO = int(os.getenv("EVENTOS_VENTANA_MAXIMO", "1000"))
+EVENTOS_VECINOS_MAXIMO = 50
+
+ORDEN_CRONOLOGICO = "posicion_inicio, orden, id_evento"
+ORDEN_CRONOLOGICO_INVERSO = "posicion_inicio DESC, orden DESC, id_evento DESC"
+#Eventos posteriores / anteriores a (:posicion_inicio, :orden, :id_evento) dentro de la misma línea de tiempo
+DESPUES_DE = "(posicion_inicio > :posicion_inicio OR (posicion_inicio = :posicion_inicio AND (orden > :orden OR (orden = :orden AND id_evento > :id_evento))))"
+ANTES_DE = "(posicion_inicio < :posicion_inicio OR (posicion_inicio = :posicion_inicio AND (orden < :orden OR (orden = :orden AND id_evento < :id_evento))))"
+
+
+def comprobar_posiciones(posicion_inicio, posicion_fin):
+    if posicion_inicio is not None and posicion_fin is not None and posicion_fin < posicion_inicio:
+        raise HTTPException(status_code=400, detail="La posición final del evento no puede ser anterior a la inicial")
+
+
+#Posición y órdenes para añadir cantidad eventos a una línea de tiempo: sin posición van detrás del último evento
+#de la línea y con posición, detrás de los que ya están en ella. Si dos altas simultáneas reciben el mismo orden
+#decide id_evento, así que el orden sigue siendo estable
+async def colocar_al_final(id_linea_tiempo, posicion_inicio=None, cantidad=1):
+    if posicion_inicio is None:
+        ultimo = await database.fetch_one(
+            query=f"SELECT posicion_inicio, orden FROM eventos WHERE id_linea_tiempo = :id_linea_tiempo ORDER BY {ORDEN_CRONOLOGICO_INVERSO} LIMIT 1",
+            values={"id_linea_tiempo": id_linea_tiempo}
+        )
+        posicion_inicio, maximo = (ultimo["posicion_inicio"], ultimo["orden"]) if ultimo is not None else (0.0, 0.0)
+    else:
+        maximo = await database.fetch_val(
+            query="SELECT MAX(orden) FROM eventos WHERE id_linea_tiempo = :id_linea_tiempo AND posicion_inicio = :posicion_inicio",
+            values={"id_linea_tiempo": id_linea_tiempo, "posicion_inicio": posicion_inicio}
+        ) or 0.0
+    return posicion_inicio, [maximo + ORDEN_HUECO * (indice + 1) for indice in range(cantidad)]
+
+
+async def _vecinos(evento, posteriores, cantidad, excluir=None):
+    query = f"""SELECT * FROM eventos WHERE id_linea_tiempo = :id_linea_tiempo AND {DESPUES_DE if posteriores else ANTES_DE}
+        {"AND id_evento <> :excluir" if excluir is not None else ""}
+        ORDER BY {ORDEN_CRONOLOGICO if posteriores else ORDEN_CRONOLOGICO_INVERSO} LIMIT {int(cantidad)}"""
+    values = {campo: evento[campo] for campo in ("id_linea_tiempo", "posicion_inicio", "orden", "id_evento")}
+    if excluir is not None:
+        values["excluir"] = excluir
+    return await database.fetch_all(query=query, values=values)
+
+
+#Renumerar con huecos los eventos de una posición (sin el que se está moviendo). Devuelve id_evento -> orden nuevo
+async def _renumerar_posicion(id_linea_tiempo, posicion_inicio, excluir):
+    filas = await database.fetch_all(
+        query=f"""SELECT id_evento FROM eventos WHERE id_linea_tiempo = :id_linea_tiempo AND posicion_inicio = :posicion_inicio
+            AND id_evento <> :excluir ORDER BY {ORDEN_CRONOLOGICO}""",
+        values={"id_linea_tiempo": id_linea_tiempo, "posicion_inicio": posicion_inicio, "excluir": excluir}
+    )
+    ordenes = {fila["id_evento"]: ORDEN_HUECO * (indice + 1) for indice, fila in enumerate(filas)}
+    await database.execute_many(
+        query="UPDATE eventos SET orden = :orden WHERE id_evento = :id_evento",
+        values=[{"id_evento": id_evento, "orden": orden} for id_evento, orden in ordenes.items()]
+    )
+    return ordenes
+
 
 #ENDPOINT PARA OBTENER TODOS LOS EVENTOS O FILTRARLOS POR DIFERENTES CAMPOS DE LA TABLA
 @router.get("/eventos", response_model=Dict[str, Any])
 async def get_eventos(
     token: str = Depends(oauth2_scheme),
+    acceso: MapaAcceso = Depends(get_mapa_acceso),
     fecha_creacion: Optional[str] = None,
     fecha_modificacion: Optional[str] = None
 ):
-    query = "SELECT * FROM eventos WHERE 1=1"
+    query = f"SELECT * FROM eventos WHERE {filtro_acceso('id_linea_tiempo', acceso.ids('linea_tiempo'))}"
     values = {}
 
     if fecha_creacion:
@@ -58,7 +133,7 @@ async def get_evento(id_evento: int, token: str = Depends(oauth2_scheme)):
 #ENDPOINT PARA OBTENER LOS EVENTOS DE UNA LINEA DE TIEMPO POR ID DE LINEA DE TIEMPO
 @router.get("/eventos/linea_tiempo/{id_linea_tiempo}", response_model=Dict[str, Any])
 async def get_eventos_linea_tiempo(id_linea_tiempo: int, token: str = Depends(oauth2_scheme)):
-    query = "SELECT * FROM eventos WHERE id_linea_tiempo = :id_linea_tiempo"
+    query = f"SELECT * FROM eventos WHERE id_linea_tiempo = :id_linea_tiempo ORDER BY {ORDEN_CRONOLOGICO}"
     values = {"id_linea_tiempo": id_linea_tiempo}
     
     eventos = await database.fetch_all(query=query, values=values)
@@ -67,16 +142,134 @@ async def get_eventos_linea_tiempo(id_linea_tiempo: int, token: str = Depends(oa
     return {"ok": True, "content": [dict(evento) for evento in eventos]}
 
 
+#ENDPOINT PARA OBTENER LOS EVENTOS DE UNA LINEA DE TIEMPO ENTRE DOS POSICIONES, EN ORDEN CRONOLOGICO
+#Con solapados=true también devuelve los eventos que empiezan antes de "desde" y siguen en curso.
+#Devuelve como mucho "limite" eventos; si hay más, hay_mas es true y la siguiente página se pide con los mismos
+#parámetros y despues_de_evento = id_evento del último evento recibido. El cursor sigue el orden completo
+#(posicion_inicio, orden, id_evento), así que avanza aunque muchos eventos compartan posición
+@router.get("/eventos/linea_tiempo/{id_linea_tiempo}/ventana", response_model=Dict[str, Any])
+async def get_eventos_ventana(
+    id_linea_tiempo: int,
+    token: str = Depends(oauth2_scheme),
+    desde: Optional[float] = None,
+    hasta: Optional[float] = None,
+    solapados: bool = False,
+    limite: int = Query(200, ge=1),
+    despues_de_evento: Optional[int] = None
+):
+    limite = min(limite, EVENTOS_VENTANA_MAXIMO)
+    query = "SELECT * FROM eventos WHERE id_linea_tiempo = :id_linea_tiempo"
+    values = {"id_linea_tiempo": id_linea_tiempo}
+    if despues_de_evento is not None:
+        cursor = await database.fetch_one(
+            query="SELECT posicion_inicio, orden, id_evento FROM eventos WHERE id_evento = :id_evento AND id_linea_tiempo = :id_linea_tiempo",
+            values={"id_evento": despues_de_evento, "id_linea_tiempo": id_linea_tiempo}
+        )
+        if cursor is None:
+            raise HTTPException(status_code=400, detail="El evento del cursor no pertenece a la línea de tiempo")
+        query += f" AND {DESPUES_DE}"
+        values.update({"posicion_inicio": cursor["posicion_inicio"], "orden": cursor["orden"], "id_evento": cursor["id_evento"]})
+    if desde is not None:
+        query += " AND posicion_inicio >= :desde"
+        values["desde"] = desde
+    if hasta is not None:
+        query += " AND posicion_inicio <= :hasta"
+        values["hasta"] = hasta
+    eventos = await database.fetch_all(query=f"{query} ORDER BY {ORDEN_CRONOLOGICO} LIMIT {limite + 1}", values=values)
+    hay_mas = len(eventos) > limite
+    eventos = eventos[:limite]
+
+    #Los eventos en curso solo van en la primera página
+    if solapados and desde is not None and despues_de_evento is None:
+        en_curso = await database.fetch_all(
+            query=f"""SELECT * FROM eventos WHERE id_linea_tiempo = :id_linea_tiempo AND posicion_inicio < :desde
+                AND posicion_fin >= :desde ORDER BY {ORDEN_CRONOLOGICO} LIMIT {limite}""",
+            values={"id_linea_tiempo": id_linea_tiempo, "desde": desde}
+        )
+        eventos = list(en_curso) + list(eventos)
+    return {"ok": True, "content": [dict(evento) for evento in eventos], "hay_mas": hay_mas}
+
+
+#ENDPOINT PARA OBTENER LOS EVENTOS ANTERIORES Y POSTERIORES A UN EVENTO EN LA CRONOLOGIA
+@router.get("/eventos/{id_evento}/vecinos", response_model=Dict[str, Any])
+async def get_eventos_vecinos(id_evento: int, token: str = Depends(oauth2_scheme), cantidad: int = Query(1, ge=1, le=EVENTOS_VECINOS_MAXIMO)):
+    evento = await database.fetch_one(query="SELECT * FROM eventos WHERE id_evento = :id_evento", values={"id_evento": id_evento})
+    if evento is None:
+        raise HTTPException(status_code=404, detail="El evento no existe")
+    anteriores = await _vecinos(evento, False, cantidad)
+    siguientes = await _vecinos(evento, True, cantidad)
+    return {"ok": True, "content": {
+        "anteriores": [dict(vecino) for vecino in reversed(anteriores)],
+        "siguientes": [dict(vecino) for vecino in siguientes],
+    }}
+
+
+#ENDPOINT PARA MOVER UN EVENTO JUSTO DESPUES O JUSTO ANTES DE OTRO DE SU LINEA DE TIEMPO
+#El evento pasa a la posición del de referencia (conservando su duración) y recibe el orden del hueco entre este
+#y su vecino
+class MoverEvento(BaseModel):
+    despues_de: Optional[int] = None
+    antes_de: Optional[int] = None
+
+
+@router.post("/eventos/{id_evento}/mover", response_model=Dict[str, Any])
+async def mover_evento(id_evento: int, movimiento: MoverEvento, token: str = Depends(oauth2_scheme)):
+    if (movimiento.despues_de is None) == (movimiento.antes_de is None):
+        raise HTTPException(status_code=400, detail="Indica despues_de o antes_de (solo uno de los dos)")
+    id_referencia = movimiento.despues_de if movimiento.despues_de is not None else movimiento.antes_de
+    if id_referencia == id_evento:
+        raise HTTPException(status_code=400, detail="Un evento no se puede mover respecto a sí mismo")
+    posteriores = movimiento.despues_de is not None
+
+    async with database.transaction():
+        evento = await database.fetch_one(query="SELECT * FROM eventos WHERE id_evento = :id_evento", values={"id_evento": id_evento})
+        if evento is None:
+            raise HTTPException(status_code=404, detail="El evento no existe")
+        referencia = await database.fetch_one(
+            query="SELECT * FROM eventos WHERE id_evento = :id_evento AND id_linea_tiempo = :id_linea_tiempo",
+            values={"id_evento": id_referencia, "id_linea_tiempo": evento["id_linea_tiempo"]}
+        )
+        if referencia is None:
+            raise HTTPException(status_code=400, detail="El evento de referencia no existe en la misma línea de tiempo")
+
+        posicion_inicio = referencia["posicion_inicio"]
+        vecino = await _vecinos(referencia, posteriores, 1, excluir=id_evento)
+        vecino = vecino[0] if vecino and vecino[0]["posicion_inicio"] == posicion_inicio else None
+        if vecino is None:
+            #Primero o último de su posición: basta con un hueco más allá de la referencia
+            orden = referencia["orden"] + (ORDEN_HUECO if posteriores else -ORDEN_HUECO)
+        else:
+            orden_referencia, orden_vecino = referencia["orden"], vecino["orden"]
+            if abs(orden_vecino - orden_referencia) < ORDEN_SEPARACION_MINIMA:
+                ordenes = await _renumerar_posicion(evento["id_linea_tiempo"], posicion_inicio, id_evento)
+                orden_referencia, orden_vecino = ordenes[referencia["id_evento"]], ordenes[vecino["id_evento"]]
+            orden = (orden_referencia + orden_vecino) / 2
+
+        posicion_fin = evento["posicion_fin"]
+        if posicion_fin is not None:
+            posicion_fin = posicion_inicio + (posicion_fin - evento["posicion_inicio"])
+        await database.execute(
+            query="UPDATE eventos SET posicion_inicio = :posicion_inicio, posicion_fin = :posicion_fin, orden = :orden WHERE id_evento = :id_evento",
+            values={"id_evento": id_evento, "posicion_inicio": posicion_inicio, "posicion_fin": posicion_fin, "orden": orden}
+        )
+    return {"ok": True, "content": {"id_evento": id_evento, "posicion_inicio": posicion_inicio, "posicion_fin": posicion_fin, "orden": orden}}
+
+
 
 #ENDPOINT PARA CREAR UN EVENTO
 @router.post("/eventos", response_model=Evento)
 async def create_evento(evento: Evento, token: str = Depends(oauth2_scheme)):
-    query = "INSERT INTO eventos (id_linea_tiempo, nombre_evento, descripcion_evento) VALUES (:id_linea_tiempo, :nombre_evento, :descripcion_evento)"
+    evento.posicion_inicio, (orden,) = await colocar_al_final(evento.id_linea_tiempo, evento.posicion_inicio)
+    comprobar_posiciones(evento.posicion_inicio, evento.posicion_fin)
+    query = """INSERT INTO eventos (id_linea_tiempo, nombre_evento, descripcion_evento, posicion_inicio, posicion_fin, orden)
+        VALUES (:id_linea_tiempo, :nombre_evento, :descripcion_evento, :posicion_inicio, :posicion_fin, :orden)"""
     values = {
         "id_linea_tiempo": evento.id_linea_tiempo,
         "nombre_evento": evento.nombre_evento,
-        "descripcion_evento": evento.descripcion_evento
-        
+        "descripcion_evento": evento.descripcion_evento,
+        "posicion_inicio": evento.posicion_inicio,
+        "posicion_fin": evento.posicion_fin,
+        "orden": orden
     }
     
     evento.id_evento = await database.execute(query=query, values=values)
@@ -85,14 +278,31 @@ async def create_evento(evento: Evento, token: str = Depends(oauth2_scheme)):
 #ENDPOINT PARA ACTUALIZAR UN EVENTO
 @router.put("/eventos/{id_evento}", response_model=Dict[str, Any])
 async def update_evento(id_evento: int, evento: Evento, token: str = Depends(oauth2_scheme)):
-    query = "UPDATE eventos SET nombre_evento = :nombre_evento, descripcion_evento = :descripcion_evento WHERE id_evento = :id_evento"
+    query = "UPDATE eventos SET nombre_evento = :nombre_evento, descripcion_evento = :descripcion_evento"
     values = {
         "id_evento": id_evento,
         "nombre_evento": evento.nombre_evento,
         "descripcion_evento": evento.descripcion_evento
     }
     
-    await database.execute(query=query, values=values)
+    #Las posiciones solo se tocan si vienen en el cuerpo (los clientes antiguos no las envían)
+    enviados = evento.dict(exclude_unset=True)
+    if "posicion_inicio" in enviados or "posicion_fin" in enviados:
+        actual = await database.fetch_one(query="SELECT id_linea_tiempo, posicion_inicio, posicion_fin FROM eventos WHERE id_evento = :id_evento", values={"id_evento": id_evento})
+        if actual is None:
+            raise HTTPException(status_code=404, detail="El evento no existe")
+        posicion_inicio = enviados.get("posicion_inicio", actual["posicion_inicio"])
+        posicion_fin = enviados.get("posicion_fin", actual["posicion_fin"])
+        comprobar_posiciones(posicion_inicio, posicion_fin)
+        query += ", posicion_fin = :posicion_fin"
+        values["posicion_fin"] = posicion_fin
+        #Al cambiar de posición pasa detrás de los eventos que ya hay en la nueva
+        if posicion_inicio is not None and posicion_inicio != actual["posicion_inicio"]:
+            posicion_inicio, (orden,) = await colocar_al_final(actual["id_linea_tiempo"], posicion_inicio)
+            query += ", posicion_inicio = :posicion_inicio, orden = :orden"
+            values.update({"posicion_inicio": posicion_inicio, "orden": orden})
+    
+    await database.execute(query=query + " WHERE id_evento = :id_evento", values=values)
     return {"message": "Evento actualizado"}
 
 #ENDPOINT PARA ELIMINAR UN EVENTO
@@ -104,3 +314,56 @@ async def delete_evento(id_evento: int, token: str = Depends(oauth2_scheme)):
     await database.execute(query=query, values=values)
     return {"message": "Evento eliminado"}
 
+
+#ENDPOINTS PARA CREAR, ACTUALIZAR Y ELIMINAR EVENTOS POR LOTES
+#Se valida todo el lote antes de escribir nada y se guarda en una sola transacción
+class NewEvento(BaseModel):
+    id_linea_tiempo: int
+    nombre_evento: str
+    descripcion_evento: Optional[str] = None
+    posicion_inicio: Optional[float] = None
+    posicion_fin: Optional[float] = None
+
+#Cambiar posicion_inicio por lote no recoloca el orden: para colocar un evento entre otros está /eventos/{id}/mover
+class UpdateEventoLote(BaseModel):
+    id_evento: int
+    nombre_evento: Optional[str] = None
+    descripcion_evento: Optional[str] = None
+    posicion_inicio: Optional[float] = None
+    posicion_fin: Optional[float] = None
+
+
+@router.post("/eventos/lote/", response_model=Dict[str, Any])
+async def create_eventos_lote(eventos: List[NewEvento], token: str = Depends(oauth2_scheme)):
+    comprobar_lote(eventos)
+    #Los eventos de la misma línea y posición se colocan juntos, detrás de los que ya había y en el orden del lote
+    filas = [evento.dict() for evento in eventos]
+    grupos = {}
+    for fila in filas:
+        grupos.setdefault((fila["id_linea_tiempo"], fila["posicion_inicio"]), []).append(fila)
+    for (id_linea_tiempo, posicion_inicio), grupo in grupos.items():
+        posicion_inicio, ordenes = await colocar_al_final(id_linea_tiempo, posicion_inicio, len(grupo))
+        for fila, orden in zip(grupo, ordenes):
+            fila["posicion_inicio"] = posicion_inicio
+            fila["orden"] = orden
+            comprobar_posiciones(posicion_inicio, fila["posicion_fin"])
+    ids = await insertar_lote("eventos", ["id_linea_tiempo", "nombre_evento", "descripcion_evento", "posicion_inicio", "posicion_fin", "orden"], filas)
+    return {"ok": True, "message": f"{len(ids)} eventos creados", "content": ids}
+
+
+@router.put("/eventos/lote/", response_model=Dict[str, Any])
+async def update_eventos_lote(eventos: List[UpdateEventoLote], token: str = Depends(oauth2_scheme), acceso: MapaAcceso = Depends(get_mapa_acceso)):
+    comprobar_lote(eventos)
+    for evento in eventos:
+        comprobar_posiciones(evento.posicion_inicio, evento.posicion_fin)
+    await verificar_ids(acceso, "evento", [evento.id_evento for evento in eventos])
+    await actualizar_lote("eventos", "id_evento", [evento.dict(exclude_none=True) for evento in eventos])
+    return {"ok": True, "message": f"{len(eventos)} eventos actualizados"}
+
+
+@router.delete("/eventos/lote/", response_model=Dict[str, Any])
+async def delete_eventos_lote(ids: List[int] = Query(...), token: str = Depends(oauth2_scheme), acceso: MapaAcceso = Depends(get_mapa_acceso)):
+    comprobar_lote(ids)
+    await verificar_ids(acceso, "evento", ids)
+    await eliminar_lote("eventos", "id_evento", ids)
+    return {"ok": True, "message": f"{len(set(ids))} eventos eliminados"}
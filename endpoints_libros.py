@@ -5,6 +5,10 @@ from pydantic import BaseModel
 from enum import Enum
 import datetime
 from db_config import database, connectToDatabase, closeConnection, getAllUsers
+from seguridad import oauth2_scheme, get_id_usuario_actual
+from cache_entidades import cache_entidades
+from eliminaciones import marcar_eliminado
+from permisos import MapaAcceso, get_mapa_acceso, verificar_acceso, filtro_acceso
 
 class GeneroLibro(str, Enum):
     fantasia = 'fantasia'
@@ -34,22 +38,23 @@ class Libro(BaseModel):
     
 router = APIRouter(
     prefix="/api/escribdream",
-    tags=["libros"]
+    tags=["libros"],
+    dependencies=[Depends(verificar_acceso)]
 )
 
-oauth2_scheme = OAuth2PasswordBearer("/token")
 
 #ENDPOINT PARA OBTENER TODOS LOS LIBROS DE LA BASE DE DATOS O FILTRARLOS POR DIFERENTES CAMPOS DE LA TABLA
 @router.get("/libros", response_model=Dict[str, Any])
 async def get_libros(
     token: str = Depends(oauth2_scheme),
+    acceso: MapaAcceso = Depends(get_mapa_acceso),
     genero_libro: Optional[GeneroLibro] = None,
     estado_libro: Optional[EstadoLibro] = None,
     fecha_creacion: Optional[datetime.datetime] = None,
     fecha_modificacion: Optional[datetime.datetime] = None,
     fecha_finalizacion: Optional[datetime.datetime] = None,
 ):
-    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE 1=1"
+    query = f"SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE {filtro_acceso('libros.id_libro', acceso.ids('libro'))}"
     values = {}
     
     if genero_libro:
@@ -80,7 +85,7 @@ async def get_libros(
 #Obtener todos los libros de la bbdd por id_proyecto
 @router.get("/libros/proyecto/{id_proyecto}", response_model=Dict[str, Any])
 async def get_libros_by_id_proyecto(id_proyecto: int, token: str = Depends(oauth2_scheme)):
-    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE libros.id_proyecto = :id_proyecto"
+    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE libros.id_proyecto = :id_proyecto AND libros.eliminado_en IS NULL"
     values = {"id_proyecto": id_proyecto}
     libros = await database.fetch_all(query=query, values=values)
     if not libros:
@@ -92,7 +97,7 @@ async def get_libros_by_id_proyecto(id_proyecto: int, token: str = Depends(oauth
 #Obtener todos los libros de un proyecto por genero_libro
 @router.get("/libros/proyecto/{id_proyecto}/genero/{genero_libro}", response_model=Dict[str, Any])
 async def get_libros_by_id_proyecto_and_genero_libro(id_proyecto: int, genero_libro: GeneroLibro, token: str = Depends(oauth2_scheme)):
-    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE libros.id_proyecto = :id_proyecto AND genero_libro = :genero_libro"
+    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE libros.id_proyecto = :id_proyecto AND libros.eliminado_en IS NULL AND genero_libro = :genero_libro"
     values = {"id_proyecto": id_proyecto, "genero_libro": genero_libro}
     libros = await database.fetch_all(query=query, values=values)
     if not libros:
@@ -103,7 +108,7 @@ async def get_libros_by_id_proyecto_and_genero_libro(id_proyecto: int, genero_li
 #Obtener todos los libros de un proyecto por estado_libro
 @router.get("/libros/proyecto/{id_proyecto}/estado/{estado_libro}", response_model=Dict[str, Any])
 async def get_libros_by_id_proyecto_and_estado_libro(id_proyecto: int, estado_libro: EstadoLibro, token: str = Depends(oauth2_scheme)):
-    query = "SELECT  libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto  LEFT JOIN usuarios  ON proyectos.id_usuario = usuarios.id_usuario WHERE libros.id_proyecto = :id_proyecto AND estado_libro = :estado_libro"
+    query = "SELECT  libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto  LEFT JOIN usuarios  ON proyectos.id_usuario = usuarios.id_usuario WHERE libros.id_proyecto = :id_proyecto AND libros.eliminado_en IS NULL AND estado_libro = :estado_libro"
     values = {"id_proyecto": id_proyecto, "estado_libro": estado_libro}
     libros = await database.fetch_all(query=query, values=values)
     if not libros:
@@ -115,7 +120,7 @@ async def get_libros_by_id_proyecto_and_estado_libro(id_proyecto: int, estado_li
 #Obtener todos los libros de un proyecto por fecha_creacion
 @router.get("/libros/proyecto/{id_proyecto}/fecha_creacion/{fecha_creacion}", response_model=Dict[str, Any])
 async def get_libros_by_id_proyecto_and_fecha_creacion(id_proyecto: int, fecha_creacion: datetime.datetime, token: str = Depends(oauth2_scheme)):
-    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE libros.id_proyecto = :id_proyecto AND fecha_creacion = :fecha_creacion"
+    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE libros.id_proyecto = :id_proyecto AND libros.eliminado_en IS NULL AND fecha_creacion = :fecha_creacion"
     values = {"id_proyecto": id_proyecto, "fecha_creacion": fecha_creacion}
     libros = await database.fetch_all(query=query, values=values)
     if not libros:
@@ -126,7 +131,7 @@ async def get_libros_by_id_proyecto_and_fecha_creacion(id_proyecto: int, fecha_c
 #Obtener todos los libros de un proyecto por fecha_modificacion
 @router.get("/libros/proyecto/{id_proyecto}/fecha_modificacion/{fecha_modificacion}", response_model=Dict[str, Any])
 async def get_libros_by_id_proyecto_and_fecha_modificacion(id_proyecto: int, fecha_modificacion: datetime.datetime, token: str = Depends(oauth2_scheme)):
-    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE libros.id_proyecto = :id_proyecto AND fecha_modificacion = :fecha_modificacion"
+    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE libros.id_proyecto = :id_proyecto AND libros.eliminado_en IS NULL AND fecha_modificacion = :fecha_modificacion"
     values = {"id_proyecto": id_proyecto, "fecha_modificacion": fecha_modificacion}
     libros = await database.fetch_all(query=query, values=values)
     if not libros:
@@ -137,7 +142,7 @@ async def get_libros_by_id_proyecto_and_fecha_modificacion(id_proyecto: int, fec
 #Obtener todos los libros de un proyecto por fecha_finalizacion
 @router.get("/libros/proyecto/{id_proyecto}/fecha_finalizacion/{fecha_finalizacion}", response_model=Dict[str, Any])
 async def get_libros_by_id_proyecto_and_fecha_finalizacion(id_proyecto: int, fecha_finalizacion: datetime.datetime, token: str = Depends(oauth2_scheme)):
-    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE libros.id_proyecto = :id_proyecto AND fecha_finalizacion = :fecha_finalizacion"
+    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE libros.id_proyecto = :id_proyecto AND libros.eliminado_en IS NULL AND fecha_finalizacion = :fecha_finalizacion"
     values = {"id_proyecto": id_proyecto, "fecha_finalizacion": fecha_finalizacion}
     libros = await database.fetch_all(query=query, values=values)
     if not libros:
@@ -150,7 +155,7 @@ async def get_libros_by_id_proyecto_and_fecha_finalizacion(id_proyecto: int, fec
 #Obtener todos los libros de la bbdd por id_usuario
 @router.get("/libros/usuario/{id_usuario}", response_model=Dict[str, Any])
 async def get_libros_by_id_usuario(id_usuario: int, token: str = Depends(oauth2_scheme)):
-    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE usuarios.id_usuario = :id_usuario"
+    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE usuarios.id_usuario = :id_usuario AND libros.eliminado_en IS NULL AND proyectos.eliminado_en IS NULL"
     values = {"id_usuario": id_usuario}
     libros = await database.fetch_all(query=query, values=values)
     if not libros:
@@ -161,7 +166,7 @@ async def get_libros_by_id_usuario(id_usuario: int, token: str = Depends(oauth2_
 #Obtener todos los libros de un usuario por genero_libro
 @router.get("/libros/usuario/{id_usuario}/genero/{genero_libro}", response_model=Dict[str, Any])
 async def get_libros_by_id_usuario_and_genero_libro(id_usuario: int, genero_libro: GeneroLibro, token: str = Depends(oauth2_scheme)):
-    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE usuarios.id_usuario = :id_usuario AND genero_libro = :genero_libro"
+    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE usuarios.id_usuario = :id_usuario AND libros.eliminado_en IS NULL AND proyectos.eliminado_en IS NULL AND genero_libro = :genero_libro"
     values = {"id_usuario": id_usuario, "genero_libro": genero_libro}
     libros = await database.fetch_all(query=query, values=values)
     if not libros:
@@ -172,7 +177,7 @@ async def get_libros_by_id_usuario_and_genero_libro(id_usuario: int, genero_libr
 #Obtener todos los libros de un usuario por estado_libro
 @router.get("/libros/usuario/{id_usuario}/estado/{estado_libro}", response_model=Dict[str, Any])
 async def get_libros_by_id_usuario_and_estado_libro(id_usuario: int, estado_libro: EstadoLibro, token: str = Depends(oauth2_scheme)):
-    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE usuarios.id_usuario = :id_usuario AND estado_libro = :estado_libro"
+    query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE usuarios.id_usuario = :id_usuario AND libros.eliminado_en IS NULL AND proyectos.eliminado_en IS NULL AND estado_libro = :estado_libro"
     values = {"id_usuario": id_usuario, "estado_libro": estado_libro}
     libros = await database.fetch_all(query=query, values=values)
     if not libros:
@@ -186,12 +191,18 @@ async def get_libros_by_id_usuario_and_estado_libro(id_usuario: int, estado_libr
 
 #Obtener un libro por id_libro
 @router.get("/libros/{id_libro}", response_model=Dict[str, Any])
-async def get_libro(id_libro: int, token: str = Depends(oauth2_scheme)):
+async def get_libro(id_libro: int, token: str = Depends(oauth2_scheme), id_usuario_actual: int = Depends(get_id_usuario_actual)):
+    libro_cache = await cache_entidades.get("libro", id_libro)
+    if libro_cache is not None:
+        return {"ok": True, "content": libro_cache}
+    
+    generacion = cache_entidades.generacion
     query = "SELECT libros.id_libro, libros.id_proyecto, libros.titulo_libro, libros.genero_libro, libros.descripcion_libro, libros.imagen_portada, libros.estado_libro, libros.fecha_creacion, libros.fecha_modificacion, libros.fecha_finalizacion, proyectos.nombre_proyecto, proyectos.tipo_proyecto, usuarios.nombre_usuario as autor, usuarios.seudonimo FROM libros LEFT JOIN proyectos ON libros.id_proyecto = proyectos.id_proyecto LEFT JOIN usuarios ON proyectos.id_usuario = usuarios.id_usuario WHERE libros.id_libro = :id_libro"
     values = {"id_libro": id_libro}
     libro = await database.fetch_one(query=query, values=values)
     if not libro:
         raise HTTPException(status_code=404, detail="No se encontró un libro con el id_libro especificado")
+    await cache_entidades.set("libro", id_libro, dict(libro), etiquetas=[("proyecto", libro["id_proyecto"]), ("usuario", id_usuario_actual)], generacion=generacion)
     return {"ok": True, "content": dict(libro)}
 
 
@@ -270,13 +281,17 @@ async def update_libro(id_libro: int, libroToUpdate: UpdateLibro, token: str = D
     query = f"UPDATE libros SET {', '.join(fields)} WHERE id_libro = :id_libro"
     
     await database.execute(query=query, values=values)
+    await cache_entidades.invalidar("libro", id_libro)
     return {"message": "Libro actualizado exitosamente."}
 
 #Eliminar un libro
 @router.delete("/libros/{id_libro}")
 async def delete_libro(id_libro: int, token: str = Depends(oauth2_scheme)):
-    query = "DELETE FROM libros WHERE id_libro = :id_libro"
-    values = {"id_libro": id_libro}
-    await database.execute(query=query, values=values)
+    #Se marca como eliminado y el worker de eliminaciones borra después capítulos, notas, escaletas y mapas por lotes
+    if not await marcar_eliminado("libro", id_libro):
+        raise HTTPException(status_code=404, detail="El libro no existe")
+    #Además del libro se invalidan sus capítulos cacheados
+    await cache_entidades.invalidar("libro", id_libro)
+    await cache_entidades.invalidar_etiqueta("libro", id_libro)
     return {"message": "Libro eliminado exitosamente"}
 
@@ -4,6 +4,9 @@ from typing import List, Optional, Dict, Any
 from pydantic import BaseModel
 import datetime
 from db_config import database
+from seguridad import oauth2_scheme
+from permisos import MapaAcceso, get_mapa_acceso, verificar_acceso, verificar_ids, filtro_acceso
+from lotes import comprobar_lote
 
 class LineaTiempo(BaseModel):
     id_linea_tiempo: int
@@ -15,15 +18,36 @@ class LineaTiempo(BaseModel):
 
 router = APIRouter(
     prefix="/api/escribdream",
-    tags=["lineas_tiempo"]
+    tags=["lineas_tiempo"],
+    dependencies=[Depends(verificar_acceso)]
 )
 
-oauth2_scheme = OAuth2PasswordBearer("/token")
+
+#Número de eventos y límites de la cronología (posiciones de migraciones/006 y última modificación) de varias
+#líneas de tiempo con una sola consulta agrupada. Las líneas sin eventos tienen 0 y límites a None
+async def resumen_eventos(ids_lineas_tiempo):
+    resumen = {
+        id_linea_tiempo: {"total_eventos": 0, "posicion_minima": None, "posicion_maxima": None, "ultima_modificacion": None}
+        for id_linea_tiempo in ids_lineas_tiempo
+    }
+    if not resumen:
+        return resumen
+    query = f"""
+        SELECT id_linea_tiempo, COUNT(*) AS total_eventos, MIN(posicion_inicio) AS posicion_minima,
+            MAX(COALESCE(posicion_fin, posicion_inicio)) AS posicion_maxima, MAX(fecha_modificacion) AS ultima_modificacion
+        FROM eventos WHERE id_linea_tiempo IN ({', '.join(str(int(id_linea_tiempo)) for id_linea_tiempo in sorted(resumen))})
+        GROUP BY id_linea_tiempo
+    """
+    for fila in await database.fetch_all(query=query):
+        resumen[fila["id_linea_tiempo"]] = {campo: fila[campo] for campo in ("total_eventos", "posicion_minima", "posicion_maxima", "ultima_modificacion")}
+    return resumen
+
 
 #ENDPOINT PARA OBTENER TODAS LAS LINEAS DE TIEMPO O FILTRARLAS POR DIFERENTES CAMPOS DE LA TABLA
 @router.get("/lineas_tiempo/", response_model=Dict[str, Any])
 async def get_lineas_tiempo(
     token: str = Depends(oauth2_scheme),
+    acceso: MapaAcceso = Depends(get_mapa_acceso),
     id_linea_tiempo: Optional[int] = Query(None),
     id_proyecto: Optional[int] = Query(None),
     nombre_linea_tiempo: Optional[str] = Query(None),
@@ -31,7 +55,7 @@ async def get_lineas_tiempo(
     fecha_creacion: Optional[str] = Query(None),
     fecha_modificacion: Optional[str] = Query(None)
 ):
-    query = "SELECT * FROM lineas_de_tiempo WHERE 1=1"
+    query = f"SELECT * FROM lineas_de_tiempo WHERE {filtro_acceso('id_proyecto', acceso.ids('proyecto'))}"
     values = {}
     
     if fecha_creacion:
@@ -61,15 +85,31 @@ async def get_linea_tiempo(id_linea_tiempo: int, token: str = Depends(oauth2_sch
 
 
 #ENDPOINT PARA OBETENER LA LINEA DE TIEMPO DE UN PROYECTO POR ID DE PROYECTO
+#Con incluir_eventos=true cada línea trae también su resumen de eventos (resumen_eventos), para la vista general
+#del proyecto sin pedir el recuento de cada línea por separado
 @router.get("/lineas_tiempo/proyecto/{id_proyecto}", response_model=Dict[str, Any])
-async def get_lineas_tiempo_proyecto(id_proyecto: int, token: str = Depends(oauth2_scheme)):
+async def get_lineas_tiempo_proyecto(id_proyecto: int, token: str = Depends(oauth2_scheme), incluir_eventos: bool = False):
     query = "SELECT * FROM lineas_de_tiempo WHERE id_proyecto = :id_proyecto"
     values = {"id_proyecto": id_proyecto}
     
     lineas_tiempo = await database.fetch_all(query=query, values=values)
     if not lineas_tiempo:
         raise HTTPException(status_code=404, detail="No se encontraron líneas de tiempo para el proyecto especificado")
-    return {"ok": True, "content": [dict(linea_tiempo) for linea_tiempo in lineas_tiempo]}
+    contenido = [dict(linea_tiempo) for linea_tiempo in lineas_tiempo]
+    if incluir_eventos:
+        resumen = await resumen_eventos([linea_tiempo["id_linea_tiempo"] for linea_tiempo in contenido])
+        for linea_tiempo in contenido:
+            linea_tiempo.update(resumen[linea_tiempo["id_linea_tiempo"]])
+    return {"ok": True, "content": contenido}
+
+
+#ENDPOINT PARA CONTAR LOS EVENTOS DE VARIAS LINEAS DE TIEMPO A LA VEZ (?ids=1&ids=2...)
+@router.get("/lineas_tiempo/eventos/count", response_model=Dict[str, Any])
+async def count_eventos_lineas_tiempo(ids: List[int] = Query(...), token: str = Depends(oauth2_scheme), acceso: MapaAcceso = Depends(get_mapa_acceso)):
+    comprobar_lote(ids)
+    await verificar_ids(acceso, "linea_tiempo", ids)
+    resumen = await resumen_eventos(set(ids))
+    return {"ok": True, "content": {str(id_linea_tiempo): datos for id_linea_tiempo, datos in resumen.items()}}
 
 
 
@@ -4,7 +4,13 @@ from typing import List, Optional, Dict, Any
 from pydantic import BaseModel
 from enum import Enum
 import datetime
+import json
+import os
 from db_config import database
+from seguridad import oauth2_scheme
+from permisos import MapaAcceso, get_mapa_acceso, verificar_acceso, verificar_ids, filtro_acceso
+from lotes import comprobar_lote, insertar_lote, actualizar_lote, eliminar_lote
+from indice_espacial import obtener_indice, agrupar, invalidar_mapas, localizacion_de_fila
 
 class TipoTerrenoEnum(str, Enum):
     Bosque = 'Bosque'
@@ -57,21 +63,55 @@ class Localizacion(BaseModel):
     flora_fauna: Optional[str]
     caracteristicas_destacadas: Optional[str]
     leyendas_historias: Optional[str]
+    coordenada_x: Optional[float] = None
+    coordenada_y: Optional[float] = None
+    poligono: Optional[List[List[float]]] = None
     fecha_creacion: Optional[datetime.datetime]
     fecha_modificacion: Optional[datetime.datetime]
     
 router = APIRouter(
     prefix="/api/escribdream",
-    tags=["localizaciones"]
+    tags=["localizaciones"],
+    dependencies=[Depends(verificar_acceso)]
 )
 
-oauth2_scheme = OAuth2PasswordBearer("/token")
+
+#Vista de un mapa: con más de LOCALIZACIONES_VISTA_MAXIMO localizaciones visibles (mapa muy alejado) se agrupan
+#en una rejilla de celdas x celdas y la respuesta lleva grupos en vez de cada localización
+LOCALIZACIONES_VISTA_MAXIMO = int(os.getenv("LOCALIZACIONES_VISTA_MAXIMO", "200"))
+
+
+#Comprobar la posición de una localización y prepararla para guardarla: devuelve (coordenada_x, coordenada_y,
+#poligono en JSON). Si solo hay polígono, el punto es la media de sus vértices
+def preparar_posicion(coordenada_x, coordenada_y, poligono):
+    if (coordenada_x is None) != (coordenada_y is None):
+        raise HTTPException(status_code=400, detail="Las coordenadas x e y de la localización van juntas")
+    if poligono is None:
+        return coordenada_x, coordenada_y, None
+    if len(poligono) < 3 or any(len(punto) != 2 for punto in poligono):
+        raise HTTPException(status_code=400, detail="El polígono de la localización necesita al menos tres puntos [x, y]")
+    if coordenada_x is None:
+        coordenada_x = sum(punto[0] for punto in poligono) / len(poligono)
+        coordenada_y = sum(punto[1] for punto in poligono) / len(poligono)
+    return coordenada_x, coordenada_y, json.dumps(poligono)
+
+
+#Mapas a los que pertenecen ahora las localizaciones (para invalidar sus índices espaciales antes de cambiarlas)
+async def mapas_de_localizaciones(ids):
+    if not ids:
+        return set()
+    filas = await database.fetch_all(
+        query=f"SELECT DISTINCT id_mapa FROM localizaciones WHERE id_localizacion IN ({', '.join(str(int(id_localizacion)) for id_localizacion in set(ids))})"
+    )
+    return {fila["id_mapa"] for fila in filas}
+
 
     
 #ENDPOINT PARA OBTENER TODAS LAS LOCALIZACIONES DE LA BASE DE DATOS O FILTRARLAS POR LOS CAMPOS DE LA TABLA
 @router.get("/localizaciones/", response_model=Dict[str, Any])
 async def get_localizaciones(
     token: str = Depends(oauth2_scheme),
+    acceso: MapaAcceso = Depends(get_mapa_acceso),
     ciudad: Optional[str] = Query(None),
     provincia: Optional[str] = Query(None),
     pais: Optional[str] = Query(None),
@@ -83,7 +123,7 @@ async def get_localizaciones(
 ):
     
     
-    query = "SELECT * FROM localizaciones WHERE 1=1"
+    query = f"SELECT * FROM localizaciones WHERE {filtro_acceso('id_mapa', acceso.ids('mapa'))}"
     values = {}
     
     if ciudad:
@@ -114,7 +154,7 @@ async def get_localizaciones(
     localizaciones = await database.fetch_all(query=query, values=values)
     if not localizaciones:
         raise HTTPException(status_code=404, detail="No se encontraron localizaciones con los filtros especificados")
-    return {"ok": True, "content": [dict(localizacion) for localizacion in localizaciones]}
+    return {"ok": True, "content": [localizacion_de_fila(localizacion) for localizacion in localizaciones]}
 
 
 
@@ -126,7 +166,31 @@ async def get_localizaciones_by_mapa(id_mapa: int, token: str = Depends(oauth2_s
     localizaciones = await database.fetch_all(query=query, values=values)
     if not localizaciones:
         raise HTTPException(status_code=404, detail="No se encontraron localizaciones con el id de mapa especificado")
-    return {"ok": True, "content": [dict(localizacion) for localizacion in localizaciones]}
+    return {"ok": True, "content": [localizacion_de_fila(localizacion) for localizacion in localizaciones]}
+
+
+#Obtener las localizaciones de un mapa que se ven en un rectángulo (en píxeles de la imagen del mapa).
+#Solo cuentan las localizaciones colocadas; las que tienen polígono se ven si su contorno entra en la vista
+@router.get("/localizaciones/mapa/{id_mapa}/vista", response_model=Dict[str, Any])
+async def get_vista_mapa(
+    id_mapa: int,
+    x_min: float,
+    y_min: float,
+    x_max: float,
+    y_max: float,
+    celdas: int = Query(16, ge=1, le=64),
+    token: str = Depends(oauth2_scheme),
+):
+    if x_max < x_min or y_max < y_min:
+        raise HTTPException(status_code=400, detail="La vista del mapa no es válida")
+    indice = await obtener_indice(id_mapa)
+    visibles = indice.buscar(x_min, y_min, x_max, y_max)
+    grupos = []
+    if len(visibles) > LOCALIZACIONES_VISTA_MAXIMO:
+        localizaciones, grupos = agrupar(visibles, x_min, y_min, x_max, y_max, celdas)
+    else:
+        localizaciones = visibles
+    return {"ok": True, "content": {"localizaciones": localizaciones, "grupos": grupos, "total": len(visibles)}}
 
 
 #Obtener una localizacion por su id
@@ -137,16 +201,17 @@ async def get_localizacion_by_id(id_localizacion: int, token: str = Depends(oaut
     localizacion = await database.fetch_one(query=query, values=values)
     if not localizacion:
         raise HTTPException(status_code=404, detail="No se encontró la localización con el id especificado")
-    return {"ok": True, "content": dict(localizacion)}
+    return {"ok": True, "content": localizacion_de_fila(localizacion)}
 
 
 #Crear una nueva localizacion
 @router.post("/localizaciones/", response_model=Dict[str, Any])
 async def create_localizacion(localizacion: Localizacion, token: str = Depends(oauth2_scheme)):
     query = """
-        INSERT INTO localizaciones (id_mapa, nombre_localizacion, ciudad, provincia, pais, descripcion_localizacion, tipo_terreno, clima, poblacion, flora_fauna, caracteristicas_destacadas, leyendas_historias, fecha_creacion, fecha_modificacion)
-        VALUES (:id_mapa, :nombre_localizacion, :ciudad, :provincia, :pais, :descripcion_localizacion, :tipo_terreno, :clima, :poblacion, :flora_fauna, :caracteristicas_destacadas, :leyendas_historias, :fecha_creacion, :fecha_modificacion)
+        INSERT INTO localizaciones (id_mapa, nombre_localizacion, ciudad, provincia, pais, descripcion_localizacion, tipo_terreno, clima, poblacion, flora_fauna, caracteristicas_destacadas, leyendas_historias, coordenada_x, coordenada_y, poligono, fecha_creacion, fecha_modificacion)
+        VALUES (:id_mapa, :nombre_localizacion, :ciudad, :provincia, :pais, :descripcion_localizacion, :tipo_terreno, :clima, :poblacion, :flora_fauna, :caracteristicas_destacadas, :leyendas_historias, :coordenada_x, :coordenada_y, :poligono, :fecha_creacion, :fecha_modificacion)
     """
+    coordenada_x, coordenada_y, poligono = preparar_posicion(localizacion.coordenada_x, localizacion.coordenada_y, localizacion.poligono)
     values = {
         "id_mapa": localizacion.id_mapa,
         "nombre_localizacion": localizacion.nombre_localizacion,
@@ -160,11 +225,15 @@ async def create_localizacion(localizacion: Localizacion, token: str = Depends(o
         "flora_fauna": localizacion.flora_fauna,
         "caracteristicas_destacadas": localizacion.caracteristicas_destacadas,
         "leyendas_historias": localizacion.leyendas_historias,
+        "coordenada_x": coordenada_x,
+        "coordenada_y": coordenada_y,
+        "poligono": poligono,
         "fecha_creacion": datetime.datetime.now(),
         "fecha_modificacion": datetime.datetime.now()
     }
     
     await database.execute(query=query, values=values)
+    invalidar_mapas([localizacion.id_mapa])
     return {"message": "Localizacion creada exitosamente"}
 
 #Actualizar una localizacion
@@ -185,7 +254,6 @@ async def update_localizacion(id_localizacion: int, localizacion: Localizacion,
         caracteristicas_destacadas = :caracteristicas_destacadas,
         leyendas_historias = :leyendas_historias,
         fecha_modificacion = :fecha_modificacion
-        WHERE id_localizacion = :id_localizacion
     """
     values = {
         "id_localizacion": id_localizacion,
@@ -203,10 +271,27 @@ async def update_localizacion(id_localizacion: int, localizacion: Localizacion,
         "leyendas_historias": localizacion.leyendas_historias,
         "fecha_modificacion": datetime.datetime.now()
     }
-    await database.execute(query=query, values=values)
+    #La posición solo se toca si viene en el cuerpo (los clientes antiguos no la envían); lo que no venga se
+    #completa con lo guardado
+    enviados = localizacion.dict(exclude_unset=True)
+    posicion = {}
+    if {"coordenada_x", "coordenada_y", "poligono"} & enviados.keys():
+        actual = await database.fetch_one(query="SELECT coordenada_x, coordenada_y, poligono FROM localizaciones WHERE id_localizacion = :id_localizacion", values={"id_localizacion": id_localizacion})
+        if actual is None:
+            raise HTTPException(status_code=404, detail="No se encontró la localización con el id especificado")
+        actual = localizacion_de_fila(actual)
+        posicion = {campo: enviados.get(campo, actual[campo]) for campo in ("coordenada_x", "coordenada_y", "poligono")}
+        values["coordenada_x"], values["coordenada_y"], values["poligono"] = preparar_posicion(posicion["coordenada_x"], posicion["coordenada_y"], posicion["poligono"])
+        posicion.update(coordenada_x=values["coordenada_x"], coordenada_y=values["coordenada_y"])
+        query += ", coordenada_x = :coordenada_x, coordenada_y = :coordenada_y, poligono = :poligono"
+    #La localización puede cambiar de mapa: se invalidan el índice del mapa anterior y el del nuevo
+    mapas = await mapas_de_localizaciones([id_localizacion])
+    await database.execute(query=query + " WHERE id_localizacion = :id_localizacion", values=values)
+    invalidar_mapas(mapas | {localizacion.id_mapa})
     response = {
         "id_localizacion": id_localizacion,
-        **values
+        **values,
+        **posicion
     }
     return {"message": "Localizacion actualizada exitosamente", "content": response}
 
@@ -215,6 +300,92 @@ async def update_localizacion(id_localizacion: int, localizacion: Localizacion,
 async def delete_localizacion(id_localizacion: int, token: str = Depends(oauth2_scheme)):
     query = "DELETE FROM localizaciones WHERE id_localizacion = :id_localizacion"
     values = {"id_localizacion": id_localizacion}
+    mapas = await mapas_de_localizaciones([id_localizacion])
     await database.execute(query=query, values=values)
+    invalidar_mapas(mapas)
     return {"message": "Localizacion eliminada satisfactoriamente"}
 
+
+#Crear, actualizar y eliminar localizaciones por lotes
+#Se valida todo el lote antes de escribir nada y se guarda en una sola transacción
+class NewLocalizacion(BaseModel):
+    id_mapa: int
+    nombre_localizacion: str
+    ciudad: Optional[str] = None
+    provincia: Optional[str] = None
+    pais: Optional[str] = None
+    descripcion_localizacion: Optional[str] = None
+    tipo_terreno: Optional[TipoTerrenoEnum] = None
+    clima: Optional[ClimaEnum] = None
+    poblacion: Optional[PoblacioEnum] = None
+    flora_fauna: Optional[str] = None
+    caracteristicas_destacadas: Optional[str] = None
+    leyendas_historias: Optional[str] = None
+    coordenada_x: Optional[float] = None
+    coordenada_y: Optional[float] = None
+    poligono: Optional[List[List[float]]] = None
+
+class UpdateLocalizacionLote(BaseModel):
+    id_localizacion: int
+    id_mapa: Optional[int] = None
+    nombre_localizacion: Optional[str] = None
+    ciudad: Optional[str] = None
+    provincia: Optional[str] = None
+    pais: Optional[str] = None
+    descripcion_localizacion: Optional[str] = None
+    tipo_terreno: Optional[TipoTerrenoEnum] = None
+    clima: Optional[ClimaEnum] = None
+    poblacion: Optional[PoblacioEnum] = None
+    flora_fauna: Optional[str] = None
+    caracteristicas_destacadas: Optional[str] = None
+    leyendas_historias: Optional[str] = None
+    coordenada_x: Optional[float] = None
+    coordenada_y: Optional[float] = None
+    poligono: Optional[List[List[float]]] = None
+
+COLUMNAS_LOCALIZACION = list(NewLocalizacion.model_fields) + ["fecha_creacion", "fecha_modificacion"]
+
+
+@router.post("/localizaciones/lote/", response_model=Dict[str, Any])
+async def create_localizaciones_lote(localizaciones: List[NewLocalizacion], token: str = Depends(oauth2_scheme)):
+    comprobar_lote(localizaciones)
+    ahora = datetime.datetime.now()
+    filas = []
+    for localizacion in localizaciones:
+        coordenada_x, coordenada_y, poligono = preparar_posicion(localizacion.coordenada_x, localizacion.coordenada_y, localizacion.poligono)
+        filas.append({
+            **localizacion.dict(), "coordenada_x": coordenada_x, "coordenada_y": coordenada_y, "poligono": poligono,
+            "fecha_creacion": ahora, "fecha_modificacion": ahora,
+        })
+    ids = await insertar_lote("localizaciones", COLUMNAS_LOCALIZACION, filas)
+    invalidar_mapas({localizacion.id_mapa for localizacion in localizaciones})
+    return {"ok": True, "message": f"{len(ids)} localizaciones creadas exitosamente", "content": ids}
+
+
+@router.put("/localizaciones/lote/", response_model=Dict[str, Any])
+async def update_localizaciones_lote(localizaciones: List[UpdateLocalizacionLote], token: str = Depends(oauth2_scheme), acceso: MapaAcceso = Depends(get_mapa_acceso)):
+    comprobar_lote(localizaciones)
+    await verificar_ids(acceso, "localizacion", [localizacion.id_localizacion for localizacion in localizaciones])
+    ahora = datetime.datetime.now()
+    elementos = []
+    for localizacion in localizaciones:
+        elemento = {**localizacion.dict(exclude_none=True), "fecha_modificacion": ahora}
+        if localizacion.coordenada_x is not None or localizacion.coordenada_y is not None or localizacion.poligono is not None:
+            elemento["coordenada_x"], elemento["coordenada_y"], poligono = preparar_posicion(localizacion.coordenada_x, localizacion.coordenada_y, localizacion.poligono)
+            if poligono is not None:
+                elemento["poligono"] = poligono
+        elementos.append(elemento)
+    mapas = await mapas_de_localizaciones([localizacion.id_localizacion for localizacion in localizaciones])
+    await actualizar_lote("localizaciones", "id_localizacion", elementos)
+    invalidar_mapas(mapas | {localizacion.id_mapa for localizacion in localizaciones if localizacion.id_mapa is not None})
+    return {"ok": True, "message": f"{len(localizaciones)} localizaciones actualizadas exitosamente"}
+
+
+@router.delete("/localizaciones/lote/", response_model=Dict[str, Any])
+async def delete_localizaciones_lote(ids: List[int] = Query(...), token: str = Depends(oauth2_scheme), acceso: MapaAcceso = Depends(get_mapa_acceso)):
+    comprobar_lote(ids)
+    await verificar_ids(acceso, "localizacion", ids)
+    mapas = await mapas_de_localizaciones(ids)
+    await eliminar_lote("localizaciones", "id_localizacion", ids)
+    invalidar_mapas(mapas)
+    return {"ok": True, "message": f"{len(set(ids))} localizaciones eliminadas exitosamente"}
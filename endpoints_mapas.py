@@ -1,10 +1,16 @@
-from fastapi import APIRouter, Query, HTTPException, Depends
+from fastapi import APIRouter, File, Query, HTTPException, Depends, UploadFile
 from fastapi.security import OAuth2PasswordBearer
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel
 from enum import Enum
 import datetime
+import os
+import shutil
+import uuid
 from db_config import database
+from seguridad import oauth2_scheme
+from permisos import MapaAcceso, get_mapa_acceso, verificar_acceso, filtro_acceso
+from imagenes import STORAGE_PATH, Image, leer_teselas, teselas_fallidas, programar_teselas, programar_variantes, eliminar_variantes, eliminar_imagen
 from fastapi.middleware.cors import CORSMiddleware
 
 
@@ -22,26 +28,29 @@ class Mapa(BaseModel):
 
 router = APIRouter(
     prefix="/api/escribdream",
-    tags=["mapas"]
+    tags=["mapas"],
+    dependencies=[Depends(verificar_acceso)]
 )
 
-oauth2_scheme = OAuth2PasswordBearer("/token")
 
 
 #ENDPOINT PARA OBTENER TODOS LOS MAPAS DE LA BASE DE DATOS O FILTRARLOS POR LOS CAMPOS DE LA TABLA
 @router.get("/mapas/", response_model=Dict[str, Any])
 async def get_mapas(
     token: str = Depends(oauth2_scheme),
+    acceso: MapaAcceso = Depends(get_mapa_acceso),
     fecha_creacion: Optional[datetime.datetime] = None,
     fecha_modificacion: Optional[datetime.datetime] = None
 ):
-    query = "SELECT * FROM mapas WHERE 1=1"
+    query = f"SELECT * FROM mapas WHERE {filtro_acceso('id_libro', acceso.ids('libro'))}"
     values = {}
 
     if fecha_creacion:
-        query += f" WHERE fecha_creacion = '{fecha_creacion}'"
+        query += " AND fecha_creacion = :fecha_creacion"
+        values["fecha_creacion"] = fecha_creacion
     if fecha_modificacion:
-        query += f" WHERE fecha_modificacion = '{fecha_modificacion}'"
+        query += " AND fecha_modificacion = :fecha_modificacion"
+        values["fecha_modificacion"] = fecha_modificacion
 
     mapas = await database.fetch_all(query=query, values=values)
     if not mapas:
@@ -106,9 +115,67 @@ async def update_mapa(id_mapa: int, mapa: Mapa, token: str = Depends(oauth2_sche
 #ENDPOINT PARA ELIMINAR UN MAPA
 @router.delete("/mapa/{id_mapa}")
 async def delete_mapa(id_mapa: int, token: str = Depends(oauth2_scheme)):
+    mapa = await database.fetch_one(query="SELECT imagen_mapa FROM mapas WHERE id_mapa = :id_mapa", values={"id_mapa": id_mapa})
     query = "DELETE FROM mapas WHERE id_mapa = :id_mapa"
     values = {"id_mapa": id_mapa}
     await database.execute(query=query, values=values)
+    #La imagen del mapa se borra con sus miniaturas y su pirámide de teselas
+    if mapa is not None and mapa["imagen_mapa"]:
+        eliminar_imagen(mapa["imagen_mapa"])
     return {"message": "Mapa eliminado exitosamente"}
 
 
+
+# Endpoint para subir la imagen de un mapa. Además de las miniaturas se genera en segundo plano su pirámide de
+# teselas, para que el cliente no tenga que descargar la imagen completa
+@router.post("/subir_imagen/mapa/{id_mapa}")
+async def upload_image_mapa(id_mapa: int, file: UploadFile = File(...), token: str = Depends(oauth2_scheme)):
+    mapa = await database.fetch_one(query="SELECT imagen_mapa FROM mapas WHERE id_mapa = :id_mapa", values={"id_mapa": id_mapa})
+    if mapa is None:
+        raise HTTPException(status_code=404, detail="Mapa no encontrado.")
+
+    file_extension = os.path.splitext(file.filename)[1]
+    unique_filename = f"{uuid.uuid4()}{file_extension}"
+    file_path = os.path.join(STORAGE_PATH, unique_filename)
+
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+
+    #Primero debemos eliminar la imagen anterior, sus miniaturas y sus teselas
+    if mapa["imagen_mapa"]:
+        old_image_path = os.path.join(STORAGE_PATH, os.path.basename(mapa["imagen_mapa"]))
+        if os.path.exists(old_image_path):
+            os.remove(old_image_path)
+        eliminar_variantes(mapa["imagen_mapa"])
+
+    query = "UPDATE mapas SET imagen_mapa = :imagen_mapa WHERE id_mapa = :id_mapa"
+    await database.execute(query=query, values={"id_mapa": id_mapa, "imagen_mapa": unique_filename})
+
+    programar_variantes(unique_filename)
+    programar_teselas(unique_filename)
+
+    return {"message": "Imagen subida exitosamente.", "filename": unique_filename}
+
+
+#Obtener la pirámide de teselas de la imagen de un mapa: dimensiones de cada nivel y la plantilla de la URL de
+#las teselas (/images/{imagen}/teselas/{nivel}/{x}/{y}, con caché y ETag). El cliente pinta primero el nivel que
+#cabe en pantalla, que son unas pocas teselas, y pide las demás al ampliar.
+#Mientras se genera (recién subida o importada, o de antes de existir las teselas) el estado es "generando";
+#si la imagen no se puede cortar es "sin_teselas" y el cliente usa la imagen completa
+@router.get("/mapa/{id_mapa}/teselas", response_model=Dict[str, Any])
+async def get_teselas_mapa(id_mapa: int, token: str = Depends(oauth2_scheme)):
+    mapa = await database.fetch_one(query="SELECT imagen_mapa FROM mapas WHERE id_mapa = :id_mapa", values={"id_mapa": id_mapa})
+    if mapa is None:
+        raise HTTPException(status_code=404, detail="No se encontró un mapa con el id_mapa especificado")
+    nombre = os.path.basename(mapa["imagen_mapa"] or "")
+    if not nombre or not os.path.isfile(os.path.join(STORAGE_PATH, nombre)):
+        raise HTTPException(status_code=404, detail="El mapa no tiene imagen")
+
+    imagen = f"{router.prefix}/images/{nombre}"
+    info = leer_teselas(nombre)
+    if info is not None:
+        return {"ok": True, "content": {"estado": "listo", "imagen": imagen, "url": imagen + "/teselas/{nivel}/{x}/{y}", **info}}
+    if Image is None or teselas_fallidas(nombre):
+        return {"ok": True, "content": {"estado": "sin_teselas", "imagen": imagen}}
+    programar_teselas(nombre)
+    return {"ok": True, "content": {"estado": "generando", "imagen": imagen}}
@@ -5,6 +5,9 @@ from pydantic import BaseModel
 from enum import Enum
 import datetime
 from db_config import database
+from seguridad import oauth2_scheme
+from permisos import MapaAcceso, get_mapa_acceso, verificar_acceso, verificar_ids, filtro_acceso
+from lotes import comprobar_lote, insertar_lote, actualizar_lote, eliminar_lote
 
 class Nota(BaseModel):
     id_nota: int
@@ -16,20 +19,21 @@ class Nota(BaseModel):
 
 router = APIRouter(
     prefix="/api/escribdream",
-    tags=["notas"]
+    tags=["notas"],
+    dependencies=[Depends(verificar_acceso)]
 )
 
-oauth2_scheme = OAuth2PasswordBearer("/token")
 
 
 #ENDPOINT PARA OBTENER TODAS LAS NOTAS DE LA BASE DE DATOS Y FILTRARLAS POR LOS CAMPOS DE LA TABLA NOTAS
 @router.get("/notas/", response_model=Dict[str, Any])
 async def get_notas(
     token: str = Depends(oauth2_scheme),
+    acceso: MapaAcceso = Depends(get_mapa_acceso),
     fecha_creacion: Optional[str] = Query(None),
     fecha_modificacion: Optional[str] = Query(None),
 ):
-    query = "SELECT * FROM notas WHERE 1=1"
+    query = f"SELECT * FROM notas WHERE {filtro_acceso('id_libro', acceso.ids('libro'))}"
     values = {}
 
     if fecha_creacion:
@@ -133,3 +137,39 @@ async def delete_notas_by_libro(id_libro: int, token: str = Depends(oauth2_schem
     await database.execute(query=query, values=values)
     return {"message": "Notas eliminadas exitosamente"}
 
+
+#Crear, actualizar y eliminar notas por lotes
+#Se valida todo el lote antes de escribir nada y se guarda en una sola transacción
+class NewNota(BaseModel):
+    id_libro: int
+    titulo_nota: str
+    contenido: Optional[str] = None
+
+class UpdateNotaLote(BaseModel):
+    id_nota: int
+    id_libro: Optional[int] = None
+    titulo_nota: Optional[str] = None
+    contenido: Optional[str] = None
+
+
+@router.post("/notas/lote/", response_model=Dict[str, Any])
+async def create_notas_lote(notas: List[NewNota], token: str = Depends(oauth2_scheme)):
+    comprobar_lote(notas)
+    ids = await insertar_lote("notas", ["id_libro", "titulo_nota", "contenido"], [nota.dict() for nota in notas])
+    return {"ok": True, "message": f"{len(ids)} notas creadas exitosamente", "content": ids}
+
+
+@router.put("/notas/lote/", response_model=Dict[str, Any])
+async def update_notas_lote(notas: List[UpdateNotaLote], token: str = Depends(oauth2_scheme), acceso: MapaAcceso = Depends(get_mapa_acceso)):
+    comprobar_lote(notas)
+    await verificar_ids(acceso, "nota", [nota.id_nota for nota in notas])
+    await actualizar_lote("notas", "id_nota", [nota.dict(exclude_none=True) for nota in notas])
+    return {"ok": True, "message": f"{len(notas)} notas actualizadas exitosamente"}
+
+
+@router.delete("/notas/lote/", response_model=Dict[str, Any])
+async def delete_notas_lote(ids: List[int] = Query(...), token: str = Depends(oauth2_scheme), acceso: MapaAcceso = Depends(get_mapa_acceso)):
+    comprobar_lote(ids)
+    await verificar_ids(acceso, "nota", ids)
+    await eliminar_lote("notas", "id_nota", ids)
+    return {"ok": True, "message": f"{len(set(ids))} notas eliminadas exitosamente"}
@@ -1,7 +1,7 @@
 import os
 import shutil
 import uuid
-from fastapi import APIRouter, File, Query, HTTPException, Depends, UploadFile
+from fastapi import APIRouter, Body, File, Query, HTTPException, Depends, UploadFile
 from fastapi.responses import FileResponse
 from fastapi.security import OAuth2PasswordBearer
 from typing import List, Optional, Dict, Any
@@ -9,7 +9,12 @@ from pydantic import BaseModel
 from enum import Enum
 import datetime
 from db_config import database, connectToDatabase, closeConnection
+from seguridad import oauth2_scheme, get_id_usuario_actual
+from cache_entidades import cache_entidades
+from permisos import MapaAcceso, get_mapa_acceso, verificar_acceso, verificar_ids, filtro_acceso
+from lotes import LOTE_MAXIMO, FILAS_POR_INSERT, comprobar_lote, consulta_insert, insertar_lote, actualizar_lote, eliminar_lote
 from endpoint_login_register import get_user_by_id
+from imagenes import programar_variantes, eliminar_variantes
 
 
 
@@ -53,15 +58,16 @@ class Personaje(BaseModel):
 
 router = APIRouter(
     prefix="/api/escribdream",
-    tags=["personajes"]
+    tags=["personajes"],
+    dependencies=[Depends(verificar_acceso)]
 )
 
-oauth2_scheme = OAuth2PasswordBearer("/token")
 
 #ENDPOINT PARA OBTENER TODOS LOS PERSONAJES DE LA BASE DE DATOS O FILTRARLOS POR DIFERENTES CAMPOS DE LA TABLA
 @router.get("/personajes/", response_model=Dict[str, Any])
 async def get_personajes(
     token: str = Depends(oauth2_scheme),
+    acceso: MapaAcceso = Depends(get_mapa_acceso),
     id_personaje: Optional[int] = Query(None),
     id_proyecto: Optional[int] = Query(None),
     nombre_personaje: Optional[str] = Query(None),
@@ -71,7 +77,7 @@ async def get_personajes(
     fecha_creacion: Optional[str] = Query(None),
     fecha_modificacion: Optional[str] = Query(None),
 ):
-    query = "SELECT * FROM personajes WHERE 1=1"
+    query = f"SELECT * FROM personajes WHERE {filtro_acceso('id_proyecto', acceso.ids('proyecto'))}"
     values = {}
 
     if genero:
@@ -100,12 +106,18 @@ async def get_personajes(
 
 #ENDPOINT PARA OBTENER UN PERSONAJE ESPECÍFICO DE LA BASE DE DATOS POR SU ID_PERSONAJE
 @router.get("/personajes/{id_personaje}", response_model=Dict[str, Any])
-async def get_personaje(id_personaje: int, token: str = Depends(oauth2_scheme)):
+async def get_personaje(id_personaje: int, token: str = Depends(oauth2_scheme), id_usuario_actual: int = Depends(get_id_usuario_actual)):
+    personaje_cache = await cache_entidades.get("personaje", id_personaje)
+    if personaje_cache is not None:
+        return {"ok": True, "content": [personaje_cache]}
+    
+    generacion = cache_entidades.generacion
     query = "SELECT * FROM personajes WHERE id_personaje = :id_personaje"
     values = {"id_personaje": id_personaje}
     personaje = await database.fetch_one(query=query, values=values)
     if not personaje:
         raise HTTPException(status_code=404, detail="No se encontró un personaje con ese ID")
+    await cache_entidades.set("personaje", id_personaje, dict(personaje), etiquetas=[("proyecto", personaje["id_proyecto"]), ("usuario", id_usuario_actual)], generacion=generacion)
     return {"ok": True, "content": [dict(personaje)]}
 
 
@@ -135,7 +147,7 @@ async def get_personaje(id_proyecto: int, token: str = Depends(oauth2_scheme)):
 #Obtener todos los personajes de la bbdd por id_usuario
 @router.get("/personajes/usuario/{id_usuario}", response_model=Dict[str, Any])
 async def get_personajes_usuario(id_usuario: int, token: str = Depends(oauth2_scheme)):
-    query = "SELECT personajes.* FROM personajes JOIN proyectos ON personajes.id_proyecto = proyectos.id_proyecto WHERE proyectos.id_usuario = :id_usuario"
+    query = "SELECT personajes.* FROM personajes JOIN proyectos ON personajes.id_proyecto = proyectos.id_proyecto WHERE proyectos.id_usuario = :id_usuario AND proyectos.eliminado_en IS NULL"
     values = {"id_usuario": id_usuario}
     personajes = await database.fetch_all(query=query, values=values)
     if not personajes:
@@ -148,7 +160,7 @@ async def get_personajes_usuario(id_usuario: int, token: str = Depends(oauth2_sc
 #Obtener todos los personajes de un proyecto por id_usuario
 @router.get("/personajes/usuario/{id_usuario}/proyecto/{id_proyecto}", response_model=Dict[str, Any])
 async def get_personajes_usuario_proyecto(id_usuario: int, id_proyecto: int, token: str = Depends(oauth2_scheme)):
-    query = "SELECT personajes.* FROM personajes JOIN proyectos ON personajes.id_proyecto = proyectos.id_proyecto WHERE proyectos.id_usuario = :id_usuario AND proyectos.id_proyecto = :id_proyecto"
+    query = "SELECT personajes.* FROM personajes JOIN proyectos ON personajes.id_proyecto = proyectos.id_proyecto WHERE proyectos.id_usuario = :id_usuario AND proyectos.id_proyecto = :id_proyecto AND proyectos.eliminado_en IS NULL"
     values = {"id_usuario": id_usuario, "id_proyecto": id_proyecto}
     personajes = await database.fetch_all(query=query, values=values)
     if not personajes:
@@ -382,6 +394,7 @@ async def update_personaje(id_personaje: int, personajeToUpdate: UpdatePersonaje
     query = f"UPDATE personajes SET {', '.join(fields)} WHERE id_personaje = :id_personaje"
     
     await database.execute(query=query, values=values)
+    await cache_entidades.invalidar("personaje", id_personaje)
     return {"message": "Personaje actualizado exitosamente."}
 
 
@@ -392,6 +405,7 @@ async def delete_personaje(id_personaje: int, token: str = Depends(oauth2_scheme
     query = "DELETE FROM personajes WHERE id_personaje = :id_personaje"
     values = {"id_personaje": id_personaje}
     await database.execute(query=query, values=values)
+    await cache_entidades.invalidar("personaje", id_personaje)
     return {"message": "Personaje eliminado exitosamente"}
 
 
@@ -402,6 +416,7 @@ async def delete_personajes_proyecto(id_proyecto: int, token: str = Depends(oaut
     query = "DELETE FROM personajes WHERE id_proyecto = :id_proyecto"
     values = {"id_proyecto": id_proyecto}
     await database.execute(query=query, values=values)
+    await cache_entidades.invalidar_etiqueta("proyecto", id_proyecto)
     return {"message": "Personajes asociados al proyecto eliminados exitosamente"}
 
 
@@ -412,6 +427,7 @@ async def delete_personajes_usuario(id_usuario: int, token: str = Depends(oauth2
     query = "DELETE personajes FROM personajes JOIN proyectos ON personajes.id_proyecto = proyectos.id_proyecto WHERE proyectos.id_usuario = :id_usuario"
     values = {"id_usuario": id_usuario}
     await database.execute(query=query, values=values)
+    await cache_entidades.invalidar_etiqueta("usuario", id_usuario)
     return {"message": "Personajes asociados a proyectos del usuario eliminados exitosamente"}
 
 
@@ -426,9 +442,24 @@ async def delete_personajes_libro(id_libro: int, token: str = Depends(oauth2_sch
     return {"message": "Personajes asociados al libro eliminados exitosamente"}
 
 
+#Un libro solo puede tener personajes de su propio proyecto. Que el usuario sea dueño de los personajes no basta:
+#podrían ser de otro de sus proyectos
+async def comprobar_personajes_del_libro(id_libro, ids):
+    if not ids:
+        return
+    ajenos = await database.fetch_all(
+        query=f"""SELECT p.id_personaje FROM personajes p JOIN libros l ON l.id_libro = :id_libro
+            WHERE p.id_personaje IN ({', '.join(str(int(id_personaje)) for id_personaje in sorted(ids))}) AND p.id_proyecto <> l.id_proyecto""",
+        values={"id_libro": id_libro}
+    )
+    if ajenos:
+        raise HTTPException(status_code=400, detail=f"Personajes que no pertenecen al proyecto del libro: {', '.join(str(fila['id_personaje']) for fila in ajenos)}")
+
+
 #ENDPOINT PARA ASOCIAR UN PERSONAJE A UN LIBRO
 @router.post("/personajes/libro/")
 async def create_personaje_libro(id_personaje: int, id_libro: int, token: str = Depends(oauth2_scheme)):
+    await comprobar_personajes_del_libro(id_libro, [id_personaje])
     query = "INSERT INTO personajes_libros (id_personaje, id_libro) VALUES (:id_personaje, :id_libro)"
     values = {"id_personaje": id_personaje, "id_libro": id_libro}
     await database.execute(query=query, values=values)
@@ -444,6 +475,77 @@ async def delete_personaje_libro(id_personaje: int, id_libro: int, token: str =
     return {"message": "Personaje desasociado del libro exitosamente"}
 
 
+#ENDPOINT PARA FIJAR EL REPARTO DE UN LIBRO: recibe la lista completa de personajes que deben estar asociados,
+#calcula la diferencia con personajes_libros y aplica altas y bajas en una sola transacción.
+#Repetir la misma petición no cambia nada, así que se puede reintentar sin miedo.
+#El SELECT ... FOR UPDATE bloquea solo las filas del libro (índice (id_libro, id_personaje), ver
+#migraciones/001_personajes_libros_indice.sql), así dos sincronizaciones del mismo libro no se pisan
+@router.put("/personajes/libro/{id_libro}", response_model=Dict[str, Any])
+async def set_personajes_libro(id_libro: int, id_personajes: List[int] = Body(...), token: str = Depends(oauth2_scheme), acceso: MapaAcceso = Depends(get_mapa_acceso)):
+    if len(id_personajes) > LOTE_MAXIMO:
+        raise HTTPException(status_code=413, detail=f"El lote no puede tener más de {LOTE_MAXIMO} elementos")
+    deseados = set(id_personajes)
+    await verificar_ids(acceso, "personaje", deseados)
+    await comprobar_personajes_del_libro(id_libro, deseados)
+
+    async with database.transaction():
+        #SQLite (benchmarks) no tiene FOR UPDATE: bloquea la base de datos entera al escribir
+        bloqueo = "" if database.url.dialect == "sqlite" else " FOR UPDATE"
+        filas = await database.fetch_all(
+            query=f"SELECT id_personaje FROM personajes_libros WHERE id_libro = :id_libro{bloqueo}",
+            values={"id_libro": id_libro}
+        )
+        actuales = {fila["id_personaje"] for fila in filas}
+        nuevos = sorted(deseados - actuales)
+        sobrantes = sorted(actuales - deseados)
+
+        if sobrantes:
+            query = f"DELETE FROM personajes_libros WHERE id_libro = :id_libro AND id_personaje IN ({', '.join(str(id_personaje) for id_personaje in sobrantes)})"
+            await database.execute(query=query, values={"id_libro": id_libro})
+        for inicio in range(0, len(nuevos), FILAS_POR_INSERT):
+            trozo = [{"id_personaje": id_personaje, "id_libro": id_libro} for id_personaje in nuevos[inicio:inicio + FILAS_POR_INSERT]]
+            query, values = consulta_insert("personajes_libros", ["id_personaje", "id_libro"], trozo)
+            await database.execute(query=query, values=values)
+
+    return {"ok": True, "message": "Personajes del libro actualizados exitosamente", "content": {"asociados": nuevos, "desasociados": sobrantes}}
+
+
+
+#ENDPOINTS PARA CREAR, ACTUALIZAR Y ELIMINAR PERSONAJES POR LOTES
+#Se valida todo el lote antes de escribir nada y se guarda en una sola transacción
+COLUMNAS_PERSONAJE = ["id_proyecto", "nombre_personaje", "descripcion_personaje", "genero", "rol_personaje", "estado_vital", "imagen_personaje"]
+
+class UpdatePersonajeLote(UpdatePersonaje):
+    id_personaje: int
+
+
+@router.post("/personajes/lote/", response_model=Dict[str, Any])
+async def create_personajes_lote(personajes: List[NewPersonaje], token: str = Depends(oauth2_scheme)):
+    comprobar_lote(personajes)
+    filas = [personaje.dict() for personaje in personajes]
+    ids = await insertar_lote("personajes", COLUMNAS_PERSONAJE, filas)
+    return {"ok": True, "message": f"{len(ids)} personajes creados exitosamente", "content": ids}
+
+
+@router.put("/personajes/lote/", response_model=Dict[str, Any])
+async def update_personajes_lote(personajes: List[UpdatePersonajeLote], token: str = Depends(oauth2_scheme), acceso: MapaAcceso = Depends(get_mapa_acceso)):
+    comprobar_lote(personajes)
+    ids = [personaje.id_personaje for personaje in personajes]
+    await verificar_ids(acceso, "personaje", ids)
+    await actualizar_lote("personajes", "id_personaje", [personaje.dict(exclude_none=True) for personaje in personajes])
+    await cache_entidades.invalidar_varios("personaje", ids)
+    return {"ok": True, "message": f"{len(ids)} personajes actualizados exitosamente"}
+
+
+@router.delete("/personajes/lote/", response_model=Dict[str, Any])
+async def delete_personajes_lote(ids: List[int] = Query(...), token: str = Depends(oauth2_scheme), acceso: MapaAcceso = Depends(get_mapa_acceso)):
+    comprobar_lote(ids)
+    await verificar_ids(acceso, "personaje", ids)
+    await eliminar_lote("personajes", "id_personaje", ids)
+    await cache_entidades.invalidar_varios("personaje", ids)
+    return {"ok": True, "message": f"{len(set(ids))} personajes eliminados exitosamente"}
+
+
 
 # Endpoint para subir imágenes y asociarlas a un personaje
 @router.post("/subir_imagen/personaje/{id_personaje}")
@@ -469,11 +571,15 @@ async def upload_image(id_personaje:int, file: UploadFile = File(...), token: st
         old_image_path = os.path.join("user_storage", personaje["imagen_personaje"])
         if os.path.exists(old_image_path):
             os.remove(old_image_path)
+        eliminar_variantes(personaje["imagen_personaje"])
             
     query = "UPDATE personajes SET imagen_personaje = :imagen_personaje WHERE id_personaje = :id_personaje"
     values = {"id_personaje": id_personaje, "imagen_personaje": unique_filename}
     await database.execute(query=query, values=values)
+    await cache_entidades.invalidar("personaje", id_personaje)
     
+    #Las miniaturas se generan en segundo plano para no retrasar la respuesta
+    programar_variantes(unique_filename)
     
     return {"message": "Imagen subida exitosamente.", "filename": unique_filename}
 
@@ -4,6 +4,10 @@ from typing import List, Optional, Dict, Any
 from pydantic import BaseModel
 import datetime
 from db_config import database
+from seguridad import oauth2_scheme, get_id_usuario_actual
+from cache_entidades import cache_entidades
+from eliminaciones import marcar_eliminado
+from permisos import MapaAcceso, get_mapa_acceso, verificar_acceso, filtro_acceso
 
 class Proyecto(BaseModel):
     id_proyecto: int
@@ -21,15 +25,16 @@ class Proyecto(BaseModel):
 
 router = APIRouter(
     prefix="/api/escribdream",
-    tags=["proyectos"]
+    tags=["proyectos"],
+    dependencies=[Depends(verificar_acceso)]
 )
 
-oauth2_scheme = OAuth2PasswordBearer("/token")
 
 #ENDPOINT PARA OBTENER TODOS LOS PROYECTOS O FILTRARLOS POR DIFERENTES CAMPOS DE LA TABLA
 @router.get("/proyectos/", response_model=Dict[str, Any])
 async def get_proyectos(
     token: str = Depends(oauth2_scheme),
+    acceso: MapaAcceso = Depends(get_mapa_acceso),
     id_proyecto: Optional[int] = Query(None),
     id_usuario: Optional[int] = Query(None),
     nombre_proyecto: Optional[str] = Query(None),
@@ -43,7 +48,7 @@ async def get_proyectos(
     etiquetas_proyecto: Optional[str] = Query(None),
     imagen_portada: Optional[str] = Query(None),
 ):
-    query = "SELECT * FROM proyectos WHERE 1=1"
+    query = f"SELECT * FROM proyectos WHERE {filtro_acceso('id_proyecto', acceso.ids('proyecto'))}"
     values = {}
     
     if nombre_proyecto:
@@ -85,19 +90,25 @@ async def get_proyectos(
 
 #ENDPOINT PARA OBTENER UN PROYECTO POR SU ID
 @router.get("/proyectos/{id_proyecto}", response_model=Dict[str, Any])
-async def get_proyecto(id_proyecto: int, token: str = Depends(oauth2_scheme)):
+async def get_proyecto(id_proyecto: int, token: str = Depends(oauth2_scheme), id_usuario_actual: int = Depends(get_id_usuario_actual)):
+    proyecto_cache = await cache_entidades.get("proyecto", id_proyecto)
+    if proyecto_cache is not None:
+        return {"ok": True, "content": proyecto_cache}
+    
+    generacion = cache_entidades.generacion
     query = "SELECT * FROM proyectos WHERE id_proyecto = :id_proyecto"
     values = {"id_proyecto": id_proyecto}
     proyecto = await database.fetch_one(query=query, values=values)
     if not proyecto:
         raise HTTPException(status_code=404, detail="No se encontró un proyecto con el id proporcionado")
+    await cache_entidades.set("proyecto", id_proyecto, dict(proyecto), etiquetas=[("usuario", id_usuario_actual)], generacion=generacion)
     return {"ok": True, "content": dict(proyecto)}
 
 
 #ENDPOINT PARA OBTENER TODOS LOS PROYECTOS DE UN USUARIO
 @router.get("/proyectos/usuario/{id_usuario}", response_model=Dict[str, Any])
 async def get_proyectos_usuario(id_usuario: int, token: str = Depends(oauth2_scheme)):
-    query = "SELECT * FROM proyectos WHERE id_usuario = :id_usuario"
+    query = "SELECT * FROM proyectos WHERE id_usuario = :id_usuario AND eliminado_en IS NULL"
     values = {"id_usuario": id_usuario}
     proyectos = await database.fetch_all(query=query, values=values)
     if not proyectos:
@@ -108,7 +119,7 @@ async def get_proyectos_usuario(id_usuario: int, token: str = Depends(oauth2_sch
 #ENDPOINT PARA OBTENER LOS PROYECTOS DE UN USUARIO POR SU TIPO DE PROYECTO
 @router.get("/proyectos/usuario/{id_usuario}/tipo_proyecto/{tipo_proyecto}", response_model=Dict[str, Any])
 async def get_proyectos_usuario_tipo(id_usuario: int, tipo_proyecto: str, token: str = Depends(oauth2_scheme)):
-    query = "SELECT * FROM proyectos WHERE id_usuario = :id_usuario AND tipo_proyecto = :tipo_proyecto"
+    query = "SELECT * FROM proyectos WHERE id_usuario = :id_usuario AND eliminado_en IS NULL AND tipo_proyecto = :tipo_proyecto"
     values = {"id_usuario": id_usuario, "tipo_proyecto": tipo_proyecto}
     proyectos = await database.fetch_all(query=query, values=values)
     if not proyectos:
@@ -119,7 +130,7 @@ async def get_proyectos_usuario_tipo(id_usuario: int, tipo_proyecto: str, token:
 #ENDPOINT PARA OBTENER LOS PROYECTOS DE UN USUARIO POR SU ESTADO
 @router.get("/proyectos/usuario/{id_usuario}/estado/{estado_proyecto}", response_model=Dict[str, Any])
 async def get_proyectos_usuario_estado(id_usuario: int, estado_proyecto: str, token: str = Depends(oauth2_scheme)):
-    query = "SELECT * FROM proyectos WHERE id_usuario = :id_usuario AND estado_proyecto = :estado_proyecto"
+    query = "SELECT * FROM proyectos WHERE id_usuario = :id_usuario AND eliminado_en IS NULL AND estado_proyecto = :estado_proyecto"
     values = {"id_usuario": id_usuario, "estado_proyecto": estado_proyecto}
     proyectos = await database.fetch_all(query=query, values=values)
     if not proyectos:
@@ -130,7 +141,7 @@ async def get_proyectos_usuario_estado(id_usuario: int, estado_proyecto: str, to
 # ENDPOINT PARA OBTENER LOS PROYECTOS DE UN USUARIO POR LIBROS ASOCIADOS
 @router.get("/proyectos/usuario/{id_usuario}/libros_asociados/{libros_asociados}", response_model=Dict[str, Any])
 async def get_proyectos_usuario_libros_asociados(id_usuario: int, libros_asociados: int, token: str = Depends(oauth2_scheme)):
-    query = "SELECT * FROM proyectos WHERE id_usuario = :id_usuario AND libros_asociados = :libros_asociados"
+    query = "SELECT * FROM proyectos WHERE id_usuario = :id_usuario AND eliminado_en IS NULL AND libros_asociados = :libros_asociados"
     values = {"id_usuario": id_usuario, "libros_asociados": libros_asociados}
     proyectos = await database.fetch_all(query=query, values=values)
     if not proyectos:
@@ -172,10 +183,12 @@ async def create_proyecto(proyecto: NewProyecto, token: str = Depends(oauth2_sch
 
 #ENDPOINT PARA ELIMINAR UN PROYECTO
 @router.delete("/proyectos/{id_proyecto}")
-async def delete_proyecto(id_proyecto: int, token: str = Depends(oauth2_scheme)):
-    query = "DELETE FROM proyectos WHERE id_proyecto = :id_proyecto"
-    values = {"id_proyecto": id_proyecto}
-    await database.execute(query=query, values=values)
+async def delete_proyecto(id_proyecto: int, token: str = Depends(oauth2_scheme), id_usuario_actual: int = Depends(get_id_usuario_actual)):
+    #Se marca como eliminado y el worker de eliminaciones borra después libros, capítulos, personajes... por lotes
+    if not await marcar_eliminado("proyecto", id_proyecto):
+        raise HTTPException(status_code=404, detail="El proyecto no existe")
+    #El borrado arrastra libros, capítulos y personajes, así que se invalida todo lo cacheado del usuario
+    await cache_entidades.invalidar_etiqueta("usuario", id_usuario_actual)
     return {"message": "Proyecto eliminado exitosamente"}
 
 
@@ -214,4 +227,7 @@ async def update_proyecto(id_proyecto: int, proyecto: UpdateProyecto, token: str
     query = query[:-2] + " WHERE id_proyecto = :id_proyecto"
     values["id_proyecto"] = id_proyecto
     await database.execute(query=query, values=values)
+    #Los libros cacheados incluyen el nombre y el tipo del proyecto
+    await cache_entidades.invalidar("proyecto", id_proyecto)
+    await cache_entidades.invalidar_etiqueta("proyecto", id_proyecto)
     return {"message": "Proyecto actualizado exitosamente"}
\ No newline at end of file
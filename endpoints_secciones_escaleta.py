@@ -5,12 +5,14 @@ from pydantic import BaseModel
 from enum import Enum
 import datetime
 from db_config import database
+from seguridad import oauth2_scheme
+from permisos import MapaAcceso, get_mapa_acceso, verificar_acceso, filtro_acceso
 
 router = APIRouter(
     prefix="/api/escribdream",
-    tags=["secciones escaleta"]
+    tags=["secciones escaleta"],
+    dependencies=[Depends(verificar_acceso)]
 )
-oauth2_scheme = OAuth2PasswordBearer("/token")
 
 class Seccion(BaseModel):
     id_seccion: Optional[int]
@@ -25,11 +27,12 @@ class Seccion(BaseModel):
 @router.get("/secciones", response_model=Dict[str, Any])
 async def get_secciones(
     token: str = Depends(oauth2_scheme),
+    acceso: MapaAcceso = Depends(get_mapa_acceso),
     fecha_creacion: Optional[str] = Query(None),
     fecha_modificacion: Optional[str] = Query(None)
 
 ):
-    query = "SELECT * FROM secciones_escaleta WHERE 1=1"
+    query = f"SELECT * FROM secciones_escaleta WHERE {filtro_acceso('id_escaleta', acceso.ids('escaleta'))}"
     values = {}
     if fecha_creacion:
         query += " AND DATE(fecha_creacion) = :fecha_creacion"
@@ -1,27 +1,28 @@
 import os
 import shutil
 import uuid
-from fastapi import APIRouter, File, Query, HTTPException, Depends, UploadFile
+from fastapi import APIRouter, File, Query, HTTPException, Depends, Request, UploadFile
 from typing import List, Optional, Dict, Any
 from fastapi.responses import FileResponse
-from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import datetime
 
-import requests
 from db_config import closeConnection, connectToDatabase, database
+from seguridad import oauth2_scheme, get_id_usuario_actual
+from permisos import verificar_acceso
+from cache_entidades import cache_entidades
+from eliminaciones import marcar_eliminado
 from fastapi.security import OAuth2PasswordBearer
 from endpoint_login_register import get_user_by_id
+from imagenes import TamanoImagen, obtener_variante, programar_variantes, eliminar_variantes, ruta_tesela
+from procesos import cerrar_pool
+from media import servir_fichero, es_nombre_inmutable
 
 router = APIRouter(
     prefix="/api/escribdream",
     tags=["usuarios"]
 )
 
-# Montar el directorio de almacenamiento de usuarios para servir archivos estáticos
-router.mount("/user_storage", StaticFiles(directory="user_storage"), name="user_storage")
-
-
 class Usuario(BaseModel):
     id_usuario: int
     nombre_usuario: str
@@ -40,12 +41,12 @@ class Usuario(BaseModel):
 
 
 
-oauth2_scheme = OAuth2PasswordBearer("/token")
 
 #ENDPOINT PARA OBTENER TODOS LOS USUARIOS O FILTRARLOS POR DIFERENTES CAMPOS DE LA TABLA
-@router.get("/usuarios/", response_model=Dict[str, Any])
+@router.get("/usuarios/", response_model=Dict[str, Any], dependencies=[Depends(verificar_acceso)])
 async def get_usuarios(
     token: str = Depends(oauth2_scheme),
+    id_usuario_actual: int = Depends(get_id_usuario_actual),
     nombre_usuario: Optional[str] = Query(None),
     primer_apellido: Optional[str] = Query(None),
     segundo_apellido: Optional[str] = Query(None),
@@ -58,8 +59,9 @@ async def get_usuarios(
     ultima_conexion: Optional[str] = Query(None),
 ):
     
-    query = "SELECT * FROM usuarios WHERE 1=1"
-    values = {}
+    #Cada usuario solo puede consultar sus propios datos
+    query = "SELECT * FROM usuarios WHERE id_usuario = :id_usuario_actual"
+    values = {"id_usuario_actual": id_usuario_actual}
 
     if nombre_usuario:
         query += " AND nombre_usuario LIKE :nombre_usuario"
@@ -99,7 +101,7 @@ async def get_usuarios(
 
 
 #ENDPOINT PARA OBTENER UN USUARIO POR SU ID
-@router.get("/usuarios/{id_usuario}", response_model=Dict[str, Any])
+@router.get("/usuarios/{id_usuario}", response_model=Dict[str, Any], dependencies=[Depends(verificar_acceso)])
 async def get_usuario(id_usuario: int, token: str = Depends(oauth2_scheme)):
     query = "SELECT id_usuario, nombre_usuario, primer_apellido, segundo_apellido, seudonimo, correo_electronico, fecha_registro, fecha_nacimiento, biografia, imagen_perfil, proyectos_iniciados, proyectos_finalizados, ultima_conexion FROM usuarios WHERE id_usuario = :id_usuario"
     
@@ -124,7 +126,7 @@ class UserUpdate(BaseModel):
     
 
 # Endpoint para actualizar uno o varios datos de un usuario
-@router.put("/actualizar/usuario/{id_usuario}")
+@router.put("/actualizar/usuario/{id_usuario}", dependencies=[Depends(verificar_acceso)])
 async def update_usuario(id_usuario: int, user_data: UserUpdate, token: str = Depends(oauth2_scheme)):
     user = get_user_by_id(id_usuario)
     if user is None:
@@ -169,6 +171,8 @@ async def update_usuario(id_usuario: int, user_data: UserUpdate, token: str = De
     #obtener el usuario actualizado
     # await database.fetch_one("SELECT * FROM usuarios WHERE id_usuario = :id_usuario", values={"id_usuario": id_usuario})
     await database.execute(query=query, values=values)
+    #Los libros cacheados incluyen el nombre y el seudónimo del autor
+    await cache_entidades.invalidar_etiqueta("usuario", id_usuario)
     
     return {
         "message": "Usuario actualizado exitosamente."
@@ -179,7 +183,7 @@ async def update_usuario(id_usuario: int, user_data: UserUpdate, token: str = De
     
 
 # Endpoint para subir imágenes y asociarlas a un usuario
-@router.post("/subir_imagen/{id_usuario}")
+@router.post("/subir_imagen/{id_usuario}", dependencies=[Depends(verificar_acceso)])
 async def upload_image(id_usuario:int, file: UploadFile = File(...), token: str = Depends(oauth2_scheme)):
     
     user = get_user_by_id(id_usuario)
@@ -201,11 +205,14 @@ async def upload_image(id_usuario:int, file: UploadFile = File(...), token: str
         old_image_path = os.path.join("user_storage", user["imagen_perfil"])
         if os.path.exists(old_image_path):
             os.remove(old_image_path)
+        eliminar_variantes(user["imagen_perfil"])
             
     query = "UPDATE usuarios SET imagen_perfil = :imagen_perfil WHERE id_usuario = :id_usuario"
     values = {"id_usuario": id_usuario, "imagen_perfil": unique_filename}
     await database.execute(query=query, values=values)
     
+    #Las miniaturas se generan en segundo plano para no retrasar la respuesta
+    programar_variantes(unique_filename)
     
     return {"message": "Imagen subida exitosamente.", "filename": unique_filename}
 
@@ -213,21 +220,48 @@ async def upload_image(id_usuario:int, file: UploadFile = File(...), token: str
 # Endpoint para obtener una imagen existente
 STORAGE_PATH = "user_storage"
 
+#Con el parámetro size se sirve una variante reducida en WebP (thumbnail, medium o webp) en lugar del original.
+#Es la única ruta para servir user_storage: responde con caché inmutable, ETag, 304 y rangos de bytes
+#HEAD va en una ruta aparte fuera del esquema: con api_route y los dos métodos FastAPI repite el operationId
 @router.get("/images/{image_name}")
-async def get_image(image_name: str):
-    file_path = os.path.join(STORAGE_PATH, image_name)
-    if not os.path.exists(file_path):
+@router.head("/images/{image_name}", include_in_schema=False)
+async def get_image(request: Request, image_name: str, size: Optional[TamanoImagen] = Query(None)):
+    file_path = os.path.join(STORAGE_PATH, os.path.basename(image_name))
+    if not os.path.isfile(file_path):
         raise HTTPException(status_code=404, detail="Image not found")
-    return FileResponse(file_path)
+    if size is not None:
+        file_path, es_variante = await obtener_variante(image_name, size)
+        if not es_variante:
+            #Sin variante se sirve la original, pero revalidando: no se puede fijar en caché como si fuera la variante
+            return servir_fichero(request, file_path, inmutable=False)
+    return servir_fichero(request, file_path)
+
+
+#Teselas de la pirámide de una imagen de mapa (GET /mapa/{id_mapa}/teselas da los niveles). Heredan la caché
+#de la imagen: con nombre uuid4 no cambian nunca, porque una imagen nueva tiene otro nombre y otras teselas
+@router.get("/images/{image_name}/teselas/{nivel}/{x}/{y}")
+@router.head("/images/{image_name}/teselas/{nivel}/{x}/{y}", include_in_schema=False)
+async def get_tesela(request: Request, image_name: str, nivel: int, x: int, y: int):
+    file_path = ruta_tesela(image_name, nivel, x, y)
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="Tesela no encontrada")
+    return servir_fichero(request, file_path, inmutable=es_nombre_inmutable(image_name), media_type="image/webp")
+
+
+#Cerrar el pool de procesos que genera las variantes al apagar la aplicación
+@router.on_event("shutdown")
+async def shutdown_pool_imagenes():
+    cerrar_pool()
 
 
 
 #ENDPOINT PARA ELIMINAR UN USUARIO POR SU ID
-@router.delete("/usuarios/{id_usuario}")
+@router.delete("/usuarios/{id_usuario}", dependencies=[Depends(verificar_acceso)])
 async def delete_usuario(id_usuario: int, token: str = Depends(oauth2_scheme)):
-    query = "DELETE FROM usuarios WHERE id_usuario = :id_usuario"
-    values = {"id_usuario": id_usuario}
-    await database.execute(query=query, values=values)
+    #Se marca como eliminado y el worker de eliminaciones borra después sus proyectos (y todo lo que cuelga de ellos) por lotes
+    if not await marcar_eliminado("usuario", id_usuario):
+        raise HTTPException(status_code=404, detail="El usuario no existe")
+    await cache_entidades.invalidar_etiqueta("usuario", id_usuario)
     return {"message": "Usuario eliminado exitosamente."}
     
     
@@ -245,7 +279,7 @@ class UserStats(BaseModel):
     totalPersonajes: int
     totalPalabras: int
 
-@router.get("/usuarios/estadisticas/{user_id}", response_model=UserStats)
+@router.get("/usuarios/estadisticas/{user_id}", response_model=UserStats, dependencies=[Depends(verificar_acceso)])
 async def get_user_stats(user_id: int, token: str = Depends(oauth2_scheme)) :
     connection = None
     try:
@@ -253,17 +287,17 @@ async def get_user_stats(user_id: int, token: str = Depends(oauth2_scheme)) :
         cursor = connection.cursor(dictionary=True)
         
         # Obtener total de proyectos
-        cursor.execute("SELECT COUNT(*) as totalProyectos FROM proyectos WHERE id_usuario = %s", (user_id,))
+        cursor.execute("SELECT COUNT(*) as totalProyectos FROM proyectos WHERE id_usuario = %s AND eliminado_en IS NULL", (user_id,))
         totalProyectos = cursor.fetchone().get('totalProyectos', 0)
         
         # Obtener total de libros
         cursor.execute("""
             SELECT COUNT(*) as totalLibros 
             FROM libros 
-            WHERE id_proyecto IN (
+            WHERE eliminado_en IS NULL AND id_proyecto IN (
                 SELECT id_proyecto 
                 FROM proyectos 
-                WHERE id_usuario = %s
+                WHERE id_usuario = %s AND eliminado_en IS NULL
             )
         """, (user_id,))
         totalLibros = cursor.fetchone().get('totalLibros', 0)
@@ -275,10 +309,10 @@ async def get_user_stats(user_id: int, token: str = Depends(oauth2_scheme)) :
             WHERE id_libro IN (
                 SELECT id_libro 
                 FROM libros 
-                WHERE id_proyecto IN (
+                WHERE eliminado_en IS NULL AND id_proyecto IN (
                     SELECT id_proyecto 
                     FROM proyectos 
-                    WHERE id_usuario = %s
+                    WHERE id_usuario = %s AND eliminado_en IS NULL
                 )
             )
         """, (user_id,))
@@ -291,7 +325,7 @@ async def get_user_stats(user_id: int, token: str = Depends(oauth2_scheme)) :
             WHERE id_proyecto IN (
                 SELECT id_proyecto 
                 FROM proyectos 
-                WHERE id_usuario = %s
+                WHERE id_usuario = %s AND eliminado_en IS NULL
             )
         """, (user_id,))
         totalPersonajes = cursor.fetchone().get('totalPersonajes', 0)
@@ -303,10 +337,10 @@ async def get_user_stats(user_id: int, token: str = Depends(oauth2_scheme)) :
             WHERE id_libro IN (
                 SELECT id_libro 
                 FROM libros 
-                WHERE id_proyecto IN (
+                WHERE eliminado_en IS NULL AND id_proyecto IN (
                     SELECT id_proyecto 
                     FROM proyectos 
-                    WHERE id_usuario = %s
+                    WHERE id_usuario = %s AND eliminado_en IS NULL
                 )
             )
         """, (user_id,))
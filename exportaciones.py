@@ -0,0 +1,557 @@
+import html
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import uuid
+import zipfile
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from procesos import ejecutar_en_pool
+from trazas import span
+
+
+#Motores de exportación de libros. Cada motor recibe el libro y sus capítulos (con el contenido en delta de Quill)
+#y escribe el documento en un fichero temporal capítulo a capítulo, dentro del pool de procesos para no bloquear
+#el bucle de eventos. La respuesta envía después el fichero por trozos y lo borra al terminar.
+#Para añadir un formato basta con una subclase de MotorExportacion registrada con registrar_motor()
+logger = logging.getLogger("escribdream.exportaciones")
+
+TROZO_EXPORTACION = 64 * 1024
+
+RUTA_NODE_SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "node_scripts")
+SCRIPT_DELTA_HTML = os.path.join(RUTA_NODE_SCRIPTS, "convertDeltaToHtml.js")
+
+#Binarios externos. Se buscan al arrancar: primero la variable de entorno (WKHTMLTOPDF_BIN, NODE_BIN),
+#después el PATH y por último las rutas de instalación habituales
+CANDIDATOS_BINARIOS = {
+    "wkhtmltopdf": ["/usr/local/bin/wkhtmltopdf", "/usr/bin/wkhtmltopdf", r"C:\Program Files\wkhtmltopdf\bin\wkhtmltopdf.exe"],
+    "node": ["/usr/local/bin/node", "/usr/bin/node", r"C:\Program Files\nodejs\node.exe"],
+}
+binarios = {nombre: None for nombre in CANDIDATOS_BINARIOS}
+_binarios_buscados = False
+
+
+def _ejecutable(ruta):
+    return bool(ruta) and os.path.isfile(ruta) and os.access(ruta, os.X_OK)
+
+
+def descubrir_binarios():
+    global _binarios_buscados
+    for nombre, candidatos in CANDIDATOS_BINARIOS.items():
+        ruta = os.getenv(f"{nombre.upper()}_BIN")
+        if ruta and not _ejecutable(ruta):
+            logger.warning("%s_BIN apunta a %s, que no es un ejecutable", nombre.upper(), ruta)
+            ruta = None
+        ruta = ruta or shutil.which(nombre) or next((candidato for candidato in candidatos if _ejecutable(candidato)), None)
+        binarios[nombre] = ruta
+    #El script de Node necesita además sus dependencias instaladas
+    if not os.path.isdir(os.path.join(RUTA_NODE_SCRIPTS, "node_modules", "quill-delta-to-html")):
+        binarios["node"] = None
+    _binarios_buscados = True
+    for nombre, ruta in binarios.items():
+        if ruta is None:
+            logger.warning("No se encontró %s: los formatos que lo necesitan no estarán disponibles", nombre)
+    return dict(binarios)
+
+
+async def iniciar_exportaciones():
+    descubrir_binarios()
+
+
+def _texto_xml(texto):
+    #Los caracteres de control no son válidos en XML
+    return html.escape(re.sub(r"[\x00-\x08\x0b\x0c\x0e-\x1f]", "", str(texto)), quote=True)
+
+
+def _delta(contenido):
+    if not contenido:
+        return {"ops": []}
+    delta = json.loads(contenido) if isinstance(contenido, str) else contenido
+    return {"ops": delta} if isinstance(delta, list) else delta
+
+
+#Partir un delta en líneas: cada línea es (segmentos, atributos de bloque), con segmentos (texto, atributos en línea).
+#Los atributos de bloque (header, list, blockquote, align...) van en el salto de línea que cierra la línea.
+#Las inserciones que no son texto (imágenes, vídeos, fórmulas) se omiten
+def lineas_delta(delta):
+    lineas = []
+    segmentos = []
+    for op in delta.get("ops", []):
+        insert = op.get("insert")
+        if not isinstance(insert, str):
+            continue
+        atributos = op.get("attributes") or {}
+        partes = insert.split("\n")
+        for indice, parte in enumerate(partes):
+            if parte:
+                segmentos.append((parte, atributos))
+            if indice < len(partes) - 1:
+                lineas.append((segmentos, atributos))
+                segmentos = []
+    if segmentos:
+        lineas.append((segmentos, {}))
+    return lineas
+
+
+def _tipo_lista(bloque):
+    lista = bloque.get("list")
+    if not lista:
+        return None
+    return "ol" if lista == "ordered" else "ul"
+
+
+def titulo_capitulo(capitulo):
+    return f"Capítulo {capitulo['numero_capitulo']}: {capitulo['titulo_capitulo'] or ''}"
+
+
+#Clase abstracta: un motor sin generar() falla al instanciarlo para registrarlo, no en el pool a mitad de petición
+class MotorExportacion(ABC):
+    nombre = None
+    extension = None
+    media_type = None
+    #Binarios que tienen que estar instalados para usar el motor
+    requiere = ()
+
+    def disponible(self):
+        return all(binarios.get(nombre) for nombre in self.requiere)
+
+    #Se ejecuta en el pool de procesos. libro: {"titulo_libro", "autor"}; capitulos: lista de
+    #{"numero_capitulo", "titulo_capitulo", "contenido_capitulo"} en orden
+    @abstractmethod
+    def generar(self, libro, capitulos, ruta, binarios):
+        pass
+
+
+PLANTILLA_HTML = """<!DOCTYPE html>
+<html lang="es">
+<head>
+    <meta charset="UTF-8">
+    <title>{titulo_libro}</title>
+    <style>
+        body {{
+            font-family: Arial, sans-serif;
+            margin: 40px;
+            line-height: 1.6;
+        }}
+
+        h1, h2, h3, h4 {{
+            text-align: center;
+            page-break-after: avoid;
+        }}
+
+        h1 {{
+            font-size: 2.5em;
+            margin-bottom: 0.5em;
+        }}
+
+        h2 {{
+            font-size: 2em;
+            margin-top: 2em;
+            margin-bottom: 0.5em;
+        }}
+
+        h3 {{
+            font-size: 1.75em;
+            margin-top: 1.5em;
+            margin-bottom: 0.5em;
+        }}
+
+        p {{
+            text-align: justify;
+        }}
+
+        .chapter {{
+            page-break-before: always;
+            page-break-inside: avoid;
+        }}
+    </style>
+</head>
+<body>
+    <h1>{titulo_libro}</h1>
+    <h3>Por {autor_libro}</h3>
+    <hr>
+"""
+
+FIN_HTML = """</body>
+</html>
+"""
+
+
+#HTML de cada capítulo con el conversor de Node (quill-delta-to-html), en el mismo orden que los capítulos.
+#Un solo proceso para todo el libro: los deltas van por la entrada estándar, uno por línea
+def _html_capitulos(capitulos, node):
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as entrada:
+        for capitulo in capitulos:
+            entrada.write(json.dumps(_delta(capitulo["contenido_capitulo"])) + "\n")
+        entrada.seek(0)
+        process = subprocess.Popen([node, SCRIPT_DELTA_HTML], stdin=entrada, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        for linea in process.stdout:
+            yield json.loads(linea)
+        stderr = process.stderr.read()
+        process.wait()
+    if process.returncode != 0:
+        raise Exception(f"Node.js script error: {stderr.decode('utf-8')}")
+
+
+def _escribir_html(libro, capitulos, fichero, node):
+    fichero.write(PLANTILLA_HTML.format(titulo_libro=html.escape(libro["titulo_libro"] or ""), autor_libro=html.escape(libro["autor"] or "")))
+    for capitulo, fragmento in zip(capitulos, _html_capitulos(capitulos, node)):
+        fichero.write(f"<div class='chapter'><h2>{html.escape(titulo_capitulo(capitulo))}</h2>{fragmento}</div>\n")
+    fichero.write(FIN_HTML)
+
+
+class MotorHTML(MotorExportacion):
+    nombre = "html"
+    extension = "html"
+    media_type = "text/html; charset=utf-8"
+    requiere = ("node",)
+
+    def generar(self, libro, capitulos, ruta, binarios):
+        with open(ruta, "w", encoding="utf-8") as fichero:
+            _escribir_html(libro, capitulos, fichero, binarios["node"])
+
+
+class MotorPDF(MotorExportacion):
+    nombre = "pdf"
+    extension = "pdf"
+    media_type = "application/pdf"
+    requiere = ("node", "wkhtmltopdf")
+
+    def generar(self, libro, capitulos, ruta, binarios):
+        import pdfkit
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".html", delete=False) as fichero:
+            ruta_html = fichero.name
+            _escribir_html(libro, capitulos, fichero, binarios["node"])
+        try:
+            pdfkit.from_file(ruta_html, ruta, configuration=pdfkit.configuration(wkhtmltopdf=binarios["wkhtmltopdf"]))
+        finally:
+            os.remove(ruta_html)
+
+
+#XHTML a partir del delta, para EPUB
+def _xhtml_segmento(texto, atributos):
+    contenido = _texto_xml(texto)
+    if atributos.get("code"):
+        contenido = f"<code>{contenido}</code>"
+    if atributos.get("script") in ("sub", "super"):
+        etiqueta = "sub" if atributos["script"] == "sub" else "sup"
+        contenido = f"<{etiqueta}>{contenido}</{etiqueta}>"
+    for atributo, etiqueta in (("strike", "s"), ("underline", "u"), ("italic", "em"), ("bold", "strong")):
+        if atributos.get(atributo):
+            contenido = f"<{etiqueta}>{contenido}</{etiqueta}>"
+    if atributos.get("link"):
+        contenido = f'<a href="{_texto_xml(atributos["link"])}">{contenido}</a>'
+    return contenido
+
+
+def xhtml_delta(delta):
+    partes = []
+    lista_abierta = None
+    for segmentos, bloque in lineas_delta(delta):
+        tipo_lista = _tipo_lista(bloque)
+        if tipo_lista != lista_abierta:
+            if lista_abierta:
+                partes.append(f"</{lista_abierta}>")
+            if tipo_lista:
+                partes.append(f"<{tipo_lista}>")
+            lista_abierta = tipo_lista
+        if tipo_lista:
+            etiqueta = "li"
+        elif bloque.get("header") in (1, 2, 3, 4, 5, 6):
+            etiqueta = f"h{bloque['header']}"
+        elif bloque.get("blockquote"):
+            etiqueta = "blockquote"
+        elif bloque.get("code-block"):
+            etiqueta = "pre"
+        else:
+            etiqueta = "p"
+        estilo = f' style="text-align: {bloque["align"]}"' if bloque.get("align") in ("center", "right", "justify") else ""
+        contenido = "".join(_xhtml_segmento(texto, atributos) for texto, atributos in segmentos) or "<br/>"
+        partes.append(f"<{etiqueta}{estilo}>{contenido}</{etiqueta}>")
+    if lista_abierta:
+        partes.append(f"</{lista_abierta}>")
+    return "\n".join(partes)
+
+
+PLANTILLA_XHTML = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="es" xml:lang="es">
+<head>
+<meta charset="UTF-8"/>
+<title>{titulo}</title>
+<link rel="stylesheet" type="text/css" href="estilos.css"/>
+</head>
+<body>
+{cuerpo}
+</body>
+</html>
+"""
+
+CSS_EPUB = """body { font-family: serif; line-height: 1.5; }
+h1, h2, h3 { text-align: center; }
+p { text-align: justify; margin: 0; text-indent: 1.5em; }
+blockquote { margin: 1em 2em; font-style: italic; }
+.portada { text-align: center; margin-top: 30%; }
+"""
+
+CONTAINER_EPUB = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles>
+<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+</rootfiles>
+</container>
+"""
+
+
+class MotorEPUB(MotorExportacion):
+    nombre = "epub"
+    extension = "epub"
+    media_type = "application/epub+zip"
+
+    def generar(self, libro, capitulos, ruta, binarios):
+        titulo = _texto_xml(libro["titulo_libro"] or "")
+        autor = _texto_xml(libro["autor"] or "")
+        ficheros = []
+        with zipfile.ZipFile(ruta, "w", compression=zipfile.ZIP_DEFLATED) as archivo:
+            #El mimetype tiene que ser la primera entrada y sin comprimir
+            archivo.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+            archivo.writestr("META-INF/container.xml", CONTAINER_EPUB)
+            archivo.writestr("OEBPS/estilos.css", CSS_EPUB)
+            archivo.writestr("OEBPS/portada.xhtml", PLANTILLA_XHTML.format(
+                titulo=titulo, cuerpo=f'<div class="portada"><h1>{titulo}</h1><p>{autor}</p></div>'))
+            #Un XHTML por capítulo, generado y comprimido de uno en uno
+            for indice, capitulo in enumerate(capitulos, start=1):
+                nombre = f"capitulo_{indice}.xhtml"
+                titulo_xml = _texto_xml(titulo_capitulo(capitulo))
+                cuerpo = f"<section epub:type=\"chapter\">\n<h1>{titulo_xml}</h1>\n{xhtml_delta(_delta(capitulo['contenido_capitulo']))}\n</section>"
+                archivo.writestr(f"OEBPS/{nombre}", PLANTILLA_XHTML.format(titulo=titulo_xml, cuerpo=cuerpo))
+                ficheros.append((nombre, titulo_xml))
+
+            indice_xhtml = "\n".join(f'<li><a href="{nombre}">{titulo_xml}</a></li>' for nombre, titulo_xml in ficheros)
+            archivo.writestr("OEBPS/nav.xhtml", PLANTILLA_XHTML.format(
+                titulo=titulo, cuerpo=f'<nav epub:type="toc" id="toc"><h1>Índice</h1><ol>\n{indice_xhtml}\n</ol></nav>'))
+
+            manifiesto = "\n".join(
+                f'<item id="capitulo_{indice}" href="{nombre}" media-type="application/xhtml+xml"/>'
+                for indice, (nombre, _) in enumerate(ficheros, start=1)
+            )
+            orden = "\n".join(f'<itemref idref="capitulo_{indice}"/>' for indice in range(1, len(ficheros) + 1))
+            modificado = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+            archivo.writestr("OEBPS/content.opf", f"""<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id_libro" xml:lang="es">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:identifier id="id_libro">urn:uuid:{uuid.uuid4()}</dc:identifier>
+<dc:title>{titulo}</dc:title>
+<dc:creator>{autor}</dc:creator>
+<dc:language>es</dc:language>
+<meta property="dcterms:modified">{modificado}</meta>
+</metadata>
+<manifest>
+<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+<item id="estilos" href="estilos.css" media-type="text/css"/>
+<item id="portada" href="portada.xhtml" media-type="application/xhtml+xml"/>
+{manifiesto}
+</manifest>
+<spine>
+<itemref idref="portada"/>
+<itemref idref="nav"/>
+{orden}
+</spine>
+</package>
+""")
+
+
+#WordprocessingML a partir del delta, para DOCX
+ALINEACION_DOCX = {"center": "center", "right": "right", "justify": "both"}
+
+
+def _docx_segmento(texto, atributos):
+    propiedades = []
+    if atributos.get("code"):
+        propiedades.append('<w:rFonts w:ascii="Courier New" w:hAnsi="Courier New"/>')
+    if atributos.get("bold"):
+        propiedades.append("<w:b/>")
+    if atributos.get("italic"):
+        propiedades.append("<w:i/>")
+    if atributos.get("strike"):
+        propiedades.append("<w:strike/>")
+    if atributos.get("link"):
+        propiedades.append('<w:color w:val="0563C1"/>')
+    if atributos.get("underline") or atributos.get("link"):
+        propiedades.append('<w:u w:val="single"/>')
+    if atributos.get("script") in ("sub", "super"):
+        propiedades.append(f'<w:vertAlign w:val="{"subscript" if atributos["script"] == "sub" else "superscript"}"/>')
+    rpr = f"<w:rPr>{''.join(propiedades)}</w:rPr>" if propiedades else ""
+    return f'<w:r>{rpr}<w:t xml:space="preserve">{_texto_xml(texto)}</w:t></w:r>'
+
+
+def _docx_parrafo(contenido, estilo=None, alineacion=None, sangria=False):
+    propiedades = []
+    if estilo:
+        propiedades.append(f'<w:pStyle w:val="{estilo}"/>')
+    if sangria:
+        propiedades.append('<w:ind w:left="720" w:hanging="360"/>')
+    if alineacion:
+        propiedades.append(f'<w:jc w:val="{alineacion}"/>')
+    ppr = f"<w:pPr>{''.join(propiedades)}</w:pPr>" if propiedades else ""
+    return f"<w:p>{ppr}{contenido}</w:p>"
+
+
+def docx_delta(delta):
+    parrafos = []
+    numero = 0
+    for segmentos, bloque in lineas_delta(delta):
+        tipo_lista = _tipo_lista(bloque)
+        numero = numero + 1 if tipo_lista == "ol" else 0
+        contenido = "".join(_docx_segmento(texto, atributos) for texto, atributos in segmentos)
+        if tipo_lista:
+            contenido = _docx_segmento(f"{numero}. " if tipo_lista == "ol" else "• ", {}) + contenido
+        estilo = None
+        if bloque.get("header") in (1, 2, 3, 4, 5, 6):
+            estilo = f"Heading{min(bloque['header'] + 1, 3)}"
+        elif bloque.get("blockquote"):
+            estilo = "Quote"
+        elif bloque.get("code-block"):
+            estilo = "Code"
+        parrafos.append(_docx_parrafo(contenido, estilo, ALINEACION_DOCX.get(bloque.get("align")), sangria=bool(tipo_lista)))
+    return "".join(parrafos)
+
+
+TIPOS_DOCX = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>
+<Override PartName="/docProps/core.xml" ContentType="application/vnd.openxmlformats-package.core-properties+xml"/>
+</Types>
+"""
+
+RELACIONES_DOCX = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties" Target="docProps/core.xml"/>
+</Relationships>
+"""
+
+RELACIONES_DOCUMENTO_DOCX = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>
+"""
+
+ESTILOS_DOCX = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:styles xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">
+<w:docDefaults><w:rPrDefault><w:rPr><w:rFonts w:ascii="Times New Roman" w:hAnsi="Times New Roman"/><w:sz w:val="24"/></w:rPr></w:rPrDefault>
+<w:pPrDefault><w:pPr><w:spacing w:after="120" w:line="360" w:lineRule="auto"/><w:jc w:val="both"/></w:pPr></w:pPrDefault></w:docDefaults>
+<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/></w:style>
+<w:style w:type="paragraph" w:styleId="Title"><w:name w:val="Title"/><w:basedOn w:val="Normal"/><w:pPr><w:jc w:val="center"/></w:pPr><w:rPr><w:b/><w:sz w:val="56"/></w:rPr></w:style>
+<w:style w:type="paragraph" w:styleId="Heading1"><w:name w:val="heading 1"/><w:basedOn w:val="Normal"/><w:pPr><w:keepNext/><w:spacing w:before="480" w:after="240"/><w:jc w:val="center"/><w:outlineLvl w:val="0"/></w:pPr><w:rPr><w:b/><w:sz w:val="40"/></w:rPr></w:style>
+<w:style w:type="paragraph" w:styleId="Heading2"><w:name w:val="heading 2"/><w:basedOn w:val="Normal"/><w:pPr><w:keepNext/><w:spacing w:before="360" w:after="120"/><w:outlineLvl w:val="1"/></w:pPr><w:rPr><w:b/><w:sz w:val="32"/></w:rPr></w:style>
+<w:style w:type="paragraph" w:styleId="Heading3"><w:name w:val="heading 3"/><w:basedOn w:val="Normal"/><w:pPr><w:keepNext/><w:spacing w:before="240" w:after="120"/><w:outlineLvl w:val="2"/></w:pPr><w:rPr><w:b/><w:sz w:val="28"/></w:rPr></w:style>
+<w:style w:type="paragraph" w:styleId="Quote"><w:name w:val="Quote"/><w:basedOn w:val="Normal"/><w:pPr><w:ind w:left="720" w:right="720"/></w:pPr><w:rPr><w:i/></w:rPr></w:style>
+<w:style w:type="paragraph" w:styleId="Code"><w:name w:val="Code"/><w:basedOn w:val="Normal"/><w:pPr><w:jc w:val="left"/></w:pPr><w:rPr><w:rFonts w:ascii="Courier New" w:hAnsi="Courier New"/><w:sz w:val="20"/></w:rPr></w:style>
+</w:styles>
+"""
+
+SALTO_PAGINA_DOCX = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+
+
+class MotorDOCX(MotorExportacion):
+    nombre = "docx"
+    extension = "docx"
+    media_type = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+    def generar(self, libro, capitulos, ruta, binarios):
+        titulo = libro["titulo_libro"] or ""
+        autor = libro["autor"] or ""
+        with zipfile.ZipFile(ruta, "w", compression=zipfile.ZIP_DEFLATED) as archivo:
+            archivo.writestr("[Content_Types].xml", TIPOS_DOCX)
+            archivo.writestr("_rels/.rels", RELACIONES_DOCX)
+            archivo.writestr("word/_rels/document.xml.rels", RELACIONES_DOCUMENTO_DOCX)
+            archivo.writestr("word/styles.xml", ESTILOS_DOCX)
+            archivo.writestr("docProps/core.xml", f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<cp:coreProperties xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:title>{_texto_xml(titulo)}</dc:title>
+<dc:creator>{_texto_xml(autor)}</dc:creator>
+<dc:language>es</dc:language>
+</cp:coreProperties>
+""")
+            #El cuerpo se escribe capítulo a capítulo directamente en la entrada comprimida
+            with archivo.open("word/document.xml", "w", force_zip64=True) as documento:
+                documento.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                                b'<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>')
+                documento.write(_docx_parrafo(_docx_segmento(titulo, {}), "Title").encode("utf-8"))
+                documento.write(_docx_parrafo(_docx_segmento(f"Por {autor}", {}), alineacion="center").encode("utf-8"))
+                for capitulo in capitulos:
+                    documento.write(SALTO_PAGINA_DOCX.encode("utf-8"))
+                    documento.write(_docx_parrafo(_docx_segmento(titulo_capitulo(capitulo), {}), "Heading1").encode("utf-8"))
+                    documento.write(docx_delta(_delta(capitulo["contenido_capitulo"])).encode("utf-8"))
+                documento.write(b'<w:sectPr><w:pgSz w:w="11906" w:h="16838"/>'
+                                b'<w:pgMar w:top="1440" w:right="1440" w:bottom="1440" w:left="1440" w:header="708" w:footer="708" w:gutter="0"/>'
+                                b'</w:sectPr></w:body></w:document>')
+
+
+MOTORES = {}
+
+
+def registrar_motor(motor):
+    MOTORES[motor.nombre] = motor
+
+
+for _motor in (MotorHTML(), MotorPDF(), MotorEPUB(), MotorDOCX()):
+    registrar_motor(_motor)
+
+
+def motores_disponibles():
+    if not _binarios_buscados:
+        descubrir_binarios()
+    return {nombre: motor.disponible() for nombre, motor in MOTORES.items()}
+
+
+#Función del pool de procesos: tiene que estar a nivel de módulo para poder enviarse al proceso hijo
+def _generar_en_proceso(nombre, libro, capitulos, ruta, rutas_binarios):
+    MOTORES[nombre].generar(libro, capitulos, ruta, rutas_binarios)
+
+
+def _enviar_y_borrar(ruta):
+    try:
+        with open(ruta, "rb") as fichero:
+            while True:
+                trozo = fichero.read(TROZO_EXPORTACION)
+                if not trozo:
+                    break
+                yield trozo
+    finally:
+        os.remove(ruta)
+
+
+#Generar el documento en el pool de procesos y devolverlo como respuesta por trozos
+async def exportar(nombre, libro, capitulos, nombre_fichero):
+    motor = MOTORES.get(nombre)
+    if motor is None:
+        raise HTTPException(status_code=400, detail=f"Formato de exportación desconocido: {nombre}")
+    if not motores_disponibles()[nombre]:
+        faltan = ", ".join(binario for binario in motor.requiere if not binarios.get(binario))
+        raise HTTPException(status_code=503, detail=f"El formato {nombre} no está disponible en este servidor (falta {faltan})")
+
+    descriptor, ruta = tempfile.mkstemp(suffix=f".{motor.extension}")
+    os.close(descriptor)
+    try:
+        with span(f"exportacion {nombre}", {"exportacion.formato": nombre, "capitulos": len(capitulos)}):
+            await ejecutar_en_pool(_generar_en_proceso, nombre, libro, capitulos, ruta, dict(binarios))
+    except Exception:
+        os.remove(ruta)
+        raise
+
+    cabeceras = {
+        "Content-Disposition": f'attachment; filename="{nombre_fichero}.{motor.extension}"',
+        "Content-Length": str(os.path.getsize(ruta)),
+    }
+    return StreamingResponse(_enviar_y_borrar(ruta), media_type=motor.media_type, headers=cabeceras)
@@ -0,0 +1,238 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import shutil
+from enum import Enum
+from procesos import ejecutar_en_pool
+
+try:
+    from PIL import Image, UnidentifiedImageError
+except ImportError:
+    Image = None
+
+
+STORAGE_PATH = "user_storage"
+VARIANTES_PATH = os.path.join(STORAGE_PATH, "variantes")
+TESELAS_PATH = os.path.join(STORAGE_PATH, "teselas")
+
+logger = logging.getLogger("escribdream.imagenes")
+
+
+#Variantes que se pueden pedir con el parámetro size de /images/{image_name}
+class TamanoImagen(str, Enum):
+    thumbnail = "thumbnail"
+    medium = "medium"
+    webp = "webp"
+
+
+#Ancho máximo de cada variante (None mantiene las dimensiones originales). Todas se guardan en WebP
+ANCHO_VARIANTES = {
+    TamanoImagen.thumbnail: 128,
+    TamanoImagen.medium: 640,
+    TamanoImagen.webp: None,
+}
+
+CALIDAD_WEBP = 80
+
+#Pirámide de teselas de las imágenes de mapa: el nivel más alto es la imagen original cortada en teselas de
+#TESELA_TAMANO x TESELA_TAMANO píxeles, cada nivel inferior es el anterior a la mitad y el nivel 0 cabe en una
+#sola tesela. Se guarda en TESELAS_PATH/<nombre>/<nivel>/<x>_<y>.webp junto a info.json con las dimensiones
+#de cada nivel; las teselas de los bordes son más pequeñas
+TESELA_TAMANO = int(os.getenv("TESELA_TAMANO", "256"))
+
+#Variantes que se están generando ahora mismo, para no generar dos veces la misma
+_en_curso = {}
+#Referencias a las tareas lanzadas en segundo plano para que no las recoja el recolector de basura
+_tareas_fondo = set()
+#Imágenes cuya pirámide no se pudo generar (no son imágenes válidas), para no reintentarlo en cada petición
+_teselas_fallidas = set()
+
+
+def ruta_variante(image_name, size):
+    nombre = os.path.splitext(os.path.basename(image_name))[0]
+    return os.path.join(VARIANTES_PATH, f"{nombre}_{size.value}.webp")
+
+
+#Se ejecuta en el pool de procesos: redimensiona la imagen y la guarda en WebP
+def _generar_variante(origen, destino, ancho):
+    with Image.open(origen) as imagen:
+        if imagen.mode not in ("RGB", "RGBA"):
+            imagen = imagen.convert("RGBA")
+        if ancho is not None and imagen.width > ancho:
+            alto = max(1, round(imagen.height * ancho / imagen.width))
+            imagen = imagen.resize((ancho, alto), Image.LANCZOS)
+        #Se escribe en un fichero temporal y se renombra para que nunca se sirva una variante a medias
+        temporal = f"{destino}.{os.getpid()}.tmp"
+        imagen.save(temporal, "WEBP", quality=CALIDAD_WEBP, method=4)
+    os.replace(temporal, destino)
+    return destino
+
+
+#Devolver (ruta, es_variante) de la variante pedida, generándola si todavía no existe.
+#Si Pillow no está instalado o la imagen no se puede procesar se devuelve la original con es_variante = False:
+#quien la sirva no debe cachearla como inmutable, porque en otro intento la variante sí puede generarse
+async def obtener_variante(image_name, size):
+    origen = os.path.join(STORAGE_PATH, os.path.basename(image_name))
+    if Image is None:
+        return origen, False
+
+    destino = ruta_variante(image_name, size)
+    if os.path.exists(destino):
+        return destino, True
+
+    tarea = _en_curso.get(destino)
+    if tarea is None:
+        os.makedirs(VARIANTES_PATH, exist_ok=True)
+        tarea = asyncio.ensure_future(ejecutar_en_pool(_generar_variante, origen, destino, ANCHO_VARIANTES[size]))
+        _en_curso[destino] = tarea
+        tarea.add_done_callback(lambda _: _en_curso.pop(destino, None))
+
+    try:
+        return await asyncio.shield(tarea), True
+    except Exception:
+        return origen, False
+
+
+#Generar todas las variantes de una imagen recién subida sin esperar a que terminen
+def programar_variantes(image_name):
+    if Image is None:
+        return
+    for size in TamanoImagen:
+        tarea = asyncio.ensure_future(obtener_variante(image_name, size))
+        _tareas_fondo.add(tarea)
+        tarea.add_done_callback(_tareas_fondo.discard)
+
+
+def ruta_teselas(image_name):
+    nombre = os.path.splitext(os.path.basename(image_name))[0]
+    return os.path.join(TESELAS_PATH, nombre)
+
+
+def ruta_tesela(image_name, nivel, x, y):
+    return os.path.join(ruta_teselas(image_name), str(int(nivel)), f"{int(x)}_{int(y)}.webp")
+
+
+#Se ejecuta en el pool de procesos: corta la imagen en teselas nivel a nivel, del original hacia abajo, reduciendo
+#a la mitad el nivel anterior (así la imagen grande solo se decodifica una vez)
+def _generar_teselas(origen, destino, tamano):
+    #Se genera en una carpeta temporal que se renombra al final para que nunca se sirva una pirámide a medias
+    temporal = f"{destino}.{os.getpid()}.tmp"
+    shutil.rmtree(temporal, ignore_errors=True)
+    try:
+        info = _cortar_teselas(origen, temporal, tamano)
+    except BaseException:
+        shutil.rmtree(temporal, ignore_errors=True)
+        raise
+    try:
+        os.rename(temporal, destino)
+    except OSError:
+        #Otro worker terminó antes la misma pirámide
+        shutil.rmtree(temporal, ignore_errors=True)
+    return info
+
+
+def _cortar_teselas(origen, temporal, tamano):
+    with Image.open(origen) as imagen:
+        if imagen.mode not in ("RGB", "RGBA"):
+            imagen = imagen.convert("RGBA")
+        maximo = math.ceil(math.log2(max(imagen.size) / tamano)) if max(imagen.size) > tamano else 0
+        niveles = [None] * (maximo + 1)
+        for nivel in range(maximo, -1, -1):
+            columnas, filas = math.ceil(imagen.width / tamano), math.ceil(imagen.height / tamano)
+            niveles[nivel] = {"ancho": imagen.width, "alto": imagen.height, "columnas": columnas, "filas": filas}
+            carpeta = os.path.join(temporal, str(nivel))
+            os.makedirs(carpeta)
+            for x in range(columnas):
+                for y in range(filas):
+                    caja = (x * tamano, y * tamano, min(imagen.width, (x + 1) * tamano), min(imagen.height, (y + 1) * tamano))
+                    imagen.crop(caja).save(os.path.join(carpeta, f"{x}_{y}.webp"), "WEBP", quality=CALIDAD_WEBP, method=4)
+            if nivel > 0:
+                imagen = imagen.reduce(2)
+    info = {"tamano_tesela": tamano, "ancho": niveles[-1]["ancho"], "alto": niveles[-1]["alto"], "niveles": niveles}
+    with open(os.path.join(temporal, "info.json"), "w", encoding="utf-8") as fichero:
+        json.dump(info, fichero)
+    return info
+
+
+#Errores del propio fichero (no es una imagen, está truncada o corrupta, es demasiado grande), que no se arreglan
+#reintentando. Pillow da los fallos de decodificación como OSError sin errno; los del disco (lleno, sin permisos...)
+#sí lo llevan, y los del pool (BrokenProcessPool) no son OSError
+def _imagen_invalida(error):
+    if isinstance(error, (UnidentifiedImageError, Image.DecompressionBombError, SyntaxError)):
+        return True
+    return isinstance(error, OSError) and error.errno is None
+
+
+#Devolver la información de la pirámide de teselas de una imagen (info.json) o None si todavía no existe
+def leer_teselas(image_name):
+    try:
+        with open(os.path.join(ruta_teselas(image_name), "info.json"), encoding="utf-8") as fichero:
+            return json.load(fichero)
+    except FileNotFoundError:
+        return None
+
+
+#Generar la pirámide de teselas de una imagen si no existe. Devuelve su información, o None si Pillow no está
+#instalado o la imagen no se puede procesar. Los demás errores (pool, disco) se propagan y se reintenta la
+#próxima vez que se pidan las teselas
+async def obtener_teselas(image_name):
+    info = leer_teselas(image_name)
+    if info is not None or Image is None or teselas_fallidas(image_name):
+        return info
+
+    origen = os.path.join(STORAGE_PATH, os.path.basename(image_name))
+    destino = ruta_teselas(image_name)
+    tarea = _en_curso.get(destino)
+    if tarea is None:
+        os.makedirs(TESELAS_PATH, exist_ok=True)
+        tarea = asyncio.ensure_future(ejecutar_en_pool(_generar_teselas, origen, destino, TESELA_TAMANO))
+        _en_curso[destino] = tarea
+        tarea.add_done_callback(lambda _: _en_curso.pop(destino, None))
+
+    try:
+        return await asyncio.shield(tarea)
+    except Exception as error:
+        if not _imagen_invalida(error):
+            raise
+        _teselas_fallidas.add(os.path.basename(image_name))
+        return None
+
+
+def teselas_fallidas(image_name):
+    return os.path.basename(image_name) in _teselas_fallidas
+
+
+#Generar la pirámide de teselas de una imagen de mapa sin esperar a que termine
+def programar_teselas(image_name):
+    if Image is None:
+        return
+    tarea = asyncio.ensure_future(obtener_teselas(image_name))
+    _tareas_fondo.add(tarea)
+    tarea.add_done_callback(_fin_teselas)
+
+
+def _fin_teselas(tarea):
+    _tareas_fondo.discard(tarea)
+    if not tarea.cancelled() and tarea.exception() is not None:
+        logger.warning("No se pudo generar la pirámide de teselas; se reintentará: %s", tarea.exception())
+
+
+#Eliminar las variantes y la pirámide de teselas de una imagen que se ha borrado o sustituido
+def eliminar_variantes(image_name):
+    for size in TamanoImagen:
+        ruta = ruta_variante(image_name, size)
+        if os.path.exists(ruta):
+            os.remove(ruta)
+    shutil.rmtree(ruta_teselas(image_name), ignore_errors=True)
+
+
+#Eliminar una imagen subida y sus variantes. Devuelve True si el original existía
+def eliminar_imagen(image_name):
+    ruta = os.path.join(STORAGE_PATH, os.path.basename(image_name))
+    existia = os.path.exists(ruta)
+    if existia:
+        os.remove(ruta)
+    eliminar_variantes(image_name)
+    return existia
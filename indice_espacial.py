@@ -0,0 +1,166 @@
+import asyncio
+import json
+import math
+import os
+from cachetools import TTLCache
+from db_config import database
+
+
+#Índice espacial en memoria de las localizaciones de cada mapa (GET /localizaciones/mapa/{id_mapa}/vista).
+#Las localizaciones de un mapa se cargan con una consulta y se reparten en una rejilla uniforme: cada celda guarda
+#las localizaciones cuyo rectángulo (el que envuelve su punto y su polígono) la toca, así que una vista solo
+#recorre las celdas que cubre y no todo el mapa. El lado de la celda se calcula para que haya unas
+#INDICE_POR_CELDA localizaciones por celda.
+#Cada worker guarda los índices INDICE_ESPACIAL_TTL segundos y descarta el de un mapa en cuanto se crean, modifican
+#o eliminan localizaciones suyas en ese worker; en los demás el cambio se ve, como mucho, al caducar el TTL
+INDICE_ESPACIAL_TTL = int(os.getenv("INDICE_ESPACIAL_TTL", "30"))
+INDICE_ESPACIAL_MAPAS = int(os.getenv("INDICE_ESPACIAL_MAPAS", "500"))
+INDICE_POR_CELDA = 8
+
+QUERY_LOCALIZACIONES_MAPA = """
+    SELECT id_localizacion, nombre_localizacion, tipo_terreno, coordenada_x, coordenada_y, poligono
+    FROM localizaciones WHERE id_mapa = :id_mapa AND coordenada_x IS NOT NULL AND coordenada_y IS NOT NULL
+"""
+
+_indices = TTLCache(maxsize=INDICE_ESPACIAL_MAPAS, ttl=INDICE_ESPACIAL_TTL)
+#id_mapa -> construcción en curso, para que las vistas simultáneas de un mapa sin índice esperen a la misma
+_construcciones = {}
+#id_mapa -> número de invalidaciones: una construcción que empezó antes de invalidar el mapa no guarda su índice
+_generaciones = {}
+#Contadores para /metrics
+estadisticas = {"construidos": 0, "aciertos": 0, "invalidaciones": 0}
+
+
+#Rectángulo que envuelve el punto de la localización y su polígono, si lo tiene
+def caja_localizacion(x, y, poligono):
+    xs = [x] + [punto[0] for punto in poligono or ()]
+    ys = [y] + [punto[1] for punto in poligono or ()]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+#Fila de la tabla localizaciones como diccionario, con el polígono (guardado como texto JSON) ya decodificado
+def localizacion_de_fila(fila):
+    localizacion = dict(fila)
+    if "poligono" in localizacion:
+        localizacion["poligono"] = json.loads(localizacion["poligono"]) if localizacion["poligono"] else None
+    return localizacion
+
+
+def _se_cruzan(caja, x_min, y_min, x_max, y_max):
+    return caja[0] <= x_max and caja[2] >= x_min and caja[1] <= y_max and caja[3] >= y_min
+
+
+class IndiceMapa:
+    def __init__(self, localizaciones):
+        #localizaciones: diccionarios con las columnas de QUERY_LOCALIZACIONES_MAPA (poligono ya decodificado)
+        self.localizaciones = localizaciones
+        self.cajas = [caja_localizacion(l["coordenada_x"], l["coordenada_y"], l["poligono"]) for l in localizaciones]
+        self.celdas = {}
+        if not localizaciones:
+            self.extension = (0.0, 0.0, 0.0, 0.0)
+            self.lado = 1.0
+            return
+        self.extension = (
+            min(caja[0] for caja in self.cajas), min(caja[1] for caja in self.cajas),
+            max(caja[2] for caja in self.cajas), max(caja[3] for caja in self.cajas),
+        )
+        ancho = self.extension[2] - self.extension[0]
+        alto = self.extension[3] - self.extension[1]
+        area = max(ancho, 1.0) * max(alto, 1.0)
+        self.lado = math.sqrt(area * INDICE_POR_CELDA / len(localizaciones))
+        for indice, caja in enumerate(self.cajas):
+            for celda in self._celdas(*caja):
+                self.celdas.setdefault(celda, []).append(indice)
+
+    def _celdas(self, x_min, y_min, x_max, y_max):
+        origen_x, origen_y = self.extension[0], self.extension[1]
+        columna_min = math.floor((x_min - origen_x) / self.lado)
+        columna_max = math.floor((x_max - origen_x) / self.lado)
+        fila_min = math.floor((y_min - origen_y) / self.lado)
+        fila_max = math.floor((y_max - origen_y) / self.lado)
+        for columna in range(columna_min, columna_max + 1):
+            for fila in range(fila_min, fila_max + 1):
+                yield (columna, fila)
+
+    #Localizaciones cuyo rectángulo se cruza con la vista
+    def buscar(self, x_min, y_min, x_max, y_max):
+        if not self.localizaciones or not _se_cruzan(self.extension, x_min, y_min, x_max, y_max):
+            return []
+        #La vista se recorta a la extensión del índice: alejar mucho la vista no recorre celdas vacías
+        x_min, y_min = max(x_min, self.extension[0]), max(y_min, self.extension[1])
+        x_max, y_max = min(x_max, self.extension[2]), min(y_max, self.extension[3])
+        vistos = set()
+        resultado = []
+        for celda in self._celdas(x_min, y_min, x_max, y_max):
+            for indice in self.celdas.get(celda, ()):
+                if indice not in vistos:
+                    vistos.add(indice)
+                    if _se_cruzan(self.cajas[indice], x_min, y_min, x_max, y_max):
+                        resultado.append(self.localizaciones[indice])
+        return resultado
+
+
+#Agrupar las localizaciones de la vista en una rejilla de divisiones x divisiones celdas (en su lado mayor).
+#Devuelve las localizaciones que quedan solas en su celda y un grupo por cada celda con varias
+def agrupar(localizaciones, x_min, y_min, x_max, y_max, divisiones):
+    lado = max(x_max - x_min, y_max - y_min, 1e-9) / divisiones
+    celdas = {}
+    for localizacion in localizaciones:
+        celda = (math.floor((localizacion["coordenada_x"] - x_min) / lado), math.floor((localizacion["coordenada_y"] - y_min) / lado))
+        celdas.setdefault(celda, []).append(localizacion)
+    sueltas = []
+    grupos = []
+    for miembros in celdas.values():
+        if len(miembros) == 1:
+            sueltas.append(miembros[0])
+            continue
+        xs = [miembro["coordenada_x"] for miembro in miembros]
+        ys = [miembro["coordenada_y"] for miembro in miembros]
+        grupos.append({
+            "cantidad": len(miembros),
+            "coordenada_x": sum(xs) / len(xs),
+            "coordenada_y": sum(ys) / len(ys),
+            "x_min": min(xs), "y_min": min(ys), "x_max": max(xs), "y_max": max(ys),
+        })
+    return sueltas, grupos
+
+
+async def _construir(id_mapa):
+    generacion = _generaciones.get(id_mapa, 0)
+    filas = await database.fetch_all(query=QUERY_LOCALIZACIONES_MAPA, values={"id_mapa": id_mapa})
+    localizaciones = [localizacion_de_fila(fila) for fila in filas]
+    indice = IndiceMapa(localizaciones)
+    estadisticas["construidos"] += 1
+    #Si se invalidó mientras se leía, el índice sirve para las peticiones que lo esperaban pero no se guarda
+    if _generaciones.get(id_mapa, 0) == generacion:
+        _indices[id_mapa] = indice
+    return indice
+
+
+async def obtener_indice(id_mapa):
+    indice = _indices.get(id_mapa)
+    if indice is not None:
+        estadisticas["aciertos"] += 1
+        return indice
+    construccion = _construcciones.get(id_mapa)
+    if construccion is None:
+        construccion = asyncio.ensure_future(_construir(id_mapa))
+        _construcciones[id_mapa] = construccion
+    try:
+        return await asyncio.shield(construccion)
+    finally:
+        if _construcciones.get(id_mapa) is construccion and construccion.done():
+            del _construcciones[id_mapa]
+
+
+#Descartar el índice de los mapas; las construcciones en curso pueden haber leído datos viejos y no se reutilizan
+def invalidar_mapas(ids_mapa):
+    for id_mapa in ids_mapa:
+        estadisticas["invalidaciones"] += 1
+        _generaciones[id_mapa] = _generaciones.get(id_mapa, 0) + 1
+        _indices.pop(id_mapa, None)
+        _construcciones.pop(id_mapa, None)
+
+
+def mapas_indexados():
+    return len(_indices)
@@ -0,0 +1,272 @@
+import json
+import logging
+import math
+import os
+import time
+from cachetools import TTLCache
+from fastapi import HTTPException
+from starlette.routing import Match
+from seguridad import verificar_token
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:
+    redis_asyncio = None
+
+
+#Limitación de peticiones por clase de ruta.
+#Cada ruta pertenece a una clase (exportacion, estadisticas, listado... o general si no tiene ninguna asignada) y
+#cada clase tiene:
+#  - un cubo de fichas por cliente (usuario del token o, si no hay token válido, IP): "tasa" fichas por segundo
+#    hasta "rafaga" como máximo (tasa 0 = sin límite). Cada petición gasta una ficha; sin fichas se responde 429
+#    con Retry-After
+#  - un máximo de peticiones simultáneas en el worker ("concurrencia", 0 = sin máximo), para que unas pocas
+#    exportaciones no acaparen el worker. Si está lleno se responde 429 en el acto en vez de encolar
+#Los cubos se guardan en memoria del worker o, con LIMITES_REDIS_URL, en Redis para que todos los workers
+#compartan el mismo límite (si Redis falla se sigue con los cubos locales). La concurrencia es siempre por worker.
+#Clases y rutas se pueden cambiar sin tocar código con LIMITES_CLASES y LIMITES_RUTAS (JSON que se mezcla con
+#los valores por defecto). Las reglas de rutas son "METODO /ruta", "/ruta" (cualquier método) o "router:<tag>"
+#para todas las rutas de un router
+LIMITES_ACTIVOS = os.getenv("LIMITES_ACTIVOS", "1") == "1"
+LIMITES_REDIS_URL = os.getenv("LIMITES_REDIS_URL")
+LIMITES_CLIENTES_MAX = int(os.getenv("LIMITES_CLIENTES_MAX", "100000"))
+
+API = "/api/escribdream"
+
+CLASES_POR_DEFECTO = {
+    "general": {"tasa": 50, "rafaga": 100, "concurrencia": 0, "clave": "usuario"},
+    "listado": {"tasa": 2, "rafaga": 10, "concurrencia": 16, "clave": "usuario"},
+    "estadisticas": {"tasa": 1, "rafaga": 5, "concurrencia": 8, "clave": "usuario"},
+    "exportacion": {"tasa": 0.1, "rafaga": 3, "concurrencia": 4, "clave": "usuario"},
+    "autenticacion": {"tasa": 0.5, "rafaga": 10, "concurrencia": 0, "clave": "ip"},
+    "registro": {"tasa": 0.05, "rafaga": 5, "concurrencia": 0, "clave": "ip"},
+    #El formulario de registro comprueba el correo y el seudónimo mientras se escriben
+    "disponibilidad": {"tasa": 2, "rafaga": 20, "concurrencia": 0, "clave": "ip"},
+    "correo": {"tasa": 0.02, "rafaga": 3, "concurrencia": 2, "clave": "ip"},
+    #Al desplazar o ampliar un mapa el visor pide de golpe las teselas que entran en pantalla (sin token: son <img>)
+    "teselas": {"tasa": 200, "rafaga": 400, "concurrencia": 0, "clave": "ip"},
+}
+
+RUTAS_POR_DEFECTO = {
+    f"GET {API}/capitulos/libro/{{id_libro}}/pdf": "exportacion",
+    f"GET {API}/capitulos/libro/{{id_libro}}/exportar": "exportacion",
+    f"GET {API}/proyectos/{{id_proyecto}}/exportar": "exportacion",
+    f"POST {API}/proyectos/importar": "exportacion",
+    f"GET {API}/usuarios/estadisticas/{{user_id}}": "estadisticas",
+    "POST /token": "autenticacion",
+    "POST /verification/account/google": "autenticacion",
+    "POST /register": "registro",
+    "GET /register/disponible": "disponibilidad",
+    "POST /send/email": "correo",
+    f"GET {API}/images/{{image_name}}/teselas/{{nivel}}/{{x}}/{{y}}": "teselas",
+    #Listados sin filtro
+    f"GET {API}/capitulos": "listado",
+    f"GET {API}/escaletas": "listado",
+    f"GET {API}/eventos": "listado",
+    f"GET {API}/libros": "listado",
+    f"GET {API}/lineas_tiempo/": "listado",
+    f"GET {API}/localizaciones/": "listado",
+    f"GET {API}/mapas/": "listado",
+    f"GET {API}/notas/": "listado",
+    f"GET {API}/personajes/": "listado",
+    f"GET {API}/proyectos/": "listado",
+    f"GET {API}/secciones": "listado",
+    f"GET {API}/usuarios/": "listado",
+}
+
+#Rutas que nunca se limitan (sondas y métricas)
+RUTAS_EXENTAS = {"/healthz", "/readyz", "/metrics"}
+
+logger = logging.getLogger("escribdream.limites")
+
+
+def _configuracion():
+    clases = {nombre: dict(valores) for nombre, valores in CLASES_POR_DEFECTO.items()}
+    for nombre, valores in json.loads(os.getenv("LIMITES_CLASES", "{}")).items():
+        clases.setdefault(nombre, dict(CLASES_POR_DEFECTO["general"])).update(valores)
+    rutas = dict(RUTAS_POR_DEFECTO)
+    rutas.update(json.loads(os.getenv("LIMITES_RUTAS", "{}")))
+    for regla, clase in rutas.items():
+        if clase not in clases:
+            raise ValueError(f"LIMITES_RUTAS: la regla {regla} usa la clase desconocida {clase}")
+    return clases, rutas
+
+
+#Cubo de fichas en Redis: atómico y con el reloj de Redis para que todos los workers vean el mismo tiempo.
+#Devuelve los segundos que faltan para la siguiente ficha (0 si la petición pasa)
+SCRIPT_CUBO = """
+local tasa = tonumber(ARGV[1])
+local rafaga = tonumber(ARGV[2])
+local reloj = redis.call('TIME')
+local ahora = tonumber(reloj[1]) + tonumber(reloj[2]) / 1000000
+local datos = redis.call('HMGET', KEYS[1], 'f', 't')
+local fichas = tonumber(datos[1]) or rafaga
+local instante = tonumber(datos[2]) or ahora
+fichas = math.min(rafaga, fichas + math.max(0, ahora - instante) * tasa)
+local espera = 0
+if fichas >= 1 then
+    fichas = fichas - 1
+else
+    espera = (1 - fichas) / tasa
+end
+redis.call('HSET', KEYS[1], 'f', fichas, 't', ahora)
+redis.call('PEXPIRE', KEYS[1], math.ceil(rafaga / tasa * 1000) + 1000)
+return tostring(espera)
+"""
+
+
+class LimitadorPeticiones:
+    def __init__(self, clases, rutas, redis_url=LIMITES_REDIS_URL, maximo_clientes=LIMITES_CLIENTES_MAX):
+        self.clases = clases
+        self.rutas = rutas
+        #Cubos locales por clase: cliente -> (fichas, instante). Una entrada caduca cuando el cubo ya estaría
+        #lleno, así que olvidarla no cambia nada
+        self.cubos = {
+            nombre: TTLCache(maxsize=maximo_clientes, ttl=max(1.0, clase["rafaga"] / clase["tasa"]))
+            for nombre, clase in clases.items() if clase["tasa"] > 0
+        }
+        self.en_curso = {nombre: 0 for nombre in clases}
+        self.rechazadas = {(nombre, motivo): 0 for nombre in clases for motivo in ("tasa", "concurrencia")}
+        self.compartido = None
+        self._script = None
+        self._ultimo_aviso = 0
+        if redis_url and redis_asyncio is not None:
+            self.compartido = redis_asyncio.from_url(redis_url)
+            self._script = self.compartido.register_script(SCRIPT_CUBO)
+
+    def _espera_local(self, clase, cliente):
+        configuracion = self.clases[clase]
+        cubo = self.cubos[clase]
+        ahora = time.monotonic()
+        fichas, instante = cubo.get(cliente, (configuracion["rafaga"], ahora))
+        fichas = min(configuracion["rafaga"], fichas + (ahora - instante) * configuracion["tasa"])
+        if fichas >= 1:
+            cubo[cliente] = (fichas - 1, ahora)
+            return 0
+        cubo[cliente] = (fichas, ahora)
+        return (1 - fichas) / configuracion["tasa"]
+
+    #Gastar una ficha del cliente. Devuelve los segundos que tiene que esperar (0 si puede pasar)
+    async def consumir(self, clase, cliente):
+        configuracion = self.clases[clase]
+        if configuracion["tasa"] <= 0:
+            return 0
+        if self.compartido is not None:
+            try:
+                espera = await self._script(keys=[f"escribdream:limite:{clase}:{cliente}"], args=[configuracion["tasa"], configuracion["rafaga"]])
+                return float(espera)
+            except Exception:
+                #Un aviso por minuto como mucho, no uno por petición
+                if time.monotonic() - self._ultimo_aviso > 60:
+                    self._ultimo_aviso = time.monotonic()
+                    logger.warning("No se pudo usar Redis para los límites; se usan los cubos locales", exc_info=True)
+        return self._espera_local(clase, cliente)
+
+    def estadisticas(self):
+        return [({"clase": clase, "motivo": motivo}, valor) for (clase, motivo), valor in self.rechazadas.items()]
+
+    def en_curso_series(self):
+        return [({"clase": clase}, valor) for clase, valor in self.en_curso.items()]
+
+
+limitador = LimitadorPeticiones(*_configuracion())
+
+
+def _cliente(scope, clave):
+    if clave == "usuario":
+        for nombre, valor in scope["headers"]:
+            if nombre == b"authorization":
+                esquema, _, token = valor.decode("latin-1").partition(" ")
+                if esquema.lower() == "bearer" and token:
+                    try:
+                        return f"u:{verificar_token(token)['sub']}"
+                    except HTTPException:
+                        pass
+                break
+    cliente = scope.get("client")
+    return f"ip:{cliente[0] if cliente else 'desconocida'}"
+
+
+def _respuesta_429(espera, detalle):
+    cuerpo = json.dumps({"detail": detalle}).encode("utf-8")
+    cabeceras = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(cuerpo)).encode()),
+        (b"retry-after", str(max(1, math.ceil(espera))).encode()),
+    ]
+    return cabeceras, cuerpo
+
+
+#Middleware ASGI puro, como MetricasMiddleware. Las rutas con clase se resuelven la primera vez contra las rutas
+#de la aplicación; las demás peticiones no recorren la tabla de rutas y se tratan como "general"
+class LimitesMiddleware:
+    def __init__(self, app, registro=limitador):
+        self.app = app
+        self.registro = registro
+        self.rutas_con_clase = None
+
+    def _resolver_rutas(self, app):
+        rutas_con_clase = []
+        usadas = set()
+        for ruta in app.router.routes:
+            metodos = getattr(ruta, "methods", None) or ()
+            reglas = [f"{metodo} {ruta.path}" for metodo in metodos] + [ruta.path]
+            reglas += [f"router:{tag}" for tag in getattr(ruta, "tags", None) or ()]
+            reglas = [regla for regla in reglas if regla in self.registro.rutas]
+            usadas.update(reglas)
+            if reglas:
+                rutas_con_clase.append((ruta, self.registro.rutas[reglas[0]]))
+        #Una regla que no corresponde a ninguna ruta (una errata en el parámetro, una ruta renombrada) dejaría
+        #la ruta en "general" sin que nadie se entere
+        for regla in sorted(self.registro.rutas.keys() - usadas):
+            logger.warning("La regla de límites %s no corresponde a ninguna ruta de la aplicación", regla)
+        return rutas_con_clase
+
+    def _clase(self, scope):
+        if self.rutas_con_clase is None:
+            self.rutas_con_clase = self._resolver_rutas(scope["app"])
+        for ruta, clase in self.rutas_con_clase:
+            coincidencia, _ = ruta.matches(scope)
+            if coincidencia == Match.FULL:
+                return clase, ruta
+        return "general", None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or scope["path"] in RUTAS_EXENTAS:
+            await self.app(scope, receive, send)
+            return
+
+        registro = self.registro
+        clase, ruta = self._clase(scope)
+        configuracion = registro.clases[clase]
+
+        espera = await registro.consumir(clase, _cliente(scope, configuracion["clave"]))
+        if espera > 0:
+            registro.rechazadas[(clase, "tasa")] += 1
+            await self._rechazar(scope, send, ruta, espera, f"Demasiadas peticiones. Inténtalo de nuevo en {max(1, math.ceil(espera))} segundos")
+            return
+
+        maximo = configuracion["concurrencia"]
+        if maximo and registro.en_curso[clase] >= maximo:
+            registro.rechazadas[(clase, "concurrencia")] += 1
+            await self._rechazar(scope, send, ruta, 1, "El servidor está ocupado con otras peticiones de este tipo. Inténtalo de nuevo en unos segundos")
+            return
+
+        registro.en_curso[clase] += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            registro.en_curso[clase] -= 1
+
+    async def _rechazar(self, scope, send, ruta, espera, detalle):
+        #Para que las métricas cuenten el 429 en su ruta y no como ruta no encontrada
+        if ruta is None:
+            for candidata in scope["app"].router.routes:
+                if candidata.matches(scope)[0] == Match.FULL:
+                    ruta = candidata
+                    break
+        if ruta is not None:
+            scope["route"] = ruta
+        cabeceras, cuerpo = _respuesta_429(espera, detalle)
+        await send({"type": "http.response.start", "status": 429, "headers": cabeceras})
+        await send({"type": "http.response.body", "body": cuerpo})
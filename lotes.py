@@ -0,0 +1,71 @@
+import os
+from fastapi import HTTPException
+from db_config import database
+
+
+#Operaciones por lotes (crear, actualizar y eliminar muchas filas de una tabla en una sola petición).
+#Todo el lote va en una transacción: o se guardan todas las filas o ninguna.
+#Las inserciones usan INSERT de varias filas, partidas en trozos de FILAS_POR_INSERT para no pasar
+#de max_allowed_packet con textos largos
+LOTE_MAXIMO = int(os.getenv("LOTE_MAXIMO", "1000"))
+FILAS_POR_INSERT = int(os.getenv("FILAS_POR_INSERT", "250"))
+
+
+def comprobar_lote(elementos):
+    if not elementos:
+        raise HTTPException(status_code=400, detail="El lote está vacío")
+    if len(elementos) > LOTE_MAXIMO:
+        raise HTTPException(status_code=413, detail=f"El lote no puede tener más de {LOTE_MAXIMO} elementos")
+
+
+#INSERT de varias filas (diccionarios con las mismas columnas) con parámetros :columna_indice
+def consulta_insert(tabla, columnas, filas):
+    marcadores = []
+    values = {}
+    for indice, fila in enumerate(filas):
+        marcadores.append("(" + ", ".join(f":{columna}_{indice}" for columna in columnas) + ")")
+        for columna in columnas:
+            values[f"{columna}_{indice}"] = fila[columna]
+    return f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES {', '.join(marcadores)}", values
+
+
+#Insertar las filas y devolver sus ids en el mismo orden, dentro de la transacción que tenga abierta quien llama.
+#En un INSERT de varias filas MySQL reserva los autoincrementos de golpe y LAST_INSERT_ID() es el primero,
+#así que los ids son consecutivos a partir de él
+async def insertar_filas(tabla, columnas, filas):
+    ids = []
+    for inicio in range(0, len(filas), FILAS_POR_INSERT):
+        trozo = filas[inicio:inicio + FILAS_POR_INSERT]
+        query, values = consulta_insert(tabla, columnas, trozo)
+        id_insertado = await database.execute(query=query, values=values)
+        #SQLite (benchmarks) devuelve el último id de la sentencia, no el primero
+        primer_id = id_insertado - len(trozo) + 1 if database.url.dialect == "sqlite" else id_insertado
+        ids.extend(range(primer_id, primer_id + len(trozo)))
+    return ids
+
+
+async def insertar_lote(tabla, columnas, filas):
+    async with database.transaction():
+        return await insertar_filas(tabla, columnas, filas)
+
+
+#Actualizar varias filas. Cada elemento trae el id y solo los campos que cambian; los elementos que cambian
+#los mismos campos comparten sentencia y se envían juntos con execute_many
+async def actualizar_lote(tabla, columna_id, elementos):
+    grupos = {}
+    for elemento in elementos:
+        campos = tuple(sorted(campo for campo in elemento if campo != columna_id))
+        if not campos:
+            raise HTTPException(status_code=400, detail=f"No se especificaron campos a actualizar para {columna_id} = {elemento[columna_id]}")
+        grupos.setdefault(campos, []).append(elemento)
+
+    async with database.transaction():
+        for campos, grupo in grupos.items():
+            query = f"UPDATE {tabla} SET {', '.join(f'{campo} = :{campo}' for campo in campos)} WHERE {columna_id} = :{columna_id}"
+            await database.execute_many(query=query, values=grupo)
+
+
+#Eliminar varias filas por id con una sola sentencia. Los ids ya vienen validados como enteros
+async def eliminar_lote(tabla, columna_id, ids):
+    query = f"DELETE FROM {tabla} WHERE {columna_id} IN ({', '.join(str(int(id_fila)) for id_fila in sorted(set(ids)))})"
+    await database.execute(query=query)
@@ -1,5 +1,5 @@
 import uvicorn
-from db_config import app
+from db_config import app, estado_pool
 from fastapi.middleware.cors import CORSMiddleware
 from endpoints_usuarios import router as usuarios_router
 from endpoints_proyectos import router as proyectos_router
@@ -14,6 +14,21 @@ from endpoints_notas import router as notas_router
 from endpoints_escaletas import router as escaletas_router
 from endpoints_secciones_escaleta import router as secciones_escaleta_router
 from endpoint_login_register import router as login_router
+from endpoints_archivo_proyecto import router as archivo_proyecto_router
+from cache_entidades import cache_entidades
+from exportaciones import iniciar_exportaciones
+from arranque import iniciar_arranque
+from servidor import instalar_drenaje
+from correos import iniciar_correos, cerrar_correos, estadisticas as estadisticas_correos
+from eliminaciones import iniciar_eliminaciones, cerrar_eliminaciones, estadisticas as estadisticas_eliminaciones
+from salud import router as salud_router
+from limites import LIMITES_ACTIVOS, LimitesMiddleware, limitador
+from metricas import metricas, MetricasMiddleware, router as metricas_router
+from consultas import ConsultasMiddleware, totales as totales_consultas
+from trazas import TrazasMiddleware, cerrar_trazas
+from permisos import mapas_en_cache
+from seguridad import tokens_en_cache
+from indice_espacial import estadisticas as estadisticas_indice_espacial, mapas_indexados
 
 # origins = [
 #     "http://127.0.0.1:57628",  
@@ -37,6 +52,54 @@ app.include_router(notas_router)
 app.include_router(escaletas_router)
 app.include_router(secciones_escaleta_router)
 app.include_router(login_router)
+app.include_router(archivo_proyecto_router)
+app.include_router(metricas_router)
+app.include_router(salud_router)
+
+#Nivel compartido de la caché de entidades (suscripción a invalidaciones de otros workers)
+app.add_event_handler("startup", cache_entidades.iniciar)
+app.add_event_handler("shutdown", cache_entidades.cerrar)
+app.add_event_handler("shutdown", cerrar_trazas)
+
+#Localizar wkhtmltopdf y Node para los motores de exportación
+app.add_event_handler("startup", iniciar_exportaciones)
+
+#Precalentamiento opcional (ESCRIBDREAM_PRECALENTAR=1): pool de conexiones, cachés, passlib, pool de procesos y binarios
+app.add_event_handler("startup", iniciar_arranque)
+
+#Marcar el worker como drenando cuando llegue SIGTERM (ver servidor.py)
+app.add_event_handler("startup", instalar_drenaje)
+
+#Worker de la bandeja de salida de correos
+app.add_event_handler("startup", iniciar_correos)
+app.add_event_handler("shutdown", cerrar_correos)
+
+#Worker de eliminación diferida (borra por lotes los usuarios, proyectos y libros marcados como eliminados)
+app.add_event_handler("startup", iniciar_eliminaciones)
+app.add_event_handler("shutdown", cerrar_eliminaciones)
+
+#Indicadores que se leen en cada consulta a /metrics
+def series_pool():
+    estado = estado_pool()
+    if estado is None:
+        return None
+    return [({"estado": nombre}, valor) for nombre, valor in estado.items()]
+
+def series_cache_entidades():
+    return [({"estadistica": nombre}, valor) for nombre, valor in cache_entidades.estadisticas().items()]
+
+metricas.registrar_indicador("escribdream_db_pool_connections", "Conexiones del pool de la base de datos", series_pool)
+metricas.registrar_indicador("escribdream_cache_entidades", "Aciertos, fallos, invalidaciones y entradas de la caché de entidades", series_cache_entidades)
+metricas.registrar_indicador("escribdream_cache_tokens_entradas", "Tokens verificados en caché", tokens_en_cache)
+metricas.registrar_indicador("escribdream_cache_acceso_entradas", "Mapas de acceso en caché", mapas_en_cache)
+metricas.registrar_indicador("escribdream_indice_espacial", "Índices espaciales de mapas construidos, aciertos, invalidaciones y en caché", lambda: [({"estadistica": nombre}, valor) for nombre, valor in {**estadisticas_indice_espacial, "entradas": mapas_indexados()}.items()])
+metricas.registrar_indicador("escribdream_eliminaciones", "Eliminaciones diferidas pendientes, filas e imágenes borradas y errores", lambda: [({"estadistica": nombre}, valor) for nombre, valor in estadisticas_eliminaciones.items()])
+metricas.registrar_indicador("escribdream_correos", "Correos encolados, enviados, reintentos, fallidos y errores del worker", lambda: [({"estadistica": nombre}, valor) for nombre, valor in estadisticas_correos.items()])
+metricas.registrar_indicador("escribdream_limites_rechazadas_total", "Peticiones rechazadas con 429 por clase de ruta y motivo", limitador.estadisticas, tipo="counter")
+metricas.registrar_indicador("escribdream_limites_en_curso", "Peticiones en curso por clase de ruta", limitador.en_curso_series)
+metricas.registrar_indicador("escribdream_db_queries_total", "Consultas ejecutadas", lambda: totales_consultas["consultas"], tipo="counter")
+metricas.registrar_indicador("escribdream_db_query_seconds_total", "Tiempo total en consultas", lambda: totales_consultas["segundos"], tipo="counter")
+metricas.registrar_indicador("escribdream_db_slow_queries_total", "Consultas que superan CONSULTAS_LENTAS_MS", lambda: totales_consultas["lentas"], tipo="counter")
 
 
 origins = [
@@ -44,6 +107,11 @@ origins = [
     "http://127.0.0.1",
     "*"
 ]
+
+#Límites de peticiones por usuario/IP y clase de ruta (ver limites.py). Va por dentro de CORS para que
+#los 429 también lleven las cabeceras CORS
+if LIMITES_ACTIVOS:
+    app.add_middleware(LimitesMiddleware)
     
 app.add_middleware(
     CORSMiddleware,
@@ -54,6 +122,16 @@ app.add_middleware(
     allow_headers=["*"],  
 )
 
+#Contabilidad de consultas por petición (cabeceras Server-Timing / X-DB-Queries)
+app.add_middleware(ConsultasMiddleware)
+
+#Span de servidor por petición; las consultas, subprocesos y llamadas externas cuelgan de él
+app.add_middleware(TrazasMiddleware)
+
+#Se añade el último para que envuelva a los demás y mida la petición completa
+app.add_middleware(MetricasMiddleware)
+
+#Desarrollo (un worker con recarga). En producción se arranca con python servidor.py
 if __name__ == "__main__":
     
     uvicorn.run("main:app", host="0.0.0.0", port=4000, reload=True, log_level="info")
\ No newline at end of file
@@ -0,0 +1,142 @@
+import mimetypes
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+import anyio
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+
+
+#Los ficheros de user_storage se guardan con un uuid4 como nombre y nunca se sobrescriben,
+#así que su contenido no cambia y el navegador puede guardarlos en caché indefinidamente
+PATRON_NOMBRE_INMUTABLE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(_[a-z0-9_]+)?\.[A-Za-z0-9]+$")
+
+CACHE_INMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDAR = "public, no-cache"
+
+PATRON_RANGO = re.compile(r"^bytes=(\d*)-(\d*)$")
+TAMANO_BLOQUE = 64 * 1024
+
+
+def es_nombre_inmutable(nombre):
+    return PATRON_NOMBRE_INMUTABLE.match(os.path.basename(nombre)) is not None
+
+
+def calcular_etag(stat_result):
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+#Comprobar If-None-Match / If-Modified-Since para responder 304 sin enviar el fichero
+def _no_modificado(request, etag, stat_result):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        etags = [valor.strip().removeprefix("W/") for valor in if_none_match.split(",")]
+        return "*" in etags or etag in etags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            fecha = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return int(stat_result.st_mtime) <= fecha.timestamp()
+    return False
+
+
+#Devolver (inicio, fin) del rango pedido, None si se debe enviar el fichero completo
+#o lanzar ValueError si el rango no se puede satisfacer
+def _parsear_rango(cabecera, tamano):
+    coincidencia = PATRON_RANGO.match(cabecera.strip())
+    if not coincidencia:
+        #Rangos múltiples o unidades desconocidas: se ignora la cabecera y se envía el fichero entero
+        return None
+    inicio, fin = coincidencia.groups()
+    if inicio == "" and fin == "":
+        return None
+    if inicio == "":
+        #bytes=-N son los últimos N bytes
+        longitud = int(fin)
+        if longitud == 0:
+            raise ValueError("Rango vacío")
+        return max(0, tamano - longitud), tamano - 1
+    inicio = int(inicio)
+    fin = tamano - 1 if fin == "" else min(int(fin), tamano - 1)
+    if inicio >= tamano or inicio > fin:
+        raise ValueError("Rango fuera del fichero")
+    return inicio, fin
+
+
+#Respuesta 206 con un fragmento del fichero. Si el servidor soporta la extensión ASGI zerocopysend
+#se le pasa el descriptor para que use sendfile, si no se lee por bloques en un hilo
+class RangoFicheroResponse(Response):
+    def __init__(self, path, inicio, fin, tamano, headers, media_type):
+        super().__init__(status_code=206, headers=headers, media_type=media_type)
+        self.path = path
+        self.inicio = inicio
+        self.fin = fin
+        self.headers["content-range"] = f"bytes {inicio}-{fin}/{tamano}"
+        self.headers["content-length"] = str(fin - inicio + 1)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"].upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        restante = self.fin - self.inicio + 1
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as fichero:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": fichero,
+                    "offset": self.inicio,
+                    "count": restante,
+                    "more_body": False,
+                })
+            return
+
+        async with await anyio.open_file(self.path, "rb") as fichero:
+            await fichero.seek(self.inicio)
+            while restante > 0:
+                bloque = await fichero.read(min(TAMANO_BLOQUE, restante))
+                if not bloque:
+                    break
+                restante -= len(bloque)
+                await send({"type": "http.response.body", "body": bloque, "more_body": restante > 0})
+        if restante > 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+#Servir un fichero del almacenamiento con ETag, Last-Modified, Cache-Control,
+#peticiones condicionales (304) y rangos de bytes (206)
+def servir_fichero(request: Request, path, inmutable=None, media_type=None):
+    stat_result = os.stat(path)
+    if inmutable is None:
+        inmutable = es_nombre_inmutable(path)
+    if media_type is None:
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    etag = calcular_etag(stat_result)
+    headers = {
+        "etag": etag,
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "cache-control": CACHE_INMUTABLE if inmutable else CACHE_REVALIDAR,
+        "accept-ranges": "bytes",
+    }
+
+    if _no_modificado(request, etag, stat_result):
+        return Response(status_code=304, headers=headers)
+
+    cabecera_rango = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if cabecera_rango and (if_range is None or if_range == etag or if_range == headers["last-modified"]):
+        try:
+            rango = _parsear_rango(cabecera_rango, stat_result.st_size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "content-range": f"bytes */{stat_result.st_size}"})
+        if rango is not None:
+            inicio, fin = rango
+            return RangoFicheroResponse(path, inicio, fin, stat_result.st_size, headers, media_type)
+
+    #FileResponse usa la extensión pathsend del servidor cuando está disponible
+    return FileResponse(path, headers=headers, media_type=media_type, stat_result=stat_result)
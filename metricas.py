@@ -0,0 +1,211 @@
+import hmac
+import os
+from bisect import bisect_right
+from collections import Counter
+from time import perf_counter
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+
+
+#Métricas en formato de exposición de Prometheus (text/plain 0.0.4).
+#Se guardan en diccionarios del propio proceso, sin locks ni dependencias, para que el coste por petición
+#sea mínimo. Con varios workers cada uno expone sus propias series y Prometheus las agrega por instancia
+METRICAS_TOKEN = os.getenv("METRICAS_TOKEN")
+
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BUCKETS_TAMANO = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+#Las series se etiquetan con la plantilla de la ruta (/api/escribdream/libros/{id_libro}) y no con la ruta real,
+#así el número de series no crece con los ids. Las peticiones que no encajan en ninguna ruta se agrupan aquí
+RUTA_NO_ENCONTRADA = "<sin_ruta>"
+
+#Cada petición solo se apunta en una lista; los histogramas se actualizan por lotes
+#(al llenarse la lista o al leer /metrics), que sale bastante más barato que hacerlo petición a petición
+TAMANO_LOTE = 1024
+
+
+class Histograma:
+    __slots__ = ("buckets", "cuentas", "suma", "total")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.cuentas = [0] * (len(buckets) + 1)
+        self.suma = 0.0
+        self.total = 0
+
+    #Se ordena el lote y se busca cada límite en él: son pocas búsquedas por lote en lugar de una por valor
+    def observar_lote(self, valores):
+        valores = sorted(valores)
+        cuentas = self.cuentas
+        anterior = 0
+        for indice, limite in enumerate(self.buckets):
+            posicion = bisect_right(valores, limite, anterior)
+            cuentas[indice] += posicion - anterior
+            anterior = posicion
+        cuentas[-1] += len(valores) - anterior
+        self.suma += sum(valores)
+        self.total += len(valores)
+
+
+#Todas las series de una ruta (método + plantilla) juntas, para resolverlas con una sola búsqueda por petición.
+#Las peticiones se apuntan en pendientes como (estado, duración, tamaño) y se vuelcan a los histogramas por lotes
+class SerieRuta:
+    __slots__ = ("estados", "latencia", "tamano", "pendientes")
+
+    def __init__(self):
+        self.estados = Counter()
+        self.latencia = Histograma(BUCKETS_LATENCIA)
+        self.tamano = Histograma(BUCKETS_TAMANO)
+        self.pendientes = []
+
+    def consolidar(self):
+        if not self.pendientes:
+            return
+        pendientes, self.pendientes = self.pendientes, []
+        estados, duraciones, tamanos = zip(*pendientes)
+        self.estados.update(estados)
+        self.latencia.observar_lote(duraciones)
+        self.tamano.observar_lote(tamanos)
+
+
+def _etiquetas(**etiquetas):
+    pares = []
+    for nombre, valor in etiquetas.items():
+        valor = str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pares.append(f'{nombre}="{valor}"')
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+def _numero(valor):
+    if valor == float("inf"):
+        return "+Inf"
+    if isinstance(valor, float) and valor.is_integer() and abs(valor) < 1e15:
+        return str(int(valor))
+    return repr(valor) if isinstance(valor, float) else str(valor)
+
+
+class Metricas:
+    def __init__(self):
+        self.series = {}
+        self.en_curso = 0
+        #nombre -> (descripción, tipo, función). La función devuelve un número o una lista de (etiquetas, valor)
+        self.indicadores = {}
+
+    def serie(self, metodo, ruta):
+        clave = (metodo, ruta)
+        serie = self.series.get(clave)
+        if serie is None:
+            serie = self.series[clave] = SerieRuta()
+        return serie
+
+    def consolidar(self):
+        for serie in list(self.series.values()):
+            serie.consolidar()
+
+    #Punto de extensión para pools, cachés, colas...: la función se evalúa en cada lectura de /metrics
+    def registrar_indicador(self, nombre, descripcion, funcion, tipo="gauge"):
+        self.indicadores[nombre] = (descripcion, tipo, funcion)
+
+    def _exportar_histograma(self, lineas, nombre, descripcion, atributo):
+        lineas.append(f"# HELP {nombre} {descripcion}")
+        lineas.append(f"# TYPE {nombre} histogram")
+        for (metodo, ruta), serie in sorted(self.series.items()):
+            histograma = getattr(serie, atributo)
+            acumulado = 0
+            for limite, cuenta in zip(histograma.buckets + (float("inf"),), histograma.cuentas):
+                acumulado += cuenta
+                lineas.append(f"{nombre}_bucket{_etiquetas(method=metodo, route=ruta, le=_numero(float(limite)))} {acumulado}")
+            lineas.append(f"{nombre}_sum{_etiquetas(method=metodo, route=ruta)} {_numero(histograma.suma)}")
+            lineas.append(f"{nombre}_count{_etiquetas(method=metodo, route=ruta)} {histograma.total}")
+
+    def exportar(self):
+        self.consolidar()
+        lineas = [
+            "# HELP escribdream_http_requests_total Peticiones HTTP atendidas",
+            "# TYPE escribdream_http_requests_total counter",
+        ]
+        for (metodo, ruta), serie in sorted(self.series.items()):
+            for estado, total in sorted(serie.estados.items()):
+                lineas.append(f"escribdream_http_requests_total{_etiquetas(method=metodo, route=ruta, status=estado)} {total}")
+
+        lineas.append("# HELP escribdream_http_requests_in_progress Peticiones HTTP en curso")
+        lineas.append("# TYPE escribdream_http_requests_in_progress gauge")
+        lineas.append(f"escribdream_http_requests_in_progress {self.en_curso}")
+
+        self._exportar_histograma(lineas, "escribdream_http_request_duration_seconds", "Duración de las peticiones HTTP", "latencia")
+        self._exportar_histograma(lineas, "escribdream_http_response_size_bytes", "Tamaño del cuerpo de las respuestas HTTP", "tamano")
+
+        for nombre, (descripcion, tipo, funcion) in self.indicadores.items():
+            try:
+                valor = funcion()
+            except Exception:
+                continue
+            if valor is None:
+                continue
+            lineas.append(f"# HELP {nombre} {descripcion}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            if isinstance(valor, (int, float)):
+                lineas.append(f"{nombre} {_numero(valor)}")
+            else:
+                for etiquetas, valor_serie in valor:
+                    lineas.append(f"{nombre}{_etiquetas(**etiquetas)} {_numero(valor_serie)}")
+        return "\n".join(lineas) + "\n"
+
+
+metricas = Metricas()
+
+
+#Middleware ASGI puro (sin BaseHTTPMiddleware) para no añadir una tarea ni copiar el cuerpo en cada petición
+class MetricasMiddleware:
+    def __init__(self, app, registro=metricas):
+        self.app = app
+        self.registro = registro
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        #[estado, bytes del cuerpo enviados]
+        respuesta = [500, 0]
+
+        #Función normal que devuelve la corrutina de send: así no se crea una corrutina extra por mensaje
+        def send_con_metricas(mensaje):
+            tipo = mensaje["type"]
+            if tipo == "http.response.body":
+                respuesta[1] += len(mensaje.get("body", b""))
+            elif tipo == "http.response.start":
+                respuesta[0] = mensaje["status"]
+            elif tipo == "http.response.zerocopysend":
+                respuesta[1] += mensaje.get("count") or 0
+            return send(mensaje)
+
+        registro = self.registro
+        registro.en_curso += 1
+        inicio = perf_counter()
+        try:
+            await self.app(scope, receive, send_con_metricas)
+        finally:
+            duracion = perf_counter() - inicio
+            registro.en_curso -= 1
+            #FastAPI deja en el scope la ruta que ha atendido la petición
+            ruta = scope.get("route")
+            clave = (scope["method"], ruta.path if ruta is not None else RUTA_NO_ENCONTRADA)
+            serie = registro.series.get(clave) or registro.serie(*clave)
+            pendientes = serie.pendientes
+            pendientes.append((respuesta[0], duracion, respuesta[1]))
+            if len(pendientes) >= TAMANO_LOTE:
+                serie.consolidar()
+
+
+router = APIRouter(tags=["Métricas"])
+
+
+#Si se define METRICAS_TOKEN el endpoint exige "Authorization: Bearer <token>"
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics(request: Request):
+    if METRICAS_TOKEN:
+        autorizacion = request.headers.get("authorization", "")
+        if not hmac.compare_digest(autorizacion, f"Bearer {METRICAS_TOKEN}"):
+            raise HTTPException(status_code=403, detail="No tienes permiso para acceder a las métricas")
+    return PlainTextResponse(metricas.exportar(), media_type="text/plain; version=0.0.4; charset=utf-8")
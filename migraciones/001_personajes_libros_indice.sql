@@ -0,0 +1,17 @@
+-- Índice compuesto (id_libro, id_personaje) en personajes_libros.
+-- Lo usan PUT /personajes/libro/{id_libro} (el SELECT ... FOR UPDATE solo bloquea las filas del libro)
+-- y los listados de personajes por libro. Al ser UNIQUE además impide asociar dos veces el mismo par.
+-- Antes de crearlo se eliminan los pares duplicados que pudiera haber.
+
+CREATE TEMPORARY TABLE personajes_libros_unicos AS
+    SELECT DISTINCT id_personaje, id_libro FROM personajes_libros;
+
+DELETE FROM personajes_libros;
+
+INSERT INTO personajes_libros (id_personaje, id_libro)
+    SELECT id_personaje, id_libro FROM personajes_libros_unicos;
+
+DROP TEMPORARY TABLE personajes_libros_unicos;
+
+ALTER TABLE personajes_libros
+    ADD UNIQUE INDEX idx_personajes_libros_libro_personaje (id_libro, id_personaje);
@@ -0,0 +1,15 @@
+-- Eliminación diferida (eliminaciones.py): DELETE de usuarios, proyectos y libros solo marca eliminado_en
+-- y un worker en segundo plano borra después los hijos por lotes y finalmente la fila.
+-- El índice permite al worker encontrar rápido lo pendiente.
+
+ALTER TABLE usuarios
+    ADD COLUMN eliminado_en DATETIME NULL DEFAULT NULL,
+    ADD INDEX idx_usuarios_eliminado_en (eliminado_en);
+
+ALTER TABLE proyectos
+    ADD COLUMN eliminado_en DATETIME NULL DEFAULT NULL,
+    ADD INDEX idx_proyectos_eliminado_en (eliminado_en);
+
+ALTER TABLE libros
+    ADD COLUMN eliminado_en DATETIME NULL DEFAULT NULL,
+    ADD INDEX idx_libros_eliminado_en (eliminado_en);
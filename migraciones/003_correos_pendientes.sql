@@ -0,0 +1,18 @@
+-- Bandeja de salida de correos (correos.py): /send/email solo inserta aquí el mensaje y un worker en
+-- segundo plano lo envía, reintentando con espera creciente si Gmail falla.
+-- El índice permite al worker encontrar rápido los pendientes cuyo reintento ya toca.
+
+CREATE TABLE correos_pendientes (
+    id_correo INT AUTO_INCREMENT PRIMARY KEY,
+    destinatario VARCHAR(255) NOT NULL,
+    asunto VARCHAR(255) NOT NULL,
+    cuerpo TEXT NULL,
+    estado VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+    intentos INT NOT NULL DEFAULT 0,
+    siguiente_intento DATETIME NOT NULL,
+    bloqueo VARCHAR(36) NULL,
+    ultimo_error TEXT NULL,
+    fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+    fecha_envio DATETIME NULL,
+    INDEX idx_correos_pendientes_estado_intento (estado, siguiente_intento)
+);
@@ -0,0 +1,11 @@
+-- Índice único en usuarios.correo_electronico.
+-- El inicio de sesión con Google (POST /verification/account/google) hace un único
+-- INSERT ... ON DUPLICATE KEY UPDATE sobre este índice: crea la cuenta o devuelve la existente en un viaje
+-- y sin carreras cuando dos pestañas inician sesión a la vez. También impide registrar dos veces el mismo correo.
+-- Antes de crearlo no puede haber correos repetidos. Esta consulta los lista para resolverlos a mano
+-- (fusionar o eliminar las cuentas duplicadas):
+--   SELECT correo_electronico, COUNT(*) AS cuentas, GROUP_CONCAT(id_usuario) AS ids
+--   FROM usuarios GROUP BY correo_electronico HAVING COUNT(*) > 1;
+
+ALTER TABLE usuarios
+    ADD UNIQUE INDEX idx_usuarios_correo_electronico (correo_electronico);
@@ -0,0 +1,9 @@
+-- Índice en usuarios.seudonimo.
+-- Lo usa GET /register/disponible?seudonimo=... para saber si un seudónimo ya está en uso sin recorrer la tabla.
+-- No es UNIQUE porque el registro permite repetir seudónimos. Si algún día se exigen únicos, antes hay que resolver
+-- los repetidos y después basta con cambiarlo por un UNIQUE INDEX (los seudónimos vacíos se guardan como NULL, que
+-- no cuentan como repetidos):
+--   UPDATE usuarios SET seudonimo = NULL WHERE seudonimo = '';
+
+ALTER TABLE usuarios
+    ADD INDEX idx_usuarios_seudonimo (seudonimo);
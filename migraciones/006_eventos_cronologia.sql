@@ -0,0 +1,18 @@
+-- Cronología de los eventos de una línea de tiempo.
+--   posicion_inicio / posicion_fin: posición del evento en el tiempo de la historia, en las unidades que elija el
+--   autor (años, días, capítulos...). posicion_fin es NULL si el evento no dura.
+--   orden: rango con huecos que ordena los eventos de una misma posición. Al mover un evento entre dos se le da el
+--   punto medio, así que reordenar no renumera la línea de tiempo.
+-- Los eventos existentes quedan todos en la posición 0, en el orden en que se crearon.
+-- El índice sirve GET /eventos/linea_tiempo/{id} ordenado, las ventanas (/ventana?desde=&hasta=) y los vecinos.
+-- Hace innecesario un índice solo sobre id_linea_tiempo, si lo hubiera.
+
+ALTER TABLE eventos
+    ADD COLUMN posicion_inicio DOUBLE NOT NULL DEFAULT 0,
+    ADD COLUMN posicion_fin DOUBLE NULL,
+    ADD COLUMN orden DOUBLE NOT NULL DEFAULT 0;
+
+UPDATE eventos SET orden = id_evento * 1024;
+
+ALTER TABLE eventos
+    ADD INDEX idx_eventos_id_linea_tiempo_posicion_inicio_orden (id_linea_tiempo, posicion_inicio, orden);
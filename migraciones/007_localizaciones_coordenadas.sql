@@ -0,0 +1,11 @@
+-- Posición de las localizaciones sobre la imagen del mapa, para GET /localizaciones/mapa/{id_mapa}/vista.
+--   coordenada_x / coordenada_y: punto de la localización, en píxeles de la imagen del mapa. NULL = sin colocar
+--   (no aparece en las vistas). Si solo se envía un polígono se guarda su centroide.
+--   poligono: contorno opcional como JSON, [[x, y], [x, y], ...] con al menos tres vértices.
+-- Las vistas no consultan estas columnas en cada petición: indice_espacial.py carga las localizaciones del mapa
+-- por el índice de la clave ajena id_mapa y las reparte en una rejilla en memoria.
+
+ALTER TABLE localizaciones
+    ADD COLUMN coordenada_x DOUBLE NULL,
+    ADD COLUMN coordenada_y DOUBLE NULL,
+    ADD COLUMN poligono TEXT NULL;
@@ -1,7 +1,22 @@
 const { QuillDeltaToHtmlConverter } = require('quill-delta-to-html');
+const readline = require('readline');
 
-const delta = JSON.parse(process.argv[2]); // Leer el delta de los argumentos de línea de comandos
-const converter = new QuillDeltaToHtmlConverter(delta.ops, {});
-const html = converter.convert();
+function convertir(delta) {
+    const converter = new QuillDeltaToHtmlConverter(delta.ops || [], {});
+    return converter.convert();
+}
 
-console.log(html); // Imprimir el HTML resultante
+if (process.argv[2] !== undefined) {
+    const delta = JSON.parse(process.argv[2]); // Leer el delta de los argumentos de línea de comandos
+    console.log(convertir(delta)); // Imprimir el HTML resultante
+} else {
+    // Sin argumentos: un delta por línea en la entrada estándar y el HTML de cada uno como cadena JSON en una línea
+    // de la salida, en el mismo orden. Así un libro entero se convierte con un solo proceso y sin límite de tamaño
+    const entrada = readline.createInterface({ input: process.stdin, crlfDelay: Infinity });
+    entrada.on('line', (linea) => {
+        if (!linea.trim()) {
+            return;
+        }
+        process.stdout.write(JSON.stringify(convertir(JSON.parse(linea))) + '\n');
+    });
+}
@@ -0,0 +1,192 @@
+import os
+import time
+from cachetools import TTLCache
+from fastapi import Depends, HTTPException, Request
+from db_config import database
+from seguridad import get_id_usuario_actual
+
+
+#Mapa de acceso de cada usuario: todos los ids de proyectos, libros, capítulos, mapas, etc. que le pertenecen.
+#Se carga con una única consulta y se guarda en caché, así comprobar la propiedad de cualquier recurso
+#cuesta una búsqueda en memoria en lugar de un JOIN por petición
+ACCESO_CACHE_SIZE = int(os.getenv("ACCESO_CACHE_SIZE", "10000"))
+ACCESO_CACHE_TTL = int(os.getenv("ACCESO_CACHE_TTL", "300"))
+
+#Si un id no aparece en un mapa con más de estos segundos se recarga una vez antes de denegar el acceso,
+#por si el recurso se creó en otro worker
+ACCESO_RECARGA_MIN = float(os.getenv("ACCESO_RECARGA_MIN", "1"))
+
+_mapas_acceso = TTLCache(maxsize=ACCESO_CACHE_SIZE, ttl=ACCESO_CACHE_TTL)
+
+
+#Nombre del parámetro (en la ruta, la query o el cuerpo) -> tipo de recurso del mapa de acceso
+PARAMETROS_RECURSO = {
+    "id_proyecto": "proyecto",
+    "id_libro": "libro",
+    "id_capitulo": "capitulo",
+    "id_mapa": "mapa",
+    "id_localizacion": "localizacion",
+    "id_escaleta": "escaleta",
+    "id_seccion": "seccion",
+    "id_nota": "nota",
+    "id_linea_tiempo": "linea_tiempo",
+    "id_evento": "evento",
+    "id_personaje": "personaje",
+}
+
+#Parámetros que identifican al propio usuario
+PARAMETROS_USUARIO = ("id_usuario", "user_id")
+
+#En el cuerpo solo se comprueban los contenedores: el id propio de la entidad que se crea
+#(id_evento, id_nota...) suele venir a 0 o vacío
+PARAMETROS_CUERPO = ("id_proyecto", "id_libro", "id_mapa", "id_escaleta", "id_linea_tiempo")
+
+#Lo que está marcado como eliminado (eliminaciones.py) no entra en el mapa, así deja de ser accesible en cuanto
+#se marca aunque el worker todavía no haya borrado las filas. La fila 'usuario' indica que la cuenta sigue activa
+QUERY_MAPA_ACCESO = """
+    SELECT 'usuario' AS tipo, u.id_usuario AS id FROM usuarios u WHERE u.id_usuario = :id_usuario AND u.eliminado_en IS NULL
+    UNION ALL
+    SELECT 'proyecto', p.id_proyecto FROM proyectos p WHERE p.id_usuario = :id_usuario AND p.eliminado_en IS NULL
+    UNION ALL
+    SELECT 'libro', l.id_libro FROM libros l JOIN proyectos p ON l.id_proyecto = p.id_proyecto WHERE p.id_usuario = :id_usuario AND p.eliminado_en IS NULL AND l.eliminado_en IS NULL
+    UNION ALL
+    SELECT 'capitulo', c.id_capitulo FROM capitulos c JOIN libros l ON c.id_libro = l.id_libro JOIN proyectos p ON l.id_proyecto = p.id_proyecto WHERE p.id_usuario = :id_usuario AND p.eliminado_en IS NULL AND l.eliminado_en IS NULL
+    UNION ALL
+    SELECT 'mapa', m.id_mapa FROM mapas m JOIN libros l ON m.id_libro = l.id_libro JOIN proyectos p ON l.id_proyecto = p.id_proyecto WHERE p.id_usuario = :id_usuario AND p.eliminado_en IS NULL AND l.eliminado_en IS NULL
+    UNION ALL
+    SELECT 'localizacion', lo.id_localizacion FROM localizaciones lo JOIN mapas m ON lo.id_mapa = m.id_mapa JOIN libros l ON m.id_libro = l.id_libro JOIN proyectos p ON l.id_proyecto = p.id_proyecto WHERE p.id_usuario = :id_usuario AND p.eliminado_en IS NULL AND l.eliminado_en IS NULL
+    UNION ALL
+    SELECT 'escaleta', e.id_escaleta FROM escaletas e JOIN libros l ON e.id_libro = l.id_libro JOIN proyectos p ON l.id_proyecto = p.id_proyecto WHERE p.id_usuario = :id_usuario AND p.eliminado_en IS NULL AND l.eliminado_en IS NULL
+    UNION ALL
+    SELECT 'seccion', s.id_seccion FROM secciones_escaleta s JOIN escaletas e ON s.id_escaleta = e.id_escaleta JOIN libros l ON e.id_libro = l.id_libro JOIN proyectos p ON l.id_proyecto = p.id_proyecto WHERE p.id_usuario = :id_usuario AND p.eliminado_en IS NULL AND l.eliminado_en IS NULL
+    UNION ALL
+    SELECT 'nota', n.id_nota FROM notas n JOIN libros l ON n.id_libro = l.id_libro JOIN proyectos p ON l.id_proyecto = p.id_proyecto WHERE p.id_usuario = :id_usuario AND p.eliminado_en IS NULL AND l.eliminado_en IS NULL
+    UNION ALL
+    SELECT 'linea_tiempo', lt.id_linea_tiempo FROM lineas_de_tiempo lt JOIN proyectos p ON lt.id_proyecto = p.id_proyecto WHERE p.id_usuario = :id_usuario AND p.eliminado_en IS NULL
+    UNION ALL
+    SELECT 'evento', ev.id_evento FROM eventos ev JOIN lineas_de_tiempo lt ON ev.id_linea_tiempo = lt.id_linea_tiempo JOIN proyectos p ON lt.id_proyecto = p.id_proyecto WHERE p.id_usuario = :id_usuario AND p.eliminado_en IS NULL
+    UNION ALL
+    SELECT 'personaje', pe.id_personaje FROM personajes pe JOIN proyectos p ON pe.id_proyecto = p.id_proyecto WHERE p.id_usuario = :id_usuario AND p.eliminado_en IS NULL
+"""
+
+
+class MapaAcceso:
+    def __init__(self, id_usuario, filas):
+        self.id_usuario = id_usuario
+        self.cargado_en = time.monotonic()
+        self.recursos = {tipo: set() for tipo in PARAMETROS_RECURSO.values()}
+        self.activo = False
+        for fila in filas:
+            if fila["tipo"] == "usuario":
+                self.activo = True
+            else:
+                self.recursos[fila["tipo"]].add(fila["id"])
+
+    def ids(self, tipo):
+        return self.recursos[tipo]
+
+    def permite(self, tipo, id_recurso):
+        return id_recurso in self.recursos[tipo]
+
+
+async def cargar_mapa_acceso(id_usuario):
+    filas = await database.fetch_all(query=QUERY_MAPA_ACCESO, values={"id_usuario": id_usuario})
+    mapa = MapaAcceso(id_usuario, filas)
+    _mapas_acceso[id_usuario] = mapa
+    return mapa
+
+
+#Olvidar el mapa de acceso de un usuario. Se llama al crear o eliminar recursos
+def invalidar_acceso(id_usuario):
+    _mapas_acceso.pop(id_usuario, None)
+
+
+def mapas_en_cache():
+    return len(_mapas_acceso)
+
+
+#Dependencia: devuelve el mapa de acceso del usuario autenticado (desde caché si es posible)
+async def get_mapa_acceso(id_usuario: int = Depends(get_id_usuario_actual)) -> MapaAcceso:
+    mapa = _mapas_acceso.get(id_usuario)
+    if mapa is None:
+        mapa = await cargar_mapa_acceso(id_usuario)
+    if not mapa.activo:
+        raise HTTPException(status_code=403, detail="El usuario no existe o ha sido eliminado")
+    return mapa
+
+
+def _a_entero(valor):
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return None
+
+
+#Reunir los (tipo, id) que la petición quiere tocar a partir de la ruta, la query y el cuerpo JSON
+async def _recursos_pedidos(request: Request):
+    pedidos = []
+    for origen in (request.path_params, request.query_params):
+        for clave, valor in origen.items():
+            if clave in PARAMETROS_RECURSO or clave in PARAMETROS_USUARIO:
+                pedidos.append((clave, valor))
+
+    if request.method in ("POST", "PUT", "PATCH") and request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            cuerpo = await request.json()
+        except ValueError:
+            cuerpo = None
+        elementos = cuerpo if isinstance(cuerpo, list) else [cuerpo]
+        for elemento in elementos:
+            if not isinstance(elemento, dict):
+                continue
+            for clave in PARAMETROS_CUERPO + PARAMETROS_USUARIO:
+                if elemento.get(clave) is not None:
+                    pedidos.append((clave, elemento[clave]))
+    return pedidos
+
+
+def _comprobar(mapa, pedidos):
+    for clave, valor in pedidos:
+        id_recurso = _a_entero(valor)
+        if clave in PARAMETROS_USUARIO:
+            if id_recurso != mapa.id_usuario:
+                return False
+        elif id_recurso is None or not mapa.permite(PARAMETROS_RECURSO[clave], id_recurso):
+            return False
+    return True
+
+
+#Dependencia a nivel de router: rechaza con 403 cualquier petición sobre recursos de otro usuario.
+#Cuando la petición crea o elimina algo, el mapa de acceso del usuario se invalida al terminar
+async def verificar_acceso(request: Request, mapa: MapaAcceso = Depends(get_mapa_acceso)):
+    pedidos = await _recursos_pedidos(request)
+    if not _comprobar(mapa, pedidos):
+        if time.monotonic() - mapa.cargado_en < ACCESO_RECARGA_MIN:
+            raise HTTPException(status_code=403, detail="No tienes permiso para acceder a este recurso")
+        mapa = await cargar_mapa_acceso(mapa.id_usuario)
+        if not _comprobar(mapa, pedidos):
+            raise HTTPException(status_code=403, detail="No tienes permiso para acceder a este recurso")
+
+    yield
+
+    if request.method in ("POST", "DELETE"):
+        invalidar_acceso(mapa.id_usuario)
+
+
+#Comprobar de una vez una lista de ids del mismo tipo (operaciones por lotes). Igual que verificar_acceso,
+#recarga el mapa una vez antes de denegar por si algún recurso se creó en otro worker
+async def verificar_ids(mapa, tipo, ids):
+    if all(mapa.permite(tipo, id_recurso) for id_recurso in ids):
+        return mapa
+    if time.monotonic() - mapa.cargado_en >= ACCESO_RECARGA_MIN:
+        mapa = await cargar_mapa_acceso(mapa.id_usuario)
+        if all(mapa.permite(tipo, id_recurso) for id_recurso in ids):
+            return mapa
+    raise HTTPException(status_code=403, detail="No tienes permiso para acceder a este recurso")
+
+
+#Fragmento SQL para limitar un listado a los ids a los que el usuario tiene acceso
+def filtro_acceso(columna, ids):
+    if not ids:
+        return "1=0"
+    return f"{columna} IN ({', '.join(str(int(id_recurso)) for id_recurso in sorted(ids))})"
@@ -0,0 +1,30 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+#Pool de procesos compartido para el trabajo pesado de CPU (redimensionar imágenes, generar exportaciones...)
+#Se crea bajo demanda la primera vez que se usa para que los workers que no lo necesitan no paguen el coste
+MAX_WORKERS = int(os.getenv("ESCRIBDREAM_PROCESOS", "0")) or None
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=MAX_WORKERS)
+    return _pool
+
+
+#Ejecutar una función en el pool sin bloquear el bucle de eventos
+async def ejecutar_en_pool(funcion, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_pool(), funcion, *args)
+
+
+#Cerrar el pool al apagar la aplicación
+def cerrar_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
@@ -0,0 +1,97 @@
+import asyncio
+import os
+import tempfile
+import time
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from db_config import database
+from imagenes import STORAGE_PATH
+from exportaciones import motores_disponibles
+from arranque import PRECALENTAR, estado_arranque
+from servidor import estado_servidor
+
+
+#Sondas para el balanceador y el orquestador, sin autenticación:
+#  /healthz: el proceso está vivo y atiende peticiones. No hace E/S
+#  /readyz: el worker puede recibir tráfico. Comprueba un SELECT 1 con una conexión del pool, que se puede
+#  escribir en user_storage y qué motores de exportación están disponibles. Devuelve 503 si algo obligatorio
+#  falla, mientras el worker drena tras un SIGTERM o si el precalentamiento no ha terminado.
+#El resultado de las comprobaciones se reutiliza SALUD_TTL segundos y las sondas que llegan mientras se está
+#comprobando esperan a esa misma comprobación, así que las sondas frecuentes no cargan la base de datos
+SALUD_TTL = float(os.getenv("SALUD_TTL", "2"))
+SALUD_TIMEOUT = float(os.getenv("SALUD_TIMEOUT", "2"))
+
+#Formatos de exportación sin los que el worker no se considera listo (separados por comas, p. ej. "pdf,epub").
+#Los demás solo se informan
+SALUD_MOTORES_OBLIGATORIOS = [motor for motor in os.getenv("SALUD_MOTORES_OBLIGATORIOS", "").split(",") if motor]
+
+router = APIRouter(tags=["Salud"])
+
+_ultimo = {"instante": None, "resultado": None}
+_comprobacion = None
+
+
+async def _comprobar_base_datos():
+    await asyncio.wait_for(database.fetch_one(query="SELECT 1"), timeout=SALUD_TIMEOUT)
+
+
+def _comprobar_almacenamiento():
+    with tempfile.NamedTemporaryFile(dir=STORAGE_PATH, prefix=".salud_"):
+        pass
+
+
+async def _comprobar():
+    comprobaciones = {}
+    for nombre, comprobacion in (
+        ("base_datos", _comprobar_base_datos()),
+        ("almacenamiento", asyncio.to_thread(_comprobar_almacenamiento)),
+    ):
+        inicio = time.perf_counter()
+        try:
+            await comprobacion
+            comprobaciones[nombre] = {"ok": True}
+        except Exception as error:
+            comprobaciones[nombre] = {"ok": False, "error": str(error) or type(error).__name__}
+        comprobaciones[nombre]["ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+
+    motores = motores_disponibles()
+    faltan = [motor for motor in SALUD_MOTORES_OBLIGATORIOS if not motores.get(motor)]
+    comprobaciones["motores_exportacion"] = {"ok": not faltan, "disponibles": motores}
+    return comprobaciones
+
+
+async def _comprobaciones_cacheadas():
+    global _comprobacion
+    if _ultimo["instante"] is not None and time.monotonic() - _ultimo["instante"] < SALUD_TTL:
+        return _ultimo["resultado"]
+    if _comprobacion is None:
+        _comprobacion = asyncio.ensure_future(_comprobar())
+    comprobacion = _comprobacion
+    try:
+        resultado = await asyncio.shield(comprobacion)
+    finally:
+        if _comprobacion is comprobacion and comprobacion.done():
+            _comprobacion = None
+    _ultimo["instante"] = time.monotonic()
+    _ultimo["resultado"] = resultado
+    return resultado
+
+
+@router.get("/healthz", include_in_schema=False)
+async def healthz():
+    return {"ok": True}
+
+
+@router.get("/readyz", include_in_schema=False)
+async def readyz():
+    if estado_servidor["drenando"]:
+        return JSONResponse(status_code=503, content={"ok": False, "message": "El worker se está apagando"})
+    if PRECALENTAR and not estado_arranque["precalentado"]:
+        return JSONResponse(status_code=503, content={"ok": False, "message": "El worker todavía se está precalentando"})
+
+    comprobaciones = await _comprobaciones_cacheadas()
+    listo = all(comprobacion["ok"] for comprobacion in comprobaciones.values())
+    contenido = {"ok": listo, "content": comprobaciones}
+    if PRECALENTAR and estado_arranque["errores"]:
+        contenido["avisos"] = estado_arranque["errores"]
+    return JSONResponse(status_code=200 if listo else 503, content=contenido)
@@ -0,0 +1,58 @@
+import os
+import time
+import jwt
+from cachetools import TTLCache
+from dotenv import load_dotenv
+from fastapi import Depends, HTTPException
+from fastapi.security import OAuth2PasswordBearer
+
+load_dotenv()
+
+SECRET_KEY = os.getenv("SECRET_KEY")
+ALGORITHM = "HS256"
+
+oauth2_scheme = OAuth2PasswordBearer("/token")
+
+#Caché de tokens ya verificados: evita repetir la verificación de la firma en cada petición.
+#Las entradas caducan a los TOKEN_CACHE_TTL segundos o cuando caduca el propio token
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", "300"))
+
+_tokens_verificados = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+
+
+#Verificar la firma y la caducidad del token una sola vez y devolver sus claims
+def verificar_token(token: str) -> dict:
+    payload = _tokens_verificados.get(token)
+    if payload is not None:
+        if payload.get("exp") is None or payload["exp"] > time.time():
+            return payload
+        _tokens_verificados.pop(token, None)
+        raise HTTPException(status_code=403, detail="Token expirado")
+
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=403, detail="Token expirado")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=403, detail="Token inválido")
+
+    if payload.get("sub") is None:
+        raise HTTPException(status_code=403, detail="Se requiere autenticación")
+
+    _tokens_verificados[token] = payload
+    return payload
+
+
+def tokens_en_cache():
+    return len(_tokens_verificados)
+
+
+#Dependencia para las rutas protegidas: verifica el token e inyecta el id del usuario
+async def get_id_usuario_actual(token: str = Depends(oauth2_scheme)) -> int:
+    payload = verificar_token(token)
+    try:
+        return int(payload["sub"])
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=403, detail="Token inválido")
+
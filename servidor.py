@@ -0,0 +1,97 @@
+import importlib.util
+import logging
+import os
+import signal
+import threading
+import uvicorn
+
+
+#Arranque en producción: python servidor.py
+#(main.py sigue arrancando un único worker con --reload para desarrollo)
+#  - ESCRIBDREAM_WORKERS procesos (por defecto uno por núcleo disponible). Cada worker importa main:app por su
+#    cuenta y abre su propio pool de conexiones en el evento startup de db_config, después de crearse el proceso:
+#    nunca se comparte una conexión entre procesos
+#  - uvloop y httptools si están instalados
+#  - keep-alive más largo que el timeout de inactividad del balanceador, para que no sea este quien corte
+#    conexiones a medias, y backlog configurable
+#  - con SIGTERM el worker deja de aceptar conexiones, marca estado_servidor["drenando"] (readyz deja de dar
+#    listo) y espera hasta ESCRIBDREAM_APAGADO_SEGUNDOS a que terminen las peticiones en curso (exportaciones,
+#    autoguardados...) antes de ejecutar los eventos shutdown
+HOST = os.getenv("ESCRIBDREAM_HOST", "0.0.0.0")
+PUERTO = int(os.getenv("ESCRIBDREAM_PUERTO", "4000"))
+KEEPALIVE_SEGUNDOS = int(os.getenv("ESCRIBDREAM_KEEPALIVE", "75"))
+BACKLOG = int(os.getenv("ESCRIBDREAM_BACKLOG", "2048"))
+APAGADO_SEGUNDOS = int(os.getenv("ESCRIBDREAM_APAGADO_SEGUNDOS", "60"))
+#Reiniciar cada worker tras este número de peticiones (0 = nunca), por si hubiera fugas de memoria
+MAXIMO_PETICIONES = int(os.getenv("ESCRIBDREAM_MAXIMO_PETICIONES", "0"))
+#IPs de los proxies de los que se aceptan X-Forwarded-For / X-Forwarded-Proto
+PROXIES = os.getenv("ESCRIBDREAM_PROXIES", "127.0.0.1")
+ACCESS_LOG = os.getenv("ESCRIBDREAM_ACCESS_LOG", "0") == "1"
+
+logger = logging.getLogger("escribdream.servidor")
+
+estado_servidor = {"drenando": False}
+
+
+def nucleos_disponibles():
+    #En contenedores sched_getaffinity respeta el límite de CPUs; cpu_count devuelve los del host
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def workers_por_defecto():
+    return int(os.getenv("ESCRIBDREAM_WORKERS", "0")) or nucleos_disponibles()
+
+
+def _disponible(modulo):
+    return importlib.util.find_spec(modulo) is not None
+
+
+#Evento startup de cada worker: encadena un aviso a los manejadores de SIGTERM/SIGINT que instala uvicorn
+#para saber que el worker está drenando. Solo se puede hacer desde el hilo principal (no en TestClient)
+async def instalar_drenaje():
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for senal in (signal.SIGTERM, signal.SIGINT):
+        anterior = signal.getsignal(senal)
+        if not callable(anterior):
+            continue
+
+        def manejador(sig, frame, anterior=anterior):
+            if not estado_servidor["drenando"]:
+                estado_servidor["drenando"] = True
+                logger.info("Señal %s recibida: drenando las peticiones en curso", sig)
+            anterior(sig, frame)
+
+        signal.signal(senal, manejador)
+
+
+def main():
+    workers = workers_por_defecto()
+    #El pool de procesos (imágenes y exportaciones) es por worker: se reparte entre todos para no crear
+    #workers x núcleos procesos
+    os.environ.setdefault("ESCRIBDREAM_PROCESOS", str(max(1, nucleos_disponibles() // workers)))
+    opciones = {
+        "host": HOST,
+        "port": PUERTO,
+        "workers": workers,
+        "loop": "uvloop" if _disponible("uvloop") else "asyncio",
+        "http": "httptools" if _disponible("httptools") else "h11",
+        "backlog": BACKLOG,
+        "timeout_keep_alive": KEEPALIVE_SEGUNDOS,
+        "timeout_graceful_shutdown": APAGADO_SEGUNDOS,
+        "limit_max_requests": MAXIMO_PETICIONES or None,
+        "proxy_headers": True,
+        "forwarded_allow_ips": PROXIES,
+        "access_log": ACCESS_LOG,
+        "log_level": os.getenv("ESCRIBDREAM_LOG_LEVEL", "info"),
+    }
+    logger.info("Arrancando %s workers (loop %s, http %s)", workers, opciones["loop"], opciones["http"])
+    #Con varios workers la aplicación tiene que pasarse como "modulo:app" para que cada proceso la importe
+    uvicorn.run("main:app", **opciones)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,120 @@
+import os
+from contextlib import nullcontext
+
+try:
+    from opentelemetry import trace
+    from opentelemetry.propagate import extract
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    from opentelemetry.trace import SpanKind, Status, StatusCode
+except ImportError:
+    trace = None
+
+
+#Trazas compatibles con OpenTelemetry: un span por petición HTTP (continuando el traceparent del cliente si lo hay)
+#y spans hijos para las consultas, los subprocesos de Node, wkhtmltopdf y las llamadas a Gmail.
+#Si opentelemetry-sdk no está instalado o TRAZAS_EXPORTADOR es "ninguno", span() no hace nada.
+#Exportadores: "ninguno", "consola", "memoria" (para pruebas) y "otlp" (necesita opentelemetry-exporter-otlp
+#y se configura con las variables estándar OTEL_EXPORTER_OTLP_*)
+TRAZAS_EXPORTADOR = os.getenv("TRAZAS_EXPORTADOR", "ninguno")
+
+#Fracción de trazas que se muestrean (0.0 - 1.0). Si la petición ya trae una traza se respeta su decisión
+TRAZAS_MUESTREO = float(os.getenv("TRAZAS_MUESTREO", "1.0"))
+
+TRAZAS_SERVICIO = os.getenv("TRAZAS_SERVICIO", "escribdream-api")
+
+tracer = None
+proveedor = None
+exportador_memoria = None
+
+
+def configurar_trazas(exportador=TRAZAS_EXPORTADOR, muestreo=TRAZAS_MUESTREO):
+    global tracer, proveedor, exportador_memoria
+    if proveedor is not None:
+        proveedor.shutdown()
+    tracer = proveedor = exportador_memoria = None
+    if trace is None or exportador == "ninguno":
+        return None
+
+    proveedor = TracerProvider(
+        resource=Resource.create({"service.name": TRAZAS_SERVICIO}),
+        sampler=ParentBased(TraceIdRatioBased(muestreo)),
+    )
+    if exportador == "memoria":
+        exportador_memoria = InMemorySpanExporter()
+        proveedor.add_span_processor(SimpleSpanProcessor(exportador_memoria))
+    elif exportador == "consola":
+        proveedor.add_span_processor(SimpleSpanProcessor(ConsoleSpanExporter()))
+    elif exportador == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        proveedor.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    else:
+        raise ValueError(f"Exportador de trazas desconocido: {exportador}")
+
+    tracer = proveedor.get_tracer("escribdream")
+    return proveedor
+
+
+def cerrar_trazas():
+    if proveedor is not None:
+        proveedor.shutdown()
+
+
+#Span hijo del span actual. Uso: with span("wkhtmltopdf", {"pdf.bytes_html": len(html)}): ...
+def span(nombre, atributos=None, cliente=False):
+    if tracer is None:
+        return nullcontext()
+    if atributos:
+        atributos = {clave: valor for clave, valor in atributos.items() if valor is not None}
+    return tracer.start_as_current_span(nombre, kind=SpanKind.CLIENT if cliente else SpanKind.INTERNAL, attributes=atributos)
+
+
+#Middleware ASGI: abre el span de servidor de cada petición y un span hijo mientras se envía la respuesta,
+#que es donde se ve el tiempo de streaming de los ficheros
+class TrazasMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if tracer is None or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        metodo = scope["method"]
+        cabeceras = {nombre.decode("latin-1"): valor.decode("latin-1") for nombre, valor in scope.get("headers", [])}
+        atributos = {"http.method": metodo, "http.target": scope["path"], "http.scheme": scope.get("scheme", "http")}
+        if scope.get("client"):
+            atributos["net.peer.ip"] = scope["client"][0]
+
+        with tracer.start_as_current_span(metodo, context=extract(cabeceras), kind=SpanKind.SERVER, attributes=atributos) as span_peticion:
+            span_envio = None
+
+            async def send_con_trazas(mensaje):
+                nonlocal span_envio
+                if mensaje["type"] == "http.response.start":
+                    estado = mensaje["status"]
+                    span_peticion.set_attribute("http.status_code", estado)
+                    if estado >= 500:
+                        span_peticion.set_status(Status(StatusCode.ERROR))
+                    span_envio = tracer.start_span("enviar respuesta", context=trace.set_span_in_context(span_peticion))
+                await send(mensaje)
+                if span_envio is not None and not mensaje.get("more_body", False) and mensaje["type"] != "http.response.start":
+                    span_envio.end()
+                    span_envio = None
+
+            try:
+                await self.app(scope, receive, send_con_trazas)
+            finally:
+                if span_envio is not None:
+                    span_envio.end()
+                #El nombre definitivo usa la plantilla de la ruta, que solo se conoce después de enrutar
+                ruta = scope.get("route")
+                if ruta is not None:
+                    span_peticion.update_name(f"{metodo} {ruta.path}")
+                    span_peticion.set_attribute("http.route", ruta.path)
+
+
+configurar_trazas()